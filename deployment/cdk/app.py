@@ -17,7 +17,7 @@ storage_stack = MultiModalVideoAnalyticsStorageStack(app, "MultiModalVideoAnalyt
 lambda_stack = MultiModalVideoAnalyticsLambdaStack(app, "MultiModalVideoAnalyticsLambdaStack", storage_stack=storage_stack)
 
 if create_ecs_stack:
-    ecs_stack = MultiModalVideoAnalyticsECSStack(app, "MultiModalVideoAnalyticsECSStack")
+    ecs_stack = MultiModalVideoAnalyticsECSStack(app, "MultiModalVideoAnalyticsECSStack", lambda_stack=lambda_stack)
 
 api_stack = MultiModalVideoAnalyticsAPIStack(app, "MultiModalVideoAnalyticsAPIStack", lambda_stack=lambda_stack, storage_stack=storage_stack)
 web_app_stack = MultiModalVideoAnalyticsWebAppStack(app, "MultiModalVideoAnalyticsWebAppStack", storage_stack=storage_stack, api_stack=api_stack, lambda_stack=lambda_stack)
@@ -6,6 +6,7 @@ from aws_cdk import (
     aws_logs as logs,
     aws_ecs_patterns as ecs_patterns,
     aws_lambda as lambda_,
+    aws_lambda_event_sources as lambda_event_sources,
     aws_dynamodb as dynamodb,
     aws_iam as iam,
     aws_s3 as s3,
@@ -18,6 +19,9 @@ from aws_cdk import (
     aws_cognito as cognito,
     aws_opensearchservice as opensearch,
     aws_secretsmanager as secretmng,
+    aws_sqs as sqs,
+    aws_cloudwatch as cloudwatch,
+    aws_applicationautoscaling as appscaling,
     custom_resources as cr,
     aws_ec2,
     CfnParameter,
@@ -28,7 +32,8 @@ from aws_cdk import (
     Size,
     Environment,
     Tags,
-    SecretValue
+    SecretValue,
+    IgnoreMode
 )
 from constructs import Construct
 import os
@@ -98,6 +103,20 @@ class MultiModalVideoAnalyticsStorageStack(Stack):
             billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
             removal_policy=RemovalPolicy.DESTROY,
         )
+        self.dynamo_task_state = dynamodb.Table(
+            self, "DynamoDBTaskState",
+            partition_key=dynamodb.Attribute(name="task_id", type=dynamodb.AttributeType.STRING),
+            sort_key=dynamodb.Attribute(name="state_key", type=dynamodb.AttributeType.STRING),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            removal_policy=RemovalPolicy.DESTROY,
+        )
+        # Token buckets shared by every Lambda that calls a model, one item per model_id
+        self.dynamo_rate_limit = dynamodb.Table(
+            self, "DynamoDBRateLimit",
+            partition_key=dynamodb.Attribute(name="model_id", type=dynamodb.AttributeType.STRING),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            removal_policy=RemovalPolicy.DESTROY,
+        )
 
         # Opensearch domain
 
@@ -162,6 +181,13 @@ class MultiModalVideoAnalyticsLambdaStack(Stack):
         # 获取vqa_model的值
         brc_enable = 'Y' if model_config.get('brconnector_enable', '') == 'true' else 'N'
         brc_endpoint = model_config.get('brconnector_endpoint', '')
+        stream_result = 'Y' if model_config.get('stream_result', '') == 'true' else 'N'
+        # requests per minute by model_id substring, see rate_limiter in the runtime_utils layer
+        model_rate_limits = json.dumps(model_config.get('model_rate_limits', {}))
+        # concurrent video_analysis batches and model calls per execution environment, together they bound the model
+        # calls made for the analysis queue
+        analysis_max_concurrency = int(model_config.get('analysis_max_concurrency', 4))
+        analysis_model_concurrency = int(model_config.get('analysis_model_concurrency', 8))
         vqa_model = model_config.get('vqa_model', '')
         postprocess_model = model_config.get('postprocess_model', '')
         opensearch_preprocess_model = model_config.get('opensearch_preprocess_model', '')
@@ -187,6 +213,12 @@ class MultiModalVideoAnalyticsLambdaStack(Stack):
             code=lambda_.Code.from_asset("../../assets/layer/rerank-python-layer.zip"),
             compatible_runtimes=[lambda_.Runtime.PYTHON_3_11]
         )
+        # Shared pooled clients and secret cache for the inference Lambdas
+        self.layer_runtime_utils = lambda_.LayerVersion(
+            self, "runtime_utils",
+            code=lambda_.Code.from_asset("../../source/layer/runtime_utils", exclude=["tests"]),
+            compatible_runtimes=[lambda_.Runtime.PYTHON_3_9,lambda_.Runtime.PYTHON_3_11]
+        )
 
         # Lambda Role
         self.lambda_role_admin = iam.Role(
@@ -289,7 +321,7 @@ class MultiModalVideoAnalyticsLambdaStack(Stack):
             handler="lambda_function.lambda_handler",
             timeout=Duration.seconds(60),
             role=self.lambda_role_admin,
-            layers=[self.layer_opensearch],
+            layers=[self.layer_opensearch, self.layer_runtime_utils],
             environment={
                 "OPENSEARCH_ENDPOINT": storage_stack.search_domain_endpoint,
                 "INDEX_NAME": "multimodal-knn-index"
@@ -304,7 +336,7 @@ class MultiModalVideoAnalyticsLambdaStack(Stack):
             handler="lambda_function.lambda_handler",
             timeout=Duration.seconds(60),
             role=self.lambda_role_admin,
-            layers=[self.layer_opensearch, self.layer_rerank],
+            layers=[self.layer_opensearch, self.layer_rerank, self.layer_runtime_utils],
             memory_size=1024,
             ephemeral_storage_size=Size.mebibytes(1024),
             environment={
@@ -315,6 +347,8 @@ class MultiModalVideoAnalyticsLambdaStack(Stack):
                 "FOLLOW_FRONT": "N",
                 "MODEL_NAME": opensearch_preprocess_model,
                 "BRC_ENABLE": brc_enable,
+                "RATE_LIMIT_TABLE": storage_stack.dynamo_rate_limit.table_name,
+                "MODEL_RATE_LIMITS": model_rate_limits,
                 "BRC_ENDPOINT": brc_endpoint,
 
             }
@@ -328,36 +362,68 @@ class MultiModalVideoAnalyticsLambdaStack(Stack):
             handler="lambda_function.lambda_handler",
             timeout=Duration.seconds(60),
             role=self.lambda_role_admin,
-            layers=[self.layer_boto3],
+            layers=[self.layer_boto3, self.layer_runtime_utils],
             environment={
                 "NotifyLambda": self.websocket_notify.function_name,
                 "RESULT_DYNAMODB": storage_stack.dynamo_result.table_name,
                 "BRC_ENABLE": brc_enable,
+                "RATE_LIMIT_TABLE": storage_stack.dynamo_rate_limit.table_name,
+                "MODEL_RATE_LIMITS": model_rate_limits,
                 "BRC_ENDPOINT": brc_endpoint,
             }
         )
         self.video_summary.node.add_dependency(storage_stack.dynamo_result, self.websocket_notify, self.layer_boto3)
 
+        # Windows waiting for analysis, consumed in batches by video_analysis. The visibility timeout follows the
+        # SQS guidance of six times the function timeout, failed windows are made visible again sooner by
+        # video_analysis itself
+        analysis_timeout = Duration.seconds(120)
+        analysis_max_receives = 3
+        self.analysis_dead_letter_queue = sqs.Queue(self, "VideoAnalysisDeadLetterQueue",
+                                                    retention_period=Duration.days(1))
+        self.analysis_queue = sqs.Queue(self, "VideoAnalysisQueue",
+                                        retention_period=Duration.hours(1),
+                                        visibility_timeout=Duration.seconds(analysis_timeout.to_seconds() * 6),
+                                        dead_letter_queue=sqs.DeadLetterQueue(
+                                            max_receive_count=analysis_max_receives,
+                                            queue=self.analysis_dead_letter_queue))
+
         self.video_analysis = lambda_.Function(
             self, "video_analysis",
             runtime=lambda_.Runtime.PYTHON_3_9,
-            code=lambda_.Code.from_asset("../../source/lambda/video_analysis"),
+            code=lambda_.Code.from_asset("../../source/lambda/video_analysis", exclude=["tests"]),
             handler="lambda_function.lambda_handler",
-            timeout=Duration.seconds(60),
+            timeout=analysis_timeout,
             role=self.lambda_role_admin,
-            layers=[self.layer_boto3],
+            layers=[self.layer_boto3, self.layer_runtime_utils],
             environment={
                 "NOTIFY_LAMBDA": self.websocket_notify.function_name,
                 "SUMMARY_LAMBDA": self.video_summary.function_name,
                 "OPS_INGEST_LAMBDA": self.opensearch_ingest.function_name,
                 "RESULT_BUCKET": storage_stack.s3_bucket_information.bucket_name,
                 "RESULT_DYNAMODB": storage_stack.dynamo_result.table_name,
+                "TASK_STATE_DYNAMODB": storage_stack.dynamo_task_state.table_name,
                 "BRC_ENABLE": brc_enable,
+                "RATE_LIMIT_TABLE": storage_stack.dynamo_rate_limit.table_name,
+                "MODEL_RATE_LIMITS": model_rate_limits,
                 "BRC_ENDPOINT": brc_endpoint,
+                "STREAM_RESULT": stream_result,
+                "ANALYSIS_QUEUE_URL": self.analysis_queue.queue_url,
+                "ANALYSIS_MAX_RECEIVES": str(analysis_max_receives),
+                "MODEL_CONCURRENCY": str(analysis_model_concurrency),
+                "ENVIRONMENT_CONCURRENCY": str(analysis_model_concurrency * 2),
             }
         )
+        self.video_analysis.add_event_source(lambda_event_sources.SqsEventSource(
+            self.analysis_queue,
+            batch_size=10,
+            max_batching_window=Duration.seconds(1),
+            report_batch_item_failures=True,
+            max_concurrency=analysis_max_concurrency
+        ))
         self.video_analysis.node.add_dependency(
             storage_stack.dynamo_result, 
+            storage_stack.dynamo_task_state,
             self.websocket_notify, 
             self.video_summary, 
             self.opensearch_ingest,
@@ -367,7 +433,7 @@ class MultiModalVideoAnalyticsLambdaStack(Stack):
         self.frame_extraction = lambda_.Function(
             self, "frame_extraction",
             runtime=lambda_.Runtime.PYTHON_3_9,
-            code=lambda_.Code.from_asset("../../source/lambda/frame_extraction"),
+            code=lambda_.Code.from_asset("../../source/lambda/frame_extraction", exclude=["tests"]),
             handler="lambda_function.lambda_handler",
             timeout=Duration.seconds(900),
             memory_size=1024,
@@ -378,9 +444,16 @@ class MultiModalVideoAnalyticsLambdaStack(Stack):
                 "VIDEO_UPLOAD_BUCKET_NAME": storage_stack.s3_bucket_upload.bucket_name,
                 "VIDEO_INFO_BUCKET_NAME": storage_stack.s3_bucket_information.bucket_name,
                 "VIDEO_ANALYSIS_LAMBDA": self.video_analysis.function_name,
+                "ANALYSIS_QUEUE_URL": self.analysis_queue.queue_url,
+                "TASK_STATE_DYNAMODB": storage_stack.dynamo_task_state.table_name,
             }
         )
-        self.frame_extraction.node.add_dependency(self.layer_ffmpeg, self.video_analysis, storage_stack.s3_bucket_upload, storage_stack.s3_bucket_information)
+        self.frame_extraction.node.add_dependency(self.layer_ffmpeg, self.video_analysis, storage_stack.s3_bucket_upload, storage_stack.s3_bucket_information, storage_stack.dynamo_task_state)
+
+        # Work queue of KVS streams for the shared multi-stream ECS worker (platform 'ecs_shared'). The worker keeps
+        # a stream's message in flight while it polls the stream, so messages live as long as the longest stream
+        self.stream_queue = sqs.Queue(self, "FrameExtractionStreamQueue",
+                                      retention_period=Duration.days(14))
 
         self.configure_video_resource = lambda_.Function(
             self, "configure_video_resource",
@@ -395,10 +468,13 @@ class MultiModalVideoAnalyticsLambdaStack(Stack):
                 "VIDEO_INFO_BUCKET_NAME": storage_stack.s3_bucket_information.bucket_name,
                 "VIDEO_ANALYSIS_LAMBDA": self.video_analysis.function_name,
                 "FRAME_EXTRACTION_LAMBDA": self.frame_extraction.function_name,
-                "FRAME_EXTRACTION_PLATFORM": "lambda"
+                "FRAME_EXTRACTION_PLATFORM": "lambda",
+                "ANALYSIS_QUEUE_URL": self.analysis_queue.queue_url,
+                "STREAM_QUEUE_URL": self.stream_queue.queue_url,
+                "TASK_STATE_DYNAMODB": storage_stack.dynamo_task_state.table_name
             }
         )
-        self.configure_video_resource.node.add_dependency(self.frame_extraction, storage_stack.s3_bucket_information, storage_stack.s3_bucket_upload, storage_stack.s3_bucket_information)
+        self.configure_video_resource.node.add_dependency(self.frame_extraction, storage_stack.s3_bucket_information, storage_stack.s3_bucket_upload, storage_stack.s3_bucket_information, storage_stack.dynamo_task_state)
 
         self.prompt_management_ws = lambda_.Function(
             self, "prompt_management",
@@ -421,13 +497,15 @@ class MultiModalVideoAnalyticsLambdaStack(Stack):
             timeout=Duration.seconds(60),
             memory_size=1024,
             role=self.lambda_role_admin,
-            layers=[self.layer_boto3],
+            layers=[self.layer_boto3, self.layer_runtime_utils],
             environment={
                 "HISTORY_DYNAMODB": storage_stack.dynamo_chat_history.table_name,
                 "RESULT_DYNAMODB": storage_stack.dynamo_result.table_name,
                 "FOLLOW_FRONT": "N",
                 "MODEL_NAME": vqa_model,
                 "BRC_ENABLE": brc_enable,
+                "RATE_LIMIT_TABLE": storage_stack.dynamo_rate_limit.table_name,
+                "MODEL_RATE_LIMITS": model_rate_limits,
                 "BRC_ENDPOINT": brc_endpoint,
             }
         )
@@ -460,7 +538,7 @@ class MultiModalVideoAnalyticsLambdaStack(Stack):
             timeout=Duration.seconds(60),
             memory_size=1024,
             role=self.lambda_role_admin,
-            layers=[self.layer_boto3],
+            layers=[self.layer_boto3, self.layer_runtime_utils],
             environment={
                 "FOLLOW_FRONT": "N",
                 "MODEL_NAME": postprocess_model,
@@ -468,6 +546,8 @@ class MultiModalVideoAnalyticsLambdaStack(Stack):
                 "TOOL_DEVICE_LAMBDA": self.agent_tool_send_device_mqtt.function_name,
                 "TOOL_NOTIFICATION_LAMBDA": self.agent_tool_send_notification.function_name,
                 "BRC_ENABLE": brc_enable,
+                "RATE_LIMIT_TABLE": storage_stack.dynamo_rate_limit.table_name,
+                "MODEL_RATE_LIMITS": model_rate_limits,
                 "BRC_ENDPOINT": brc_endpoint,
             }
         )
@@ -480,7 +560,7 @@ class MultiModalVideoAnalyticsLambdaStack(Stack):
             handler="lambda_function.lambda_handler",
             timeout=Duration.seconds(60),
             role=self.lambda_role_admin,
-            layers=[self.layer_opensearch],
+            layers=[self.layer_opensearch, self.layer_runtime_utils],
             environment={
                 "RESULT_DYNAMODB": storage_stack.dynamo_result.table_name,
                 "OPENSEARCH_ENDPOINT": storage_stack.search_domain_endpoint,
@@ -515,7 +595,7 @@ class MultiModalVideoAnalyticsLambdaStack(Stack):
         )
         
 class MultiModalVideoAnalyticsECSStack(Stack):
-    def __init__(self, scope: Construct, id: str, **kwargs) -> None:
+    def __init__(self, scope: Construct, id: str, lambda_stack: MultiModalVideoAnalyticsLambdaStack, **kwargs) -> None:
         super().__init__(scope, id, **kwargs)
 
         # 1. Create docker repo
@@ -523,8 +603,15 @@ class MultiModalVideoAnalyticsECSStack(Stack):
                              repository_name="frame_extraction")
 
         # 2. use DockerImageAsset to create Docker image
+        # built from the repository root so the image shares extraction_utils.py with the frame_extraction Lambda
         docker_image = ecr_assets.DockerImageAsset(self, "FrameExtractionImage",
-                                                   directory="../modules/ecs/frame_extraction")
+                                                   directory="../..",
+                                                   file="deployment/modules/ecs/frame_extraction/Dockerfile",
+                                                   ignore_mode=IgnoreMode.DOCKER,
+                                                   exclude=["**",
+                                                            "!deployment/modules/ecs/frame_extraction",
+                                                            "deployment/modules/ecs/frame_extraction/tests",
+                                                            "!source/lambda/frame_extraction/extraction_utils.py"])
 
         # 3. Deploy Docker image to private ECR
         ecr_deployment = ECRDeployment(self, "DeployFrameExtractionImage",
@@ -542,7 +629,9 @@ class MultiModalVideoAnalyticsECSStack(Stack):
                               managed_policies=[
                                   iam.ManagedPolicy.from_aws_managed_policy_name("AmazonS3FullAccess"),
                                   iam.ManagedPolicy.from_aws_managed_policy_name("AWSLambda_FullAccess"),
-                                  iam.ManagedPolicy.from_aws_managed_policy_name("AmazonKinesisVideoStreamsFullAccess")
+                                  iam.ManagedPolicy.from_aws_managed_policy_name("AmazonKinesisVideoStreamsFullAccess"),
+                                  iam.ManagedPolicy.from_aws_managed_policy_name("AmazonSQSFullAccess"),
+                                  iam.ManagedPolicy.from_aws_managed_policy_name("AmazonDynamoDBFullAccess")
                               ])
         
         # 6. Create ECS Task Definition
@@ -566,6 +655,59 @@ class MultiModalVideoAnalyticsECSStack(Stack):
         # 8. Define port mapping
         container.add_port_mappings(ecs.PortMapping(container_port=80, host_port=80, protocol=ecs.Protocol.TCP))
 
+        # 9. Long running worker polling many KVS streams from one task
+        worker_task_definition = ecs.FargateTaskDefinition(self, "FrameExtractionWorkerTaskDefinition",
+                                                           family="frame-extraction-worker",
+                                                           task_role=task_execution_role,
+                                                           execution_role=task_execution_role,
+                                                           memory_limit_mib=4096,
+                                                           cpu=2048)
+        worker_task_definition.add_container("frame_extraction_worker",
+                                             image=ecs.ContainerImage.from_ecr_repository(repo, "latest"),
+                                             command=["python", "stream_worker.py"],
+                                             # time to hand the streams back to the queue after SIGTERM
+                                             stop_timeout=Duration.seconds(60),
+                                             environment={
+                                                 "stream_queue_url": lambda_stack.stream_queue.queue_url,
+                                                 "max_streams": "50",
+                                                 "max_inflight_cycles": "16"
+                                             },
+                                             logging=ecs.LogDriver.aws_logs(
+                                                 stream_prefix="ecs",
+                                                 log_group=logs.LogGroup(self, "FrameExtractionWorkerLogGroup",
+                                                                         log_group_name="/ecs/frame-extraction-worker",
+                                                                         removal_policy=RemovalPolicy.DESTROY)
+                                             ))
+        worker_service = ecs.FargateService(self, "FrameExtractionWorkerService",
+                                            cluster=cluster,
+                                            task_definition=worker_task_definition,
+                                            desired_count=0)
+        worker_service.node.add_dependency(ecr_deployment)
+
+        # 10. Scale the workers on the streams queued or being polled, one task per max_streams streams.
+        # Workers hold a stream's message in flight while polling it, and a worker stopped by scale-in hands its
+        # streams back to the queue
+        stream_count = cloudwatch.MathExpression(
+            expression="visible + polled",
+            using_metrics={
+                "visible": lambda_stack.stream_queue.metric_approximate_number_of_messages_visible(period=Duration.minutes(1)),
+                "polled": lambda_stack.stream_queue.metric_approximate_number_of_messages_not_visible(period=Duration.minutes(1))
+            },
+            period=Duration.minutes(1)
+        )
+        worker_scaling = worker_service.auto_scale_task_count(min_capacity=0, max_capacity=10)
+        worker_scaling.scale_on_metric("StreamCountScaling",
+                                       metric=stream_count,
+                                       scaling_steps=[
+                                           appscaling.ScalingInterval(upper=1, change=0),
+                                           appscaling.ScalingInterval(lower=1, upper=51, change=1),
+                                           appscaling.ScalingInterval(lower=51, upper=101, change=2),
+                                           appscaling.ScalingInterval(lower=101, upper=201, change=4),
+                                           appscaling.ScalingInterval(lower=201, change=10)
+                                       ],
+                                       adjustment_type=appscaling.AdjustmentType.EXACT_CAPACITY,
+                                       cooldown=Duration.minutes(5))
+
 class MultiModalVideoAnalyticsAPIStack(Stack):
     def __init__(self, scope: Construct, construct_id: str, lambda_stack: MultiModalVideoAnalyticsLambdaStack, storage_stack: MultiModalVideoAnalyticsStorageStack, **kwargs) -> None:
         super().__init__(scope, construct_id, **kwargs)
@@ -1,42 +1,41 @@
 import os
-import json
 import boto3
-import time
 import math
-import base64
 import ffmpeg
 import logging
 import shutil
 from datetime import datetime, timedelta
+from botocore.config import Config
+from extraction_utils import (ANALYSIS_TASK_FIELDS, FrameUploader, adaptive_windows, build_analysis_request,
+                              build_end_request, decode_settings, deliver_window, encode_settings,
+                              fetch_kvs_clip_frames, fetch_kvs_frames, frame_hashes, kvs_schedule, load_checkpoint,
+                              parallel_windows, plan_image_size, prepare_window, resolve_video_input, save_checkpoint,
+                              seek_windows, send_analysis_request, stream_windows, trim_windows)
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-s3 = boto3.client('s3')
+s3 = boto3.client('s3', config=Config(max_pool_connections=20))
 lambda_client = boto3.client('lambda')
+sqs = boto3.client('sqs')
 kinesisvideo = boto3.client('kinesisvideo')
+dynamodb = boto3.resource('dynamodb')
+
+# 共享的传输管理器, 并发上传一个窗口的所有帧
+uploader = FrameUploader(s3, max_concurrency=20)
 
 def main():
     logger.info('frame_extraction started')
 
-    # 设置 FFmpeg 和 FFprobe 的路径
-    ffmpeg_binary_path = '/usr/bin/ffmpeg'
-    ffprobe_binary_path = '/usr/bin/ffprobe'
+    # 镜像中 apt 安装的 FFmpeg 和 FFprobe 已在 PATH 中, 直接执行, 无需复制
+    for binary in ('ffmpeg', 'ffprobe'):
+        if shutil.which(binary) is None:
+            raise RuntimeError(f'{binary} not found in PATH')
 
     # 创建临时目录
     tmp_dir = '/tmp'
     os.makedirs(tmp_dir, exist_ok=True)
 
-    # 复制 FFmpeg 和 FFprobe 到可写目录
-    shutil.copy(ffmpeg_binary_path, os.path.join(tmp_dir, 'ffmpeg'))
-    shutil.copy(ffprobe_binary_path, os.path.join(tmp_dir, 'ffprobe'))
-    os.chmod(os.path.join(tmp_dir, 'ffmpeg'), 0o755)
-    os.chmod(os.path.join(tmp_dir, 'ffprobe'), 0o755)
-
-    # 更新环境变量 PATH
-    current_path = os.environ.get('PATH', '')
-    os.environ['PATH'] = tmp_dir + os.pathsep + current_path
-
     # 从环境变量中提取参数
     connection_id = os.environ.get('connection_id')
     video_analysis_lambda = os.environ.get('video_analysis_lambda')
@@ -50,208 +49,257 @@ def main():
     interval = float(os.environ.get('interval'))
     duration = int(os.environ.get('duration'))
     image_size = os.environ.get('image_size')
-    system_prompt = os.environ.get('system_prompt')
-    user_prompt = os.environ.get('user_prompt')
+    extraction_engine = os.environ.get('extraction_engine', 'stream')
+    seek_accuracy = os.environ.get('seek_accuracy', 'exact')
+    extraction_workers = int(os.environ.get('extraction_workers', 0))
+    input_mode = os.environ.get('input_mode', 'url')
+    frame_delivery = os.environ.get('frame_delivery', 'direct')
+    archive_frames = os.environ.get('archive_frames', 'Y') == 'Y'
+    sampling_mode = os.environ.get('sampling_mode', 'fixed')
+    scene_threshold = float(os.environ.get('scene_threshold', 0.08))
+    min_interval = float(os.environ.get('min_interval', interval))
+    max_interval = float(os.environ.get('max_interval', 60))
+    dedup_threshold = int(os.environ.get('dedup_threshold', -1))
+    kvs_engine = os.environ.get('kvs_engine', 'images')
+    decode_profile = os.environ.get('decode_profile', 'default')
+    frame_mosaic = os.environ.get('frame_mosaic', 'N') == 'Y'
+    frame_format = os.environ.get('frame_format', 'jpeg')
+    frame_quality = os.environ.get('frame_quality', 'auto')
+    # 由 configure_video_resource 生成, 重新运行同一 task_id 时从检查点继续
+    task_id = os.environ.get('task_id')
+    task_state_table = os.environ.get('task_state_table')
     model_id = os.environ.get('model_id')
-    temperature = float(os.environ.get('temperature'))
-    top_p = float(os.environ.get('top_p'))
-    top_k = int(os.environ.get('top_k'))
-    max_tokens = int(os.environ.get('max_tokens'))
+    # 提示词和模型参数原样写入每个窗口的分析请求
+    task = {name: os.environ.get(name) for name in ANALYSIS_TASK_FIELDS}
 
     logger.info('Parameters: connection_id={}, video_analysis_lambda={}, user_id={}, video_source_type={}, video_source_content={}'.format(
         connection_id, video_analysis_lambda, user_id, video_source_type, video_source_content))
 
     # KVS 帧提取
     if video_source_type == 'kvs':
-        extract_frames_from_kvs(tmp_dir, frequency, list_length, interval, duration, image_size,
-                                 video_source_content, video_info_bucket_name, user_id,
-                                 video_analysis_lambda, system_prompt, user_prompt, model_id,
-                                 temperature, top_p, top_k, max_tokens, connection_id, video_source_type)
+        extract_frames_from_kvs(tmp_dir=tmp_dir, frequency=frequency, list_length=list_length, interval=interval,
+                                duration=duration, image_size=image_size, video_source_content=video_source_content,
+                                video_info_bucket_name=video_info_bucket_name, user_id=user_id,
+                                video_analysis_lambda=video_analysis_lambda, model_id=model_id, task=task,
+                                video_source_type=video_source_type, frame_delivery=frame_delivery,
+                                archive_frames=archive_frames, dedup_threshold=dedup_threshold,
+                                kvs_engine=kvs_engine, task_id=task_id, task_state_table=task_state_table,
+                                frame_format=frame_format,
+                                frame_quality=frame_quality, frame_mosaic=frame_mosaic)
 
     # S3 帧提取
     elif video_source_type == 's3':
-        extract_frames_from_s3(tmp_dir, video_upload_bucket_name, video_source_content,
-                           video_info_bucket_name, user_id, frequency, list_length,
-                           interval, duration, image_size, video_analysis_lambda,
-                           system_prompt, user_prompt, model_id, temperature, top_p,
-                           top_k, max_tokens, connection_id, video_source_type)
+        extract_frames_from_s3(tmp_dir=tmp_dir, video_upload_bucket_name=video_upload_bucket_name,
+                               video_source_content=video_source_content,
+                               video_info_bucket_name=video_info_bucket_name, user_id=user_id, frequency=frequency,
+                               list_length=list_length, interval=interval, duration=duration, image_size=image_size,
+                               video_analysis_lambda=video_analysis_lambda, model_id=model_id, task=task,
+                               video_source_type=video_source_type, extraction_engine=extraction_engine,
+                               seek_accuracy=seek_accuracy, extraction_workers=extraction_workers,
+                               input_mode=input_mode, frame_delivery=frame_delivery, archive_frames=archive_frames,
+                               sampling_mode=sampling_mode, scene_threshold=scene_threshold,
+                               min_interval=min_interval, max_interval=max_interval,
+                               dedup_threshold=dedup_threshold, task_id=task_id, task_state_table=task_state_table,
+                               decode_profile=decode_profile, frame_format=frame_format,
+                               frame_quality=frame_quality, frame_mosaic=frame_mosaic)
 
 def extract_frames_from_kvs(tmp_dir, frequency, list_length, interval, duration, image_size,
                             video_source_content, video_info_bucket_name, user_id,
-                            video_analysis_lambda, system_prompt, user_prompt, model_id,
-                            temperature, top_p, top_k, max_tokens, connection_id, video_source_type):
+                            video_analysis_lambda, model_id, task, video_source_type,
+                            frame_delivery='direct', archive_frames=True, dedup_threshold=-1, kvs_engine='images',
+                            task_id=None, task_state_table=None, frame_format='jpeg', frame_quality='auto',
+                            frame_mosaic=False):
 
     task_timestamp = datetime.now().strftime('%Y-%m-%d-%H%M%S')
+    task_id = task_id or f'task_{task_timestamp}'
     cycle_limit = int(duration / frequency)
-    cycle_count = 0
-    gap_time = list_length * interval + 4
+    state_table = dynamodb.Table(task_state_table) if task_state_table else None
+
+    # 'images' 由 KVS 用 GetImages 编码 JPEG, 'clip' 下载 GetClip 媒体后在本地解码
+    fetch_frames = fetch_kvs_clip_frames if kvs_engine == 'clip' else fetch_kvs_frames
+    # 'auto' 按模型选择帧尺寸, 不探测流时只规划宽度
+    image_size, image_tokens = plan_image_size(image_size, model_id)
+    logger.info(f'Frame size {image_size}, about {image_tokens * list_length} image tokens per window')
+    # GetImages 只返回 JPEG, frame_format 只作用于本地解码的帧
+    encode = encode_settings(frame_format if kvs_engine == 'clip' else 'jpeg', frame_quality, model_id,
+                             list_length, image_size)
 
     # 获取 KVS 信息
     kvs_endpoint = kinesisvideo.get_data_endpoint(
         StreamName=video_source_content,
-        APIName='GET_IMAGES'
+        APIName='GET_CLIP' if kvs_engine == 'clip' else 'GET_IMAGES'
     ).get('DataEndpoint')
 
     kinesis_video_archived_media = boto3.client('kinesis-video-archived-media', endpoint_url=kvs_endpoint)
 
     try:
-        while cycle_count < cycle_limit:
-            timestamp = datetime.now().strftime('%Y-%m-%d-%H%M%S')
-            end_time = datetime.now()
-            start_time = end_time - timedelta(seconds=gap_time)
-
-            if image_size != 'raw':
-                width, height = image_size.split('*')
-                frame_response = kinesis_video_archived_media.get_images(
-                    StreamName=video_source_content,
-                    ImageSelectorType='SERVER_TIMESTAMP',
-                    SamplingInterval=int(interval * 1000),
-                    StartTimestamp=start_time,
-                    EndTimestamp=end_time,
-                    Format='JPEG',
-                    WidthPixels=int(width),
-                    HeightPixels=int(height)
-                )
-            else:
-                frame_response = kinesis_video_archived_media.get_images(
-                    StreamName=video_source_content,
-                    ImageSelectorType='SERVER_TIMESTAMP',
-                    SamplingInterval=int(interval * 1000),
-                    StartTimestamp=start_time,
-                    EndTimestamp=end_time,
-                    Format='JPEG'
-                )
-
-            image_contents_raw = [image['ImageContent'] for image in frame_response['Images'] if 'ImageContent' in image]
-            image_files_raw = image_contents_raw[-1 * list_length:]
-
-            for index, image_file_raw in enumerate(image_files_raw):
-                with open(os.path.join(tmp_dir, f'{timestamp}_{index}.jpg'), "wb") as image_file:
-                    image_file.write(base64.decodebytes(bytes(image_file_raw, 'utf-8')))
-
-            image_files = [f for f in os.listdir(tmp_dir) if f.endswith('.jpg')]
-            task_id = f'task_{task_timestamp}'
-            image_folder = f'{video_source_type}_extract_{timestamp}_{start_time}'
+        # 固定节奏运行, 每轮的耗时不会推迟后续轮次; 游标之前的帧不会被重复获取
+        cursor = None
+        for cycle_count, end_time in kvs_schedule(frequency, cycle_limit):
+            start_time = end_time - timedelta(seconds=list_length * interval)
+            if cursor is not None and cursor > start_time:
+                start_time = cursor
+
+            # 只请求窗口所需的 list_length 帧, 分页获取并逐帧解码
+            frames = []
+            frame_times = []
+            for frame_timestamp, frame in fetch_frames(kinesis_video_archived_media, video_source_content,
+                                                       start_time, end_time, interval, list_length, image_size,
+                                                       encode):
+                frames.append(frame)
+                frame_times.append(frame_timestamp)
+                cursor = frame_timestamp + timedelta(milliseconds=1)
+            # 可选: 推理前把窗口内的帧拼成带时间标签的网格图
+            frames, frame_times, window_fields = prepare_window(frames, frame_times, frame_mosaic, model_id,
+                                                                image_size, encode)
+            # 感知哈希, video_analysis 据此复用相似窗口的分析结果
+            hashes = frame_hashes(frames, encode) if dedup_threshold >= 0 and frames else None
+
+            # 对象键只由任务和窗口决定, 重试时覆盖而不是新增
+            image_folder = f'{video_source_type}_extract_{start_time:%Y-%m-%d %H:%M:%S.%f}'
             image_path = f'{user_id}/{task_id}/{image_folder}'
+            delivery_fields, upload_futures = deliver_window(uploader, frames, video_info_bucket_name, image_path,
+                                                             frame_delivery, archive_frames, encode, frame_times,
+                                                             hashes)
+            uploader.wait(upload_futures)
 
-            for image_file in image_files:
-                file_path = os.path.join(tmp_dir, image_file)
-                object_key = f'{image_path}/{image_file}'
-                s3.upload_file(file_path, video_info_bucket_name, object_key)
-                logger.info(f'Successfully uploaded {image_file} to {video_info_bucket_name}/{object_key}')
-
-            for image_file in image_files:
-                os.remove(os.path.join(tmp_dir, image_file))
-
-            analysis_request = {
-                'system_prompt': system_prompt,
-                'user_prompt': user_prompt,
-                'model_id': model_id,
-                'temperature': temperature,
-                'top_p': top_p,
-                'top_k': top_k,
-                'max_tokens': max_tokens,
-                'image_path': image_path,
-                'start_time': start_time.strftime('%Y-%m-%d-%H:%M:%S'),
-                'user_id': user_id,
-                'task_id': task_id,
-                'video_source_type': video_source_type,
-                'video_source_content': video_source_content,
-                'connection_id': connection_id
-            }
-
-            cycle_count += 1
-            if cycle_count >= cycle_limit:
-                analysis_request.update({'tag': 'end'})
+            analysis_request = build_analysis_request(
+                dict(task, task_id=task_id), image_path, start_time, window_fields, delivery_fields, hashes,
+                dedup_threshold, tag='end' if cycle_count == cycle_limit - 1 else None)
 
             logger.info(f'Analysis request: {analysis_request}')
-            lambda_client.invoke(
-                FunctionName=video_analysis_lambda,
-                InvocationType='Event',
-                Payload=bytes(json.dumps(analysis_request), encoding='utf-8')
-            )
-
-            time.sleep(frequency)
+            send_analysis_request(lambda_client, sqs, video_analysis_lambda, analysis_request,
+                                  state_table=state_table)
 
     except Exception:
         logger.exception('Exception during KVS frame extraction')
 
 def extract_frames_from_s3(tmp_dir, video_upload_bucket_name, video_source_content,
                            video_info_bucket_name, user_id, frequency, list_length,
-                           interval, duration, image_size, video_analysis_lambda,
-                           system_prompt, user_prompt, model_id, temperature, top_p,
-                           top_k, max_tokens, connection_id, video_source_type):
-
-    s3.download_file(video_upload_bucket_name, video_source_content, '/tmp/video.mp4')
-    original_stream = ffmpeg.input('/tmp/video.mp4')
+                           interval, duration, image_size, video_analysis_lambda, model_id, task, video_source_type,
+                           extraction_engine='stream', seek_accuracy='exact', extraction_workers=0,
+                           input_mode='url', frame_delivery='direct', archive_frames=True,
+                           sampling_mode='fixed', scene_threshold=0.08, min_interval=1.0, max_interval=60.0,
+                           dedup_threshold=-1, task_id=None, task_state_table=None, decode_profile='default',
+                           frame_format='jpeg', frame_quality='auto', frame_mosaic=False):
 
+    task_timestamp = datetime.now().strftime('%Y-%m-%d-%H%M%S')
+    task_id = task_id or f'task_{task_timestamp}'
+    state_table = dynamodb.Table(task_state_table) if task_state_table else None
+    # 提取循环留下的最后一个窗口, 在 finally 中发送并结束任务
+    pending = None
+    completed = False
     try:
-        probe = ffmpeg.probe('/tmp/video.mp4')
+        # 默认通过预签名 URL 流式读取, 批处理任务可能运行数小时, URL 有效期设为 6 小时
+        video_path = resolve_video_input(s3, video_upload_bucket_name, video_source_content, input_mode,
+                                         expires_in=6 * 3600)
+        probe = ffmpeg.probe(video_path)
         original_stream_duration = math.floor(float(probe['format']['duration']))
-        task_timestamp = datetime.now().strftime('%Y-%m-%d-%H%M%S')
-        start_time = 0
-
-        while start_time < duration and start_time < original_stream_duration:
-            start_time_trim = start_time
-            end_time_trim = start_time + list_length * interval
-
-            stream = ffmpeg.trim(original_stream, start=start_time_trim, end=end_time_trim)
-
-            if image_size != 'raw':
-                width, height = image_size.split('*')
-                stream = ffmpeg.filter(stream, 'scale', w=width, h=height)
-
-            stream = ffmpeg.filter(stream, 'fps', f'1/{interval}')
-            timestamp = datetime.now().strftime('%Y-%m-%d-%H%M%S')
-            stream = ffmpeg.output(stream, os.path.join(tmp_dir, f'{timestamp}_%02d.jpg'), vsync='vfr', qscale=2, f='image2')
-
-            ffmpeg.run(stream, overwrite_output=True)
-
-            image_files = [f for f in os.listdir(tmp_dir) if f.endswith('.jpg')]
-            task_id = f'task_{task_timestamp}'
-            image_folder = f'{video_source_type}_extract_{timestamp}_{start_time}'
+        limit = min(duration, original_stream_duration)
+
+        # 从上次运行已分发的最后一个窗口之后继续
+        begin = 0
+        checkpoint = load_checkpoint(state_table, task_id) if state_table else None
+        if checkpoint:
+            logger.info(f'Resuming task {task_id} at {checkpoint}s')
+            begin = checkpoint
+        # 解码调优: 线程, 仅关键帧, 低分辨率解码
+        # 'auto' 按源视频宽高比和模型计费方式选择帧尺寸
+        image_size, image_tokens = plan_image_size(image_size, model_id, probe)
+        logger.info(f'Frame size {image_size}, about {image_tokens * list_length} image tokens per window')
+        decode = decode_settings(decode_profile, probe, image_size)
+        # 输出格式和质量, 'auto' 按模型的窗口大小预算选择质量
+        encode = encode_settings(frame_format, frame_quality, model_id, list_length, image_size, probe)
+
+        # 'scene' 采样按画面变化而不是固定间隔取帧,
+        # 'stream' 单次解码整个视频, 'seek' 每个窗口在输入端 seek, 'parallel' 多个 worker 并发 seek,
+        # 'trim' 每个窗口运行一次 ffmpeg trim
+        if sampling_mode == 'scene':
+            windows = adaptive_windows(video_path, frequency, list_length, limit, image_size, scene_threshold,
+                                       min_interval, max_interval, begin=begin, decode=decode, encode=encode)
+        elif extraction_engine == 'trim':
+            windows = trim_windows(video_path, tmp_dir, frequency, list_length, interval, limit, image_size,
+                                   begin=begin, decode=decode, encode=encode)
+        elif extraction_engine == 'seek':
+            windows = seek_windows(video_path, frequency, list_length, interval, limit, image_size,
+                                   seek_accuracy, begin=begin, decode=decode, encode=encode)
+        elif extraction_engine == 'parallel':
+            # 窗口并发提取, 但仍按时间顺序返回, 最后一个窗口带 end 标记
+            windows = parallel_windows(video_path, frequency, list_length, interval, limit, image_size,
+                                       seek_accuracy, extraction_workers, begin=begin, decode=decode,
+                                       encode=encode)
+        else:
+            windows = stream_windows(video_path, frequency, list_length, interval, limit, image_size,
+                                     begin=begin, decode=decode, encode=encode)
+
+        for start_time, frames in windows:
+            # 可选: 推理前拼图; scene 采样没有固定的帧时间, 按序号标注
+            frame_times = None if sampling_mode == 'scene' else [start_time + index * interval
+                                                                 for index in range(len(frames))]
+            frames, frame_times, window_fields = prepare_window(frames, frame_times, frame_mosaic, model_id,
+                                                                image_size, encode, probe)
+            # 感知哈希, video_analysis 据此复用相似窗口的分析结果
+            hashes = frame_hashes(frames, encode) if dedup_threshold >= 0 and frames else None
+
+            # 对象键只由任务和窗口决定, 从检查点继续时覆盖而不是新增
+            image_folder = f'{video_source_type}_extract_{start_time}'
             image_path = f'{user_id}/{task_id}/{image_folder}'
+            # 后台上传, 与下一个窗口的解码重叠
+            delivery_fields, upload_futures = deliver_window(uploader, frames, video_info_bucket_name, image_path,
+                                                             frame_delivery, archive_frames, encode, frame_times,
+                                                             hashes)
 
-            for image_file in image_files:
-                file_path = os.path.join(tmp_dir, image_file)
-                object_key = f'{image_path}/{image_file}'
-                s3.upload_file(file_path, video_info_bucket_name, object_key)
-                logger.info(f'Successfully uploaded {image_file} to {video_info_bucket_name}/{object_key}')
-
-            for image_file in image_files:
-                os.remove(os.path.join(tmp_dir, image_file))
-
-            analysis_request = {
-                'system_prompt': system_prompt,
-                'user_prompt': user_prompt,
-                'model_id': model_id,
-                'temperature': temperature,
-                'top_p': top_p,
-                'top_k': top_k,
-                'max_tokens': max_tokens,
-                'image_path': image_path,
-                'start_time': start_time,
-                'user_id': user_id,
-                'task_id': task_id,
-                'video_source_type': video_source_type,
-                'video_source_content': video_source_content,
-                'connection_id': connection_id
-            }
-
-            start_time += frequency
-
-            if start_time >= duration or start_time >= original_stream_duration:
-                analysis_request.update({'tag': 'end'})
+            analysis_request = build_analysis_request(dict(task, task_id=task_id), image_path, start_time,
+                                                      window_fields, delivery_fields, hashes, dedup_threshold)
 
-            logger.info(f'Analysis request: {analysis_request}')
-            lambda_client.invoke(
-                FunctionName=video_analysis_lambda,
-                InvocationType='Event',
-                Payload=bytes(json.dumps(analysis_request), encoding='utf-8')
-            )
+            # 上一个窗口的帧上传完成后再调用分析
+            if pending is not None:
+                dispatch_analysis(video_analysis_lambda, *pending, state_table=state_table)
+                if state_table:
+                    save_checkpoint(state_table, task_id, start_time)
+            pending = (analysis_request, upload_futures)
+
+        completed = True
 
     except Exception:
         logger.exception('Exception during S3 frame extraction')
+    finally:
+        # 提取中途失败时也结束任务, 否则已登记的窗口永远等不到 end, 任务不会被总结
+        try:
+            finish_extraction(video_analysis_lambda, dict(task, task_id=task_id), pending, state_table)
+            if completed and state_table:
+                save_checkpoint(state_table, task_id, limit)
+        except Exception:
+            logger.exception('Failed to close the S3 frame extraction task')
+
+def finish_extraction(video_analysis_lambda, task, pending, state_table=None):
+    """
+    发送提取循环留下的最后一个窗口并结束任务
+    最后一个窗口带 end 标记, scene 采样会跳过无变化的窗口, 所以不一定是 limit 处的窗口;
+    没有留下窗口或它发送失败时, 发送只带 end 标记的请求
+    :param pending: (analysis request, upload futures), 没有窗口时为 None
+    """
+    if pending is not None:
+        pending[0]['tag'] = 'end'
+        try:
+            dispatch_analysis(video_analysis_lambda, *pending, state_table=state_table)
+            return
+        except Exception:
+            logger.exception('Failed to dispatch the last window')
+    logger.info(f"Closing task {task['task_id']} with an end-only request")
+    send_analysis_request(lambda_client, sqs, video_analysis_lambda, build_end_request(task))
+
+def dispatch_analysis(video_analysis_lambda, analysis_request, upload_futures, state_table=None):
+    """
+    等待窗口的帧上传到 S3, 然后调用分析 Lambda
+    :param state_table: 任务状态表, 发送后在其中登记窗口, video_analysis 等登记的窗口都处理完再总结
+    """
+    uploader.wait(upload_futures)
+    logger.info(f'Analysis request: {analysis_request}')
+    send_analysis_request(lambda_client, sqs, video_analysis_lambda, analysis_request, state_table=state_table)
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    finally:
+        uploader.shutdown()
@@ -0,0 +1,376 @@
+import os
+import json
+import time
+import boto3
+import signal
+import socket
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from extraction_utils import (KVS_INGEST_DELAY, FrameUploader, build_analysis_request, deliver_window, encode_settings,
+                              fetch_kvs_clip_frames, fetch_kvs_frames, frame_hashes, plan_image_size, prepare_window,
+                              send_analysis_request)
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# 单个 worker 同时轮询的 KVS 流数量上限, 达到上限后不再从队列领取新的流
+MAX_STREAMS = int(os.environ.get('max_streams', 50))
+# 同时执行的取帧/上传/调用轮次上限, 所有流共享
+MAX_INFLIGHT_CYCLES = int(os.environ.get('max_inflight_cycles', 16))
+# 流的租约时长, 持有者每隔三分之一租约续期一次; worker 异常退出后其他 worker 最迟在一个租约后接手
+STREAM_LEASE_SECONDS = int(os.environ.get('stream_lease_seconds', 300))
+WORKER_ID = f'{socket.gethostname()}-{os.getpid()}'
+# 轮询失败的流在这么多秒后重新投递
+STREAM_RETRY_DELAY = int(os.environ.get('stream_retry_delay', 30))
+# 获取 KVS 端点的尝试次数, 避免一次限流就让流失败
+ENDPOINT_ATTEMPTS = 3
+
+sqs = boto3.client('sqs')
+s3 = boto3.client('s3', config=Config(max_pool_connections=MAX_INFLIGHT_CYCLES * 4))
+lambda_client = boto3.client('lambda')
+kinesisvideo = boto3.client('kinesisvideo')
+dynamodb = boto3.resource('dynamodb')
+
+# 所有流共享的传输管理器
+uploader = FrameUploader(s3, max_concurrency=MAX_INFLIGHT_CYCLES * 4)
+
+
+def extract_window(archived_media_client, request, start_time, end_time, tag=None):
+    """
+    取一个窗口的帧, 上传并调用分析 Lambda, 在线程池中运行
+    :param request: 工作队列中的流配置, 字段与帧提取 Lambda 的请求相同
+    :return: 最后一帧的服务端时间戳, 没有帧时为 None
+    """
+    list_length = int(request['list_length'])
+    interval = float(request['interval'])
+    dedup_threshold = int(request.get('dedup_threshold', -1))
+    clip = request.get('kvs_engine') == 'clip'
+    image_size = plan_image_size(request['image_size'], request['model_id'])[0]
+    fetch_frames = fetch_kvs_clip_frames if clip else fetch_kvs_frames
+    # GetImages 只返回 JPEG
+    encode = encode_settings(request.get('frame_format', 'jpeg') if clip else 'jpeg',
+                             request.get('frame_quality', 'auto'), request['model_id'], list_length,
+                             image_size)
+
+    frames = []
+    frame_times = []
+    last_timestamp = None
+    for last_timestamp, frame in fetch_frames(archived_media_client, request['video_source_content'],
+                                              start_time, end_time, interval, list_length, image_size,
+                                              encode):
+        frames.append(frame)
+        frame_times.append(last_timestamp)
+    frames, frame_times, window_fields = prepare_window(frames, frame_times, request.get('frame_mosaic', 'N') == 'Y',
+                                                        request['model_id'], image_size, encode)
+    hashes = frame_hashes(frames, encode) if dedup_threshold >= 0 and frames else None
+
+    # 对象键只由任务和窗口决定
+    image_folder = f'kvs_extract_{start_time:%Y-%m-%d %H:%M:%S.%f}'
+    image_path = f"{request['user_id']}/{request['task_id']}/{image_folder}"
+    delivery_fields, upload_futures = deliver_window(uploader, frames, request['video_info_bucket_name'],
+                                                     image_path, request.get('frame_delivery', 'direct'),
+                                                     request.get('archive_frames', 'Y') == 'Y', encode, frame_times,
+                                                     hashes)
+    uploader.wait(upload_futures)
+
+    analysis_request = build_analysis_request(dict(request, video_source_type='kvs'), image_path, start_time,
+                                              window_fields, delivery_fields, hashes, dedup_threshold, tag)
+
+    logger.info(f'Analysis request: {analysis_request}')
+    state_table = dynamodb.Table(request['task_state_table']) if request.get('task_state_table') else None
+    send_analysis_request(lambda_client, sqs, request['video_analysis_lambda'], analysis_request,
+                          request.get('analysis_queue_url'), state_table)
+    return last_timestamp
+
+
+def claim_stream(table, task_id):
+    """
+    领取或续期流的租约, 租约记在任务状态表中, 与 SQS 消息一起保证流在 worker 退出后由其他 worker 接手
+    :return: 流的第一个窗口的结束时间, 接手的 worker 沿用它以保持原来的节奏和总时长;
+             流已结束时返回 False, 其他 worker 持有未过期的租约时返回 None
+    """
+    now = int(time.time())
+    try:
+        item = table.update_item(
+            Key={'task_id': task_id, 'state_key': 'stream'},
+            UpdateExpression='SET lease_owner = :owner, lease_until = :until, first_end = if_not_exists(first_end, :first_end)',
+            ConditionExpression='attribute_not_exists(finished) AND '
+                                '(attribute_not_exists(lease_owner) OR lease_owner = :owner OR lease_until < :now)',
+            ExpressionAttributeValues={
+                ':owner': WORKER_ID,
+                ':until': now + STREAM_LEASE_SECONDS,
+                ':now': now,
+                ':first_end': (datetime.now(timezone.utc) - timedelta(seconds=KVS_INGEST_DELAY)).isoformat()
+            },
+            ReturnValues='ALL_NEW'
+        )['Attributes']
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        item = table.get_item(Key={'task_id': task_id, 'state_key': 'stream'}).get('Item', {})
+        return False if item.get('finished') else None
+    return datetime.fromisoformat(item['first_end'])
+
+
+def release_stream(table, task_id, finished=False):
+    """
+    交还租约; finished 为 True 时把流标记为结束, 持有者下次续期失败后停止轮询, 队列中残留的消息也不会再启动它
+    """
+    if finished:
+        # 只标记已经被领取过的流
+        try:
+            table.update_item(
+                Key={'task_id': task_id, 'state_key': 'stream'},
+                UpdateExpression='SET finished = :true',
+                ConditionExpression='attribute_exists(first_end)',
+                ExpressionAttributeValues={':true': True}
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+    else:
+        table.update_item(
+            Key={'task_id': task_id, 'state_key': 'stream'},
+            UpdateExpression='SET lease_until = :zero',
+            ConditionExpression='lease_owner = :owner',
+            ExpressionAttributeValues={':zero': 0, ':owner': WORKER_ID}
+        )
+
+
+async def poll_stream(request, inflight, first_end):
+    """
+    按流自己的 frequency 固定节奏轮询一个 KVS 流, 直到 duration 结束
+    落后超过一个周期时丢弃错过的轮次, 而不是连续补跑, 避免慢流拖住共享的线程池
+    :param first_end: 第一个窗口的结束时间, 接手其他 worker 的流时已经过去的轮次会被丢弃
+    """
+    stream_name = request['video_source_content']
+    frequency = int(request['frequency'])
+    cycle_limit = int(int(request['duration']) / frequency)
+    window_span = timedelta(seconds=int(request['list_length']) * float(request['interval']))
+
+    api_name = 'GET_CLIP' if request.get('kvs_engine') == 'clip' else 'GET_IMAGES'
+    for attempt in range(ENDPOINT_ATTEMPTS):
+        try:
+            kvs_endpoint = (await asyncio.to_thread(
+                kinesisvideo.get_data_endpoint, StreamName=stream_name, APIName=api_name
+            )).get('DataEndpoint')
+            break
+        except Exception:
+            if attempt == ENDPOINT_ATTEMPTS - 1:
+                raise
+            logger.warning(f'Failed to get the KVS endpoint of {stream_name}, retrying', exc_info=True)
+            await asyncio.sleep(2 ** attempt)
+    archived_media_client = boto3.client('kinesis-video-archived-media', endpoint_url=kvs_endpoint)
+
+    loop = asyncio.get_running_loop()
+    elapsed = (datetime.now(timezone.utc) - timedelta(seconds=KVS_INGEST_DELAY) - first_end).total_seconds()
+    started = loop.time() - max(elapsed, 0)
+    cursor = None
+    cycle = 0
+    while cycle < cycle_limit:
+        delay = started + cycle * frequency - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        elif delay < -frequency:
+            # 保留最后一轮, 它负责 end 标记
+            skipped = min(int(-delay // frequency), cycle_limit - 1 - cycle)
+            if skipped:
+                logger.warning(f'Stream {stream_name} is {-delay:.1f}s behind, skipping {skipped} cycles')
+                cycle += skipped
+
+        end_time = first_end + timedelta(seconds=cycle * frequency)
+        start_time = end_time - window_span
+        if cursor is not None and cursor > start_time:
+            start_time = cursor
+        tag = 'end' if cycle == cycle_limit - 1 else None
+        try:
+            async with inflight:
+                last_timestamp = await asyncio.to_thread(extract_window, archived_media_client, request,
+                                                         start_time, end_time, tag)
+            if last_timestamp is not None:
+                cursor = last_timestamp + timedelta(milliseconds=1)
+        except Exception:
+            logger.exception(f'Exception during KVS frame extraction of {stream_name} in cycle {cycle}')
+        cycle += 1
+    logger.info(f'Stream {stream_name} finished after {cycle_limit} cycles')
+
+
+class HeldStream:
+    """
+    worker 正在轮询的流, 领取它的 SQS 消息在轮询期间一直保持不可见, 流结束后才删除
+    """
+
+    def __init__(self, request, message, task):
+        self.request = request
+        self.message = message
+        self.task = task
+        self.table = dynamodb.Table(request['task_state_table'])
+
+
+async def renew_leases(queue_url, streams):
+    """
+    定期续期租约并延长消息的不可见时间
+    """
+    while True:
+        await asyncio.sleep(STREAM_LEASE_SECONDS / 3)
+        for stream_name, held in list(streams.items()):
+            if held.task.done():
+                continue
+            try:
+                if not await asyncio.to_thread(claim_stream, held.table, held.request['task_id']):
+                    # 流被发到其他 worker 的 stop 请求结束, 或租约已被接手; 手中的消息交给之后拿到它的 worker 处理
+                    logger.info(f'Stream {stream_name} lease lost, stopping')
+                    streams.pop(stream_name)
+                    held.task.cancel()
+                    continue
+            except Exception:
+                logger.exception(f'Failed to renew the lease of stream {stream_name}')
+                continue
+
+            if held.message is None:
+                continue
+            try:
+                await asyncio.to_thread(sqs.change_message_visibility, QueueUrl=queue_url,
+                                        ReceiptHandle=held.message['ReceiptHandle'],
+                                        VisibilityTimeout=STREAM_LEASE_SECONDS)
+            except ClientError:
+                # 消息的不可见时间最多 12 小时, 到期后换成一条新消息, 租约保证它不会再启动一个轮询
+                logger.info(f'Stream {stream_name} message reached the visibility limit, re-enqueuing it')
+                await asyncio.to_thread(sqs.send_message, QueueUrl=queue_url, MessageBody=held.message['Body'])
+                await asyncio.to_thread(sqs.delete_message, QueueUrl=queue_url,
+                                        ReceiptHandle=held.message['ReceiptHandle'])
+                held.message = None
+
+
+def log_stream_failure(stream_name, task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f'Stream {stream_name} failed', exc_info=task.exception())
+
+
+async def finish_stream(queue_url, held):
+    """
+    结束一个流: 标记任务状态并删除领取它的消息
+    """
+    await asyncio.to_thread(release_stream, held.table, held.request['task_id'], True)
+    if held.message is not None:
+        await asyncio.to_thread(sqs.delete_message, QueueUrl=queue_url, ReceiptHandle=held.message['ReceiptHandle'])
+
+
+async def release_held(queue_url, stream_name, held, delay=0):
+    """
+    交还一个流的租约但不标记结束, 消息在 delay 秒后重新可见, 由拿到它的 worker 按原来的节奏接手
+    """
+    try:
+        await asyncio.to_thread(release_stream, held.table, held.request['task_id'])
+        if held.message is not None:
+            await asyncio.to_thread(sqs.change_message_visibility, QueueUrl=queue_url,
+                                    ReceiptHandle=held.message['ReceiptHandle'], VisibilityTimeout=delay)
+        logger.info(f'Stream {stream_name} released')
+    except Exception:
+        logger.exception(f'Failed to release stream {stream_name}')
+
+
+async def release_streams(queue_url, streams):
+    """
+    worker 停止时交还所有流, 消息立即重新可见
+    """
+    for stream_name, held in streams.items():
+        held.task.cancel()
+        await release_held(queue_url, stream_name, held)
+
+
+async def handle_message(queue_url, message, streams, inflight):
+    request = json.loads(message['Body'])
+    stream_name = request['video_source_content']
+    action = request.get('action', 'start')
+    table = dynamodb.Table(request['task_state_table'])
+
+    if action == 'stop':
+        if stream_name in streams:
+            held = streams.pop(stream_name)
+            held.task.cancel()
+            await finish_stream(queue_url, held)
+        elif request.get('task_id'):
+            # 流由其他 worker 持有, 它在下次续期时停止
+            await asyncio.to_thread(release_stream, table, request['task_id'], True)
+        logger.info(f'Stream {stream_name} stopped')
+    else:
+        first_end = await asyncio.to_thread(claim_stream, table, request['task_id'])
+        if first_end is None:
+            # 其他 worker 持有租约, 消息留在队列中, 持有者退出后由拿到消息的 worker 接手
+            await asyncio.to_thread(sqs.change_message_visibility, QueueUrl=queue_url,
+                                    ReceiptHandle=message['ReceiptHandle'], VisibilityTimeout=STREAM_LEASE_SECONDS)
+            return
+        if first_end is False:
+            logger.info(f'Stream {stream_name} already finished, dropping start request')
+        elif stream_name in streams:
+            if streams[stream_name].message is None:
+                # 续期时重新入队的消息回到了持有者
+                streams[stream_name].message = message
+                return
+            logger.warning(f'Stream {stream_name} is already being polled, ignoring start request')
+        else:
+            task = asyncio.create_task(poll_stream(request, inflight, first_end))
+            task.add_done_callback(partial(log_stream_failure, stream_name))
+            streams[stream_name] = HeldStream(request, message, task)
+            logger.info(f"Stream {stream_name} started, task_id={request['task_id']}")
+            return
+
+    await asyncio.to_thread(sqs.delete_message, QueueUrl=queue_url, ReceiptHandle=message['ReceiptHandle'])
+
+
+async def main():
+    queue_url = os.environ['stream_queue_url']
+    inflight = asyncio.Semaphore(MAX_INFLIGHT_CYCLES)
+    loop = asyncio.get_running_loop()
+    # 队列长轮询也占用一个线程
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=MAX_INFLIGHT_CYCLES + 1))
+    streams = {}
+    # ECS 缩容或部署时先发 SIGTERM
+    stopping = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stopping.set)
+    renewer = asyncio.create_task(renew_leases(queue_url, streams))
+
+    logger.info(f'Stream worker started, queue={queue_url}, max_streams={MAX_STREAMS}, worker={WORKER_ID}')
+    try:
+        while not stopping.is_set():
+            for stream_name in [name for name, held in streams.items() if held.task.done()]:
+                held = streams.pop(stream_name)
+                if not held.task.cancelled() and held.task.exception() is None:
+                    await finish_stream(queue_url, held)
+                else:
+                    # 失败的流没有发出 end 窗口, 不能标记结束; 稍后重新投递, 避免持续失败的流空转
+                    await release_held(queue_url, stream_name, held, STREAM_RETRY_DELAY)
+
+            # 达到上限时把新的流留在队列中, 交给其他 worker
+            if len(streams) >= MAX_STREAMS:
+                await asyncio.sleep(1)
+                continue
+
+            response = await asyncio.to_thread(
+                sqs.receive_message,
+                QueueUrl=queue_url,
+                MaxNumberOfMessages=min(10, MAX_STREAMS - len(streams)),
+                WaitTimeSeconds=20
+            )
+            for message in response.get('Messages', []):
+                try:
+                    await handle_message(queue_url, message, streams, inflight)
+                except Exception:
+                    # 消息在不可见时间结束后重新投递
+                    logger.exception(f"Failed to handle stream request {message['MessageId']}")
+    finally:
+        renewer.cancel()
+        await release_streams(queue_url, streams)
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    finally:
+        uploader.shutdown()
@@ -0,0 +1,8 @@
+import os
+import sys
+
+MODULE_DIR = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, MODULE_DIR)
+# the image copies extraction_utils.py from the frame_extraction Lambda
+sys.path.insert(0, os.path.join(MODULE_DIR, '..', '..', '..', '..', 'source', 'lambda', 'frame_extraction'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
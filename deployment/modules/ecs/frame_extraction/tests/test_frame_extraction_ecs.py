@@ -0,0 +1,62 @@
+import pytest
+
+import frame_extraction_ecs
+from extraction_utils import ANALYSIS_TASK_FIELDS
+
+PROBE = {
+    'format': {'duration': '60.0'},
+    'streams': [{'codec_type': 'video', 'codec_name': 'h264', 'width': 640, 'height': 360}]
+}
+TASK = dict({name: 'value' for name in ANALYSIS_TASK_FIELDS}, temperature='0.1', top_p='1', top_k='250',
+            max_tokens='2048')
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    """Analysis requests the extraction sends, in order."""
+    sent = []
+    monkeypatch.setattr(frame_extraction_ecs, 'resolve_video_input', lambda *args, **kwargs: 'video.mp4')
+    monkeypatch.setattr(frame_extraction_ecs.ffmpeg, 'probe', lambda path: PROBE)
+    monkeypatch.setattr(frame_extraction_ecs, 'deliver_window', lambda *args: ({}, []))
+    monkeypatch.setattr(frame_extraction_ecs, 'send_analysis_request',
+                        lambda lambda_client, sqs, function_name, request, **kwargs: sent.append(request))
+    return sent
+
+
+def extract(windows, monkeypatch):
+    monkeypatch.setattr(frame_extraction_ecs, 'stream_windows', lambda *args, **kwargs: windows())
+    frame_extraction_ecs.extract_frames_from_s3(
+        tmp_dir='/tmp', video_upload_bucket_name='upload', video_source_content='video.mp4',
+        video_info_bucket_name='info', user_id='user', frequency=10, list_length=1, interval=1.0, duration=60,
+        image_size='64*36', video_analysis_lambda='video_analysis', model_id='anthropic.claude-3-haiku', task=TASK,
+        video_source_type='s3', task_id='task')
+
+
+def test_last_window_carries_the_end_tag(sent, monkeypatch):
+    def windows():
+        for start_time in (0, 10, 20):
+            yield start_time, [b'frame']
+
+    extract(windows, monkeypatch)
+    assert [(request['start_time'], request.get('tag')) for request in sent] == [(0, None), (10, None), (20, 'end')]
+
+
+def test_failure_partway_still_closes_the_task(sent, monkeypatch):
+    def windows():
+        yield 0, [b'frame']
+        yield 10, [b'frame']
+        raise RuntimeError('ffmpeg exited')
+
+    extract(windows, monkeypatch)
+    # the window held back when the generator failed is sent, and it closes the task
+    assert [(request['start_time'], request.get('tag')) for request in sent] == [(0, None), (10, 'end')]
+
+
+def test_failure_before_any_window_sends_an_end_only_request(sent, monkeypatch):
+    def windows():
+        raise RuntimeError('ffmpeg exited')
+        yield
+
+    extract(windows, monkeypatch)
+    assert len(sent) == 1
+    assert sent[0]['end_only'] and sent[0]['tag'] == 'end' and sent[0]['task_id'] == 'task'
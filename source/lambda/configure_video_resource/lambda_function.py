@@ -2,12 +2,14 @@ import os
 import json
 import boto3
 import logging
+from datetime import datetime
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 ec2 = boto3.client('ec2')
 ecs = boto3.client('ecs')
+sqs = boto3.client('sqs')
 lambda_client = boto3.client('lambda')
 
 
@@ -32,7 +34,32 @@ def lambda_handler(event, context):
     list_length = int(event.get('list_length', 1))
     interval = float(event.get('interval', 1.0))
     duration = int(event.get('duration', 60))
-    image_size = event.get('image_size', 'raw')
+    # 'auto' sizes frames for model_id, see plan_image_size in frame_extraction; 'raw' is capped the same way
+    # for models with a hard size limit such as Llama
+    image_size = event.get('image_size', 'auto')
+    extraction_engine = event.get('extraction_engine', 'stream')
+    seek_accuracy = event.get('seek_accuracy', 'exact')
+    extraction_workers = int(event.get('extraction_workers', 0))
+    # seconds of video per frame_extraction Lambda invocation for S3 videos, 0 extracts in a single invocation
+    shard_duration = int(event.get('shard_duration', 0))
+    input_mode = event.get('input_mode', 'url')
+    frame_delivery = event.get('frame_delivery', 'direct')
+    archive_frames = event.get('archive_frames', 'Y')
+    sampling_mode = event.get('sampling_mode', 'fixed')
+    scene_threshold = float(event.get('scene_threshold', 0.08))
+    min_interval = float(event.get('min_interval', interval))
+    max_interval = float(event.get('max_interval', 60))
+    # hamming distance between frame hashes under which a window reuses the previous result, -1 disables
+    dedup_threshold = int(event.get('dedup_threshold', -1))
+    # KVS frames from 'images' (GetImages) or 'clip' (GetClip media decoded by ffmpeg)
+    kvs_engine = event.get('kvs_engine', 'images')
+    # ffmpeg decode tuning for S3 videos: 'default', 'fast' or 'keyframe'
+    decode_profile = event.get('decode_profile', 'default')
+    # frame encoding: 'jpeg', 'webp' or 'avif' (sent as webp), quality level 0-3 or 'auto' to fit the model budget
+    frame_format = event.get('frame_format', 'jpeg')
+    frame_quality = str(event.get('frame_quality', 'auto'))
+    # 'Y' tiles the frames of a window into labelled grid images, one image per model call instead of one per frame
+    frame_mosaic = event.get('frame_mosaic', 'N')
 
     # LLM params
     system_prompt = event.get('system_prompt', '')
@@ -42,14 +69,13 @@ def lambda_handler(event, context):
     top_p = float(event.get('top_p', 1))
     top_k = int(event.get('top_k', 250))
     max_tokens = int(event.get('max_tokens', 2048))
-    
-    # Override image_size if model is llama
-    if "llama" in model_id.lower():
-        image_size = '640*480'
 
     # platform selection
     frame_extraction_platform = event.get('platform', 'lambda')
 
+    # a stable task id lets a retried or restarted extraction resume from its checkpoint
+    task_id = event.get('task_id') or f"task_{datetime.now().strftime('%Y-%m%d-%H%M%S')}"
+
     if video_source_type == 's3_image':
         try:
             # construct request and invoke analysis lambda
@@ -88,6 +114,55 @@ def lambda_handler(event, context):
             'body': json.dumps({})
         }
 
+    # hand KVS streams to the long running multi-stream ECS worker instead of one task per stream
+    if frame_extraction_platform == 'ecs_shared' and video_source_type == 'kvs':
+        try:
+            stream_request = {
+                'action': event.get('stream_action', 'start'),
+                'task_id': task_id,
+                'connection_id': connection_id,
+                'video_analysis_lambda': os.environ['VIDEO_ANALYSIS_LAMBDA'],
+                'analysis_queue_url': os.environ.get('ANALYSIS_QUEUE_URL', ''),
+                'task_state_table': os.environ['TASK_STATE_DYNAMODB'],
+                'user_id': user_id,
+                'video_source_content': video_source_content,
+                'video_info_bucket_name': os.environ['VIDEO_INFO_BUCKET_NAME'],
+                'frequency': str(frequency),
+                'list_length': str(list_length),
+                'interval': str(interval),
+                'duration': str(duration),
+                'image_size': image_size,
+                'frame_delivery': frame_delivery,
+                'archive_frames': archive_frames,
+                'dedup_threshold': str(dedup_threshold),
+                'kvs_engine': kvs_engine,
+                'frame_format': frame_format,
+                'frame_quality': frame_quality,
+                'frame_mosaic': frame_mosaic,
+                'system_prompt': system_prompt,
+                'user_prompt': user_prompt,
+                'model_id': model_id,
+                'temperature': str(temperature),
+                'top_p': str(top_p),
+                'top_k': str(top_k),
+                'max_tokens': str(max_tokens),
+            }
+
+            logger.info(f'Stream request: {stream_request}')
+            # work queue of the shared multi-stream ECS worker
+            sqs.send_message(QueueUrl=os.environ['STREAM_QUEUE_URL'], MessageBody=json.dumps(stream_request))
+        except Exception:
+            logger.exception('Failed to queue stream for the ECS worker')
+            return {
+                'statusCode': 500,
+                'body': 'Failed to queue stream for the ECS worker'
+            }
+
+        return {
+            'statusCode': 200,
+            'body': json.dumps({})
+        }
+
     # retrieve default VPC with subnet list
     try:
         vpc = ec2.describe_vpcs(
@@ -117,7 +192,7 @@ def lambda_handler(event, context):
         }
 
     # frame_extraction_platform = os.environ['FRAME_EXTRACTION_PLATFORM']
-    if frame_extraction_platform == 'ecs':
+    if frame_extraction_platform in ('ecs', 'ecs_shared'):
         # run ECS task
         try:
             ecs.run_task(
@@ -138,6 +213,7 @@ def lambda_handler(event, context):
                             'environment': [
                                 {'name': 'connection_id', 'value': connection_id},
                                 {'name': 'video_analysis_lambda', 'value': os.environ['VIDEO_ANALYSIS_LAMBDA']},
+                                {'name': 'ANALYSIS_QUEUE_URL', 'value': os.environ.get('ANALYSIS_QUEUE_URL', '')},
                                 {'name': 'user_id', 'value': user_id},
                                 {'name': 'video_source_type', 'value': video_source_type},
                                 {'name': 'video_source_content', 'value': video_source_content},
@@ -148,6 +224,24 @@ def lambda_handler(event, context):
                                 {'name': 'interval', 'value': str(interval)},
                                 {'name': 'duration', 'value': str(duration)},
                                 {'name': 'image_size', 'value': image_size},
+                                {'name': 'extraction_engine', 'value': extraction_engine},
+                                {'name': 'seek_accuracy', 'value': seek_accuracy},
+                                {'name': 'extraction_workers', 'value': str(extraction_workers)},
+                                {'name': 'input_mode', 'value': input_mode},
+                                {'name': 'frame_delivery', 'value': frame_delivery},
+                                {'name': 'archive_frames', 'value': archive_frames},
+                                {'name': 'sampling_mode', 'value': sampling_mode},
+                                {'name': 'scene_threshold', 'value': str(scene_threshold)},
+                                {'name': 'min_interval', 'value': str(min_interval)},
+                                {'name': 'max_interval', 'value': str(max_interval)},
+                                {'name': 'dedup_threshold', 'value': str(dedup_threshold)},
+                                {'name': 'kvs_engine', 'value': kvs_engine},
+                                {'name': 'decode_profile', 'value': decode_profile},
+                                {'name': 'frame_format', 'value': frame_format},
+                                {'name': 'frame_quality', 'value': frame_quality},
+                                {'name': 'frame_mosaic', 'value': frame_mosaic},
+                                {'name': 'task_id', 'value': task_id},
+                                {'name': 'task_state_table', 'value': os.environ['TASK_STATE_DYNAMODB']},
                                 {'name': 'system_prompt', 'value': system_prompt},
                                 {'name': 'user_prompt', 'value': user_prompt},
                                 {'name': 'model_id', 'value': model_id},
@@ -182,6 +276,23 @@ def lambda_handler(event, context):
                 'interval': str(interval),
                 'duration': str(duration),
                 'image_size': image_size,
+                'extraction_engine': extraction_engine,
+                'seek_accuracy': seek_accuracy,
+                'shard_duration': str(shard_duration),
+                'input_mode': input_mode,
+                'frame_delivery': frame_delivery,
+                'archive_frames': archive_frames,
+                'sampling_mode': sampling_mode,
+                'scene_threshold': str(scene_threshold),
+                'min_interval': str(min_interval),
+                'max_interval': str(max_interval),
+                'dedup_threshold': str(dedup_threshold),
+                'kvs_engine': kvs_engine,
+                'decode_profile': decode_profile,
+                'frame_format': frame_format,
+                'frame_quality': frame_quality,
+                'frame_mosaic': frame_mosaic,
+                'task_id': task_id,
                 'system_prompt': system_prompt,
                 'user_prompt': user_prompt,
                 'model_id': model_id,
@@ -0,0 +1,1041 @@
+import io
+import os
+import re
+import json
+import math
+import base64
+import shutil
+import hashlib
+import tempfile
+import queue
+import ffmpeg
+import logging
+import subprocess
+import threading
+import time
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+logger = logging.getLogger()
+
+JPEG_SOI = b'\xff\xd8'
+JPEG_EOI = b'\xff\xd9'
+
+# stay well below the 256 KB asynchronous Lambda invocation payload limit, which is also the SQS message limit
+INLINE_FRAMES_LIMIT = 192 * 1024
+
+# queue consumed by the batch inference engine of video_analysis, windows invoke the function directly when unset
+ANALYSIS_QUEUE_URL = os.environ.get('ANALYSIS_QUEUE_URL')
+
+SHOWINFO_PTS_TIME = re.compile(rb'Parsed_showinfo.*\bpts_time:\s*(-?[\d.]+)')
+
+# KVS needs a few seconds after a fragment arrives before GetImages can return its frames
+KVS_INGEST_DELAY = 4
+# largest MaxResults GetImages accepts per call
+GET_IMAGES_PAGE_SIZE = 100
+
+# decoder tuning selectable per task, resolved against the probed source by decode_settings
+#   'default'  : ffmpeg defaults
+#   'fast'     : automatic decoder threads, fast bilinear scaler, decoder side downscale where the codec supports it
+#                (LOWRES_CODECS), other codecs such as H.264 and HEVC still decode every frame at full resolution and
+#                only skip the deblocking of non-reference frames
+#   'keyframe' : 'fast' and decode keyframes only, for sampling intervals longer than the keyframe distance,
+#                the profile that actually cuts the decode cost of H.264 and HEVC sources
+DECODE_PROFILES = {
+    'default': {},
+    'fast': {'threads': 0, 'scale_flags': 'fast_bilinear', 'lowres': True},
+    'keyframe': {'threads': 0, 'scale_flags': 'fast_bilinear', 'lowres': True, 'skip_frame': 'nokey'},
+}
+
+# decoders able to decode at 1/2, 1/4 or 1/8 of the resolution, H.264, HEVC, VP9 and AV1 are not among them
+LOWRES_CODECS = {'mjpeg', 'mpeg1video', 'mpeg2video', 'mpeg4', 'h263', 'msmpeg4v2', 'msmpeg4v3', 'jpeg2000'}
+
+# output encodings of the extracted frames, all accepted by the Bedrock converse API
+FRAME_FORMATS = {
+    'jpeg': {'extension': 'jpg', 'content_type': 'image/jpeg', 'input_format': 'jpeg_pipe'},
+    'webp': {'extension': 'webp', 'content_type': 'image/webp', 'input_format': 'webp_pipe'},
+}
+
+# quality levels from best to smallest: mjpeg qscale, libwebp quality, KVS GetImages JPEGQuality and the rough
+# size of the result in bytes per pixel, used to estimate a window against the model budget
+QUALITY_LEVELS = [
+    {'qscale': 2, 'quality': 90, 'bytes_per_pixel': 0.5},
+    {'qscale': 5, 'quality': 80, 'bytes_per_pixel': 0.25},
+    {'qscale': 10, 'quality': 65, 'bytes_per_pixel': 0.12},
+    {'qscale': 20, 'quality': 45, 'bytes_per_pixel': 0.06},
+]
+
+# frame bytes allowed for one window per model family, matched in order against the lower case model id
+MODEL_FRAME_BUDGETS = [
+    # SageMaker payloads are limited to 6 MB including base64 and the JSON around it
+    ('sagemaker', 2 * 1024 * 1024),
+    ('llama', 1024 * 1024),
+    ('nova', 8 * 1024 * 1024),
+    ('claude', 8 * 1024 * 1024),
+]
+DEFAULT_FRAME_BUDGET = 4 * 1024 * 1024
+
+# how each model family bills images, matched in order against the lower case model id. Providers downsample
+# anything over max_long_edge or max_pixels before tokenizing, so larger frames only add payload and latency.
+# Token counts are approximations of the published formulas, used for planning and reporting only.
+MODEL_IMAGE_PROFILES = [
+    # LLaVA on SageMaker: 336 px patches, two per edge at most
+    ('sagemaker', {'max_long_edge': 672, 'max_pixels': 672 * 672, 'pixels_per_token': 196}),
+    # Llama 3.2 vision bills per 560 px tile, one tile keeps the cost of the former 640*480 frames;
+    # cap_raw: 'raw' frames are sized as 'auto' too, the model is never sent full resolution frames
+    ('llama', {'max_long_edge': 560, 'max_pixels': 560 * 560, 'pixels_per_token': 196, 'cap_raw': True}),
+    ('nova', {'max_long_edge': 1920, 'max_pixels': 1920 * 1080, 'pixels_per_token': 800}),
+    ('claude', {'max_long_edge': 1568, 'max_pixels': 1150 * 1000, 'pixels_per_token': 750}),
+]
+DEFAULT_IMAGE_PROFILE = {'max_long_edge': 1568, 'max_pixels': 1150 * 1000, 'pixels_per_token': 750}
+
+# largest mosaic grid per model family, models that downsample hard get fewer, larger tiles
+MODEL_MOSAIC_GRIDS = [
+    ('sagemaker', 2),
+    ('llama', 2),
+    ('nova', 3),
+    ('claude', 3),
+]
+DEFAULT_MOSAIC_GRID = 3
+MOSAIC_PADDING = 4
+# drawtext needs a font, static ffmpeg builds without fontconfig need it set explicitly
+MOSAIC_FONT_FILE = os.environ.get('MOSAIC_FONT_FILE')
+
+# dHash compares horizontally adjacent pixels of a (HASH_SIZE + 1) x HASH_SIZE grayscale thumbnail
+HASH_SIZE = 8
+
+
+def iter_jpeg_frames(pipe, chunk_size=1024 * 1024):
+    """
+    Split a concatenated MJPEG byte stream (ffmpeg image2pipe output) into single JPEG images.
+    :param pipe: readable binary stream
+    :param chunk_size: bytes to read from the stream per call
+    :return: generator of JPEG bytes
+    """
+    # read1 returns as soon as ffmpeg has flushed something instead of waiting for a full chunk
+    read = getattr(pipe, 'read1', pipe.read)
+    buffer = bytearray()
+    search_from = 0
+    while True:
+        chunk = read(chunk_size)
+        if not chunk:
+            break
+        buffer += chunk
+        while True:
+            start = buffer.find(JPEG_SOI)
+            if start < 0:
+                break
+            end = buffer.find(JPEG_EOI, max(start + 2, search_from))
+            if end < 0:
+                # keep the partial frame, resume the EOI search where this one stopped
+                search_from = len(buffer) - 1
+                break
+            yield bytes(buffer[start:end + 2])
+            del buffer[:end + 2]
+            search_from = 0
+
+
+def iter_riff_frames(pipe):
+    """
+    Split concatenated RIFF images (ffmpeg image2pipe WebP output) using the size in each RIFF header.
+    :param pipe: readable binary stream
+    :return: generator of WebP bytes
+    """
+    while True:
+        header = pipe.read(8)
+        if len(header) < 8:
+            return
+        size = int.from_bytes(header[4:8], 'little')
+        # RIFF chunks are padded to an even size
+        body = pipe.read(size + (size & 1))
+        if len(body) < size:
+            return
+        yield header + body
+
+
+def frame_dimensions(image_size, probe=None):
+    """
+    Output size of the frames.
+    :param image_size: 'width*height', 'width*-2' to keep the aspect ratio, or 'raw'
+    :param probe: ffmpeg.probe output of the source, sizes 'raw' frames
+    :return: (width, height), None when unknown; a kept aspect ratio is assumed to be 16:9
+    """
+    if image_size not in ('raw', 'auto'):
+        width, height = (int(value) for value in image_size.split('*'))
+        return width, height if height > 0 else width * 9 // 16
+    if probe:
+        video = next((stream for stream in probe.get('streams', []) if stream.get('codec_type') == 'video'), None)
+        if video:
+            return int(video['width']), int(video['height'])
+    return None
+
+
+def image_profile(model_id):
+    return next((profile for family, profile in MODEL_IMAGE_PROFILES if family in model_id.lower()),
+                DEFAULT_IMAGE_PROFILE)
+
+
+def fit_image_size(width, height, profile):
+    """
+    Largest even size with the aspect ratio of width x height that the model does not downsample, never upscaled.
+    """
+    scale = min(1.0, profile['max_long_edge'] / max(width, height),
+                math.sqrt(profile['max_pixels'] / (width * height)))
+    return max(2, int(width * scale) // 2 * 2), max(2, int(height * scale) // 2 * 2)
+
+
+def image_tokens(width, height, profile):
+    return math.ceil(min(width * height, profile['max_pixels']) / profile['pixels_per_token'])
+
+
+def plan_image_size(image_size, model_id, probe=None):
+    """
+    Resolve image_size 'auto' to the largest frame size the model bills without downsampling it first,
+    keeping the source aspect ratio and never upscaling.
+    :param image_size: 'auto', or an explicit size which is kept as is. 'raw' is kept too, except for models
+                       whose profile sets cap_raw, where it is planned like 'auto'
+    :param probe: ffmpeg.probe output of the source. Without it (KVS) only the width is planned, for a
+                  landscape 16:9 source, and the height follows the stream's aspect ratio
+    :return: (image_size, expected image tokens per frame)
+    """
+    profile = image_profile(model_id)
+    if image_size == 'auto' or (image_size == 'raw' and profile.get('cap_raw')):
+        # even sizes keep yuv420p encoders happy
+        width, height = fit_image_size(*(frame_dimensions('raw', probe) or (1920, 1080)), profile)
+        image_size = f'{width}*{height}' if probe else f'{width}*-2'
+
+    return image_size, image_tokens(*(frame_dimensions(image_size, probe) or (1920, 1080)), profile)
+
+
+def frame_label(frame_time):
+    """
+    Mosaic label of a frame: wall clock time for KVS timestamps, h:mm:ss offset for S3 seconds
+    """
+    if isinstance(frame_time, datetime):
+        return f'{frame_time:%H:%M:%S}'
+    seconds = int(frame_time)
+    return f'{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}'
+
+
+def tile_frames(frames, labels, columns, rows, frame_height, width, encode=None):
+    """
+    Tile up to columns x rows frames of the same size into one labelled image, row by row, scaled to width.
+    Unused cells stay black.
+    :return: image bytes
+    """
+    encode = encode or DEFAULT_ENCODE
+    stream = ffmpeg.input('pipe:', format=encode['input_format'])
+    stream = ffmpeg.filter(stream, 'tile', f'{columns}x{rows}', padding=MOSAIC_PADDING)
+    font_args = {'fontfile': MOSAIC_FONT_FILE} if MOSAIC_FONT_FILE else {}
+    for index, label in enumerate(labels or []):
+        # the cell origin is derived from the mosaic size w x h, so it holds whatever the frame size is
+        stream = ffmpeg.filter(stream, 'drawtext', text=label, fontsize=max(12, frame_height // 12),
+                               fontcolor='white', box=1, boxcolor='black@0.6',
+                               x=f'{index % columns}*(w+{MOSAIC_PADDING})/{columns}+8',
+                               y=f'{index // columns}*(h+{MOSAIC_PADDING})/{rows}+8', **font_args)
+    stream = ffmpeg.filter(stream, 'scale', width, -2)
+    out, _ = frame_output(stream, encode).run(input=b''.join(frames), capture_stdout=True, quiet=True)
+    return next(iter_frames(io.BytesIO(out), encode))
+
+
+def prepare_window(frames, frame_times, frame_mosaic, model_id, image_size, encode=None, probe=None):
+    """
+    Compositing stage between extraction and inference. With frame_mosaic, the frames of a window are tiled into
+    labelled grid images sized for the model, so a multi-frame window costs one image instead of one per frame.
+    :param frame_times: per frame S3 offset in seconds or KVS timestamp, None to label frames by position
+    :param frame_mosaic: tile the frames, windows of a single frame are passed through
+    :param image_size: planned size of the frames
+    :return: (frames to deliver, their frame_times, fields to add to the analysis request); a mosaic has
+             the time of its first frame
+    """
+    profile = image_profile(model_id)
+    frame_width, frame_height = frame_dimensions(image_size, probe) or (1920, 1080)
+    if not frame_mosaic or len(frames) < 2:
+        window_tokens = image_tokens(frame_width, frame_height, profile) * len(frames)
+        return frames, frame_times, {'expected_image_tokens': window_tokens}
+
+    grid = next((grid for family, grid in MODEL_MOSAIC_GRIDS if family in model_id.lower()), DEFAULT_MOSAIC_GRID)
+    columns = min(grid, math.ceil(math.sqrt(len(frames))))
+    rows = min(grid, math.ceil(len(frames) / columns))
+    width, height = fit_image_size(columns * frame_width + (columns - 1) * MOSAIC_PADDING,
+                                   rows * frame_height + (rows - 1) * MOSAIC_PADDING, profile)
+    if frame_times is None:
+        labels = [f'#{index}' for index in range(1, len(frames) + 1)]
+    else:
+        labels = [frame_label(frame_time) for frame_time in frame_times]
+
+    mosaics = []
+    cells = columns * rows
+    for first in range(0, len(frames), cells):
+        chunk = frames[first:first + cells]
+        try:
+            mosaics.append(tile_frames(chunk, labels[first:first + cells], columns, rows, frame_height, width, encode))
+        except ffmpeg.Error as e:
+            # typically no font for drawtext, tiles without labels are still usable
+            logger.warning(f"Labelling the mosaic failed, tiling without labels: {e.stderr.decode('utf-8')[-500:]}")
+            mosaics.append(tile_frames(chunk, None, columns, rows, frame_height, width, encode))
+    mosaic_times = frame_times[::cells] if frame_times is not None else None
+    return mosaics, mosaic_times, {'expected_image_tokens': image_tokens(width, height, profile) * len(mosaics),
+                                   'frame_mosaic': f'{columns}x{rows}'}
+
+
+def encode_settings(frame_format='jpeg', frame_quality='auto', model_id='', frame_count=1, image_size='raw',
+                    probe=None):
+    """
+    Resolve the output format and quality of the extracted frames.
+    :param frame_format: 'jpeg', 'webp', or 'avif' which Bedrock does not accept and falls back to 'webp'
+    :param frame_quality: index into QUALITY_LEVELS (0 is best), or 'auto' for the best level whose estimated
+                          window size fits the budget of the model
+    :param frame_count: frames per window, for the 'auto' estimate
+    :param image_size: output size of the frames, for the 'auto' estimate
+    :param probe: ffmpeg.probe output of the source, sizes 'raw' frames; 1080p is assumed without either
+    :return: dict passed as encode to the extraction engines
+    """
+    if frame_format == 'avif':
+        logger.warning('Bedrock does not accept AVIF images, encoding frames as WebP')
+        frame_format = 'webp'
+    if frame_format not in FRAME_FORMATS:
+        frame_format = 'jpeg'
+
+    if frame_quality == 'auto':
+        budget = next((budget for family, budget in MODEL_FRAME_BUDGETS if family in model_id.lower()),
+                      DEFAULT_FRAME_BUDGET)
+        width, height = frame_dimensions(image_size, probe) or (1920, 1080)
+        window_pixels = width * height * max(1, frame_count)
+        level = next((index for index, quality in enumerate(QUALITY_LEVELS)
+                      if quality['bytes_per_pixel'] * window_pixels <= budget), len(QUALITY_LEVELS) - 1)
+    else:
+        level = min(max(0, int(frame_quality)), len(QUALITY_LEVELS) - 1)
+
+    quality = QUALITY_LEVELS[level]
+    if frame_format == 'webp':
+        output_args = {'vcodec': 'libwebp', 'quality': quality['quality']}
+    else:
+        output_args = {'vcodec': 'mjpeg', 'qscale': quality['qscale']}
+    return dict(FRAME_FORMATS[frame_format], format=frame_format, level=level, output_args=output_args)
+
+
+# the encoding used before formats were selectable
+DEFAULT_ENCODE = encode_settings('jpeg', 0)
+
+
+def frame_output(stream, encode=None):
+    """
+    Encode the sampled frames to stdout as an image2pipe stream.
+    """
+    encode = encode or DEFAULT_ENCODE
+    return ffmpeg.output(stream, 'pipe:', format='image2pipe', vsync='vfr', **encode['output_args'])
+
+
+def iter_frames(pipe, encode=None):
+    """
+    Split an image2pipe stream written by frame_output into single images.
+    """
+    if encode and encode['format'] == 'webp':
+        return iter_riff_frames(pipe)
+    return iter_jpeg_frames(pipe)
+
+
+class FrameUploader:
+    """
+    Upload the frames of a window concurrently from memory over one shared, pooled transfer manager.
+    Uploads run in the background so the caller can decode the next window meanwhile.
+    """
+
+    def __init__(self, s3_client, max_concurrency=10):
+        # max_concurrency should not exceed the client's max_pool_connections
+        self.transfer_manager = create_transfer_manager(s3_client, TransferConfig(max_concurrency=max_concurrency))
+
+    def upload_window(self, frames, bucket_name, image_path, encode=None):
+        """
+        Start uploading the frames of one window
+        :param frames: list of image bytes
+        :param bucket_name: destination bucket
+        :param image_path: destination folder
+        :param encode: encode_settings of the frames, JPEG when None
+        :return: list of transfer futures
+        """
+        encode = encode or DEFAULT_ENCODE
+        futures = []
+        for index, frame in enumerate(frames, start=1):
+            object_key = frame_key(image_path, index, encode)
+            futures.append(self.transfer_manager.upload(
+                io.BytesIO(frame), bucket_name, object_key, extra_args={'ContentType': encode['content_type']}
+            ))
+        return futures
+
+    def upload_bundle(self, frames, bucket_name, object_key):
+        """
+        Start uploading all frames of one window as a single object
+        :return: transfer future
+        """
+        return self.transfer_manager.upload(io.BytesIO(b''.join(frames)), bucket_name, object_key)
+
+    def upload_manifest(self, manifest, bucket_name, object_key):
+        """
+        Start uploading the manifest of one window
+        :return: transfer future
+        """
+        body = json.dumps(manifest).encode('utf-8')
+        return self.transfer_manager.upload(io.BytesIO(body), bucket_name, object_key,
+                                            extra_args={'ContentType': 'application/json'})
+
+    @staticmethod
+    def wait(futures):
+        """
+        Block until the uploads of a window finished, raising the first upload error
+        """
+        for future in futures:
+            future.result()
+        if futures:
+            call_args = futures[0].meta.call_args
+            image_path = call_args.key.rsplit('/', 1)[0]
+            logger.info(f'Successfully uploaded {len(futures)} objects to {call_args.bucket}/{image_path}')
+
+    def shutdown(self):
+        self.transfer_manager.shutdown()
+
+
+def frame_key(image_path, index, encode=None):
+    """
+    Object key of the index-th (from 1) frame of a window, derived from the window alone so retries overwrite
+    instead of adding objects
+    """
+    return f"{image_path}/frame_{index:02d}.{(encode or DEFAULT_ENCODE)['extension']}"
+
+
+def window_manifest(frames, image_path, encode=None, frame_times=None, hashes=None):
+    """
+    Describe the archived frames of one window, so downstream stages read the frame keys instead of listing
+    image_path.
+    :param frame_times: per frame S3 offset in seconds or KVS timestamp
+    :param hashes: per frame dHash, when computed for deduplication
+    """
+    encode = encode or DEFAULT_ENCODE
+    entries = []
+    for index, frame in enumerate(frames):
+        frame_time = frame_times[index] if frame_times else None
+        entries.append({
+            'key': frame_key(image_path, index + 1, encode),
+            'size': len(frame),
+            # equals the ETag of the single part upload
+            'md5': hashlib.md5(frame).hexdigest(),
+            'dhash': hashes[index] if hashes else None,
+            'time': frame_time.isoformat() if isinstance(frame_time, datetime) else frame_time
+        })
+    return {'format': encode['format'], 'content_type': encode['content_type'], 'frames': entries}
+
+
+def deliver_window(uploader, frames, bucket_name, image_path, frame_delivery='direct', archive_frames=True,
+                   encode=None, frame_times=None, hashes=None):
+    """
+    Hand the frames of one window to the analysis stage.
+    :param frame_delivery: 's3' lets video_analysis download the frames listed in the window manifest,
+                           'direct' passes the frames inline in the request, or as one bundle object when
+                           they do not fit in the invocation payload
+    :param archive_frames: also store every frame under image_path, needed for the web UI preview and
+                           opensearch_ingest; always on for 's3' delivery
+    :param encode: encode_settings of the frames, JPEG when None
+    :param frame_times: per frame media time, recorded in the manifest
+    :param hashes: per frame dHash, recorded in the manifest
+    :return: (fields to add to the analysis request, upload futures to wait on before dispatching)
+    """
+    encode = encode or DEFAULT_ENCODE
+    fields = {'frame_format': encode['format']}
+    futures = []
+    if frame_delivery == 's3' or archive_frames:
+        futures = uploader.upload_window(frames, bucket_name, image_path, encode)
+        manifest_key = f'{image_path}/manifest.json'
+        futures.append(uploader.upload_manifest(window_manifest(frames, image_path, encode, frame_times, hashes),
+                                                bucket_name, manifest_key))
+        fields['manifest_key'] = manifest_key
+        if frames:
+            fields['first_frame_key'] = frame_key(image_path, 1, encode)
+
+    if frame_delivery == 'direct':
+        encoded_frames = [base64.b64encode(frame).decode('utf-8') for frame in frames]
+        if sum(len(encoded_frame) for encoded_frame in encoded_frames) <= INLINE_FRAMES_LIMIT:
+            fields['frames'] = encoded_frames
+        else:
+            bundle_key = f'{image_path}/frames.bin'
+            futures.append(uploader.upload_bundle(frames, bucket_name, bundle_key))
+            fields['frame_bundle_key'] = bundle_key
+            fields['frame_sizes'] = [len(frame) for frame in frames]
+    return fields, futures
+
+
+def frame_hashes(frames, encode=None):
+    """
+    Compute a 64 bit difference hash (dHash) per frame, used by video_analysis to skip near-duplicate windows.
+    All frames of a window are scaled down to grayscale thumbnails by a single ffmpeg run.
+    :return: list of hex strings, one per frame
+    """
+    if not frames:
+        return []
+    encode = encode or DEFAULT_ENCODE
+    out, _ = (
+        ffmpeg.input('pipe:', format=encode['input_format'])
+        .filter('scale', HASH_SIZE + 1, HASH_SIZE)
+        .output('pipe:', format='rawvideo', pix_fmt='gray')
+        .run(input=b''.join(frames), capture_stdout=True, quiet=True)
+    )
+    thumbnail_size = (HASH_SIZE + 1) * HASH_SIZE
+    hashes = []
+    for offset in range(0, len(out) - thumbnail_size + 1, thumbnail_size):
+        pixels = out[offset:offset + thumbnail_size]
+        value = 0
+        for row in range(HASH_SIZE):
+            for column in range(HASH_SIZE):
+                left = pixels[row * (HASH_SIZE + 1) + column]
+                value = (value << 1) | (left > pixels[row * (HASH_SIZE + 1) + column + 1])
+        hashes.append(f'{value:016x}')
+    return hashes
+
+
+def resolve_video_input(s3_client, bucket_name, key, input_mode='url', expires_in=3600,
+                        download_path='/tmp/video.mp4'):
+    """
+    Get the input ffmpeg should read the video from.
+    :param input_mode: 'url' lets ffmpeg read a presigned URL with range requests, so only the container
+                       index is fetched up front and decoding starts on the first bytes;
+                       'download' copies the whole object to download_path first
+    :param expires_in: presigned URL lifetime in seconds, must cover the whole extraction
+    :return: local path or URL
+    """
+    if input_mode == 'download':
+        s3_client.download_file(bucket_name, key, download_path)
+        return download_path
+    return s3_client.generate_presigned_url(
+        ClientMethod='get_object',
+        Params={'Bucket': bucket_name, 'Key': key},
+        ExpiresIn=expires_in
+    )
+
+
+def decode_settings(decode_profile, probe, image_size):
+    """
+    Resolve a decode profile against the probed source.
+    Decoder side downscale ('lowres') only exists for LOWRES_CODECS. For any other codec the 'lowres' profiles fall
+    back to skipping the loop filter of non-reference frames, but still decode every picture at full resolution,
+    so H.264/HEVC sources only get a substantial saving from the 'keyframe' profile.
+    :param decode_profile: key of DECODE_PROFILES
+    :param probe: ffmpeg.probe output of the source
+    :return: dict with the ffmpeg input options ('input_args') and the scaler flags ('scale_flags'),
+             passed as decode to the extraction engines
+    """
+    profile = DECODE_PROFILES.get(decode_profile, {})
+    input_args = {key: profile[key] for key in ('threads', 'skip_frame') if key in profile}
+
+    # let the decoder itself drop resolution when the output is at least half the source size in both directions,
+    # codecs without lowres skip deblocking the frames nothing is predicted from instead, the downscale hides it
+    if profile.get('lowres') and image_size != 'raw':
+        video = next((stream for stream in probe.get('streams', []) if stream.get('codec_type') == 'video'), None)
+        if video:
+            width, height = image_size.split('*')
+            ratio = min(int(video['width']) / int(width), int(video['height']) / int(height))
+            if ratio >= 2 and video.get('codec_name') in LOWRES_CODECS:
+                input_args['lowres'] = min(3, int(math.log2(ratio)))
+            elif ratio >= 2:
+                input_args['skip_loop_filter'] = 'noref'
+
+    return {'input_args': input_args, 'scale_flags': profile.get('scale_flags')}
+
+
+def open_input(video_path, decode=None, **kwargs):
+    """
+    ffmpeg.input wrapper that adds the decode profile options and reconnect options for HTTP(S) inputs.
+    """
+    if decode:
+        kwargs.update(decode['input_args'])
+    if video_path.startswith('http'):
+        kwargs.update({'reconnect': 1, 'reconnect_on_network_error': 1, 'reconnect_delay_max': 5})
+    return ffmpeg.input(video_path, **kwargs)
+
+
+def build_scaled_stream(stream, image_size, interval, decode=None):
+    """
+    Apply the fps and output scale filter shared by all extraction engines.
+    The fps filter runs first so only the sampled frames go through the scaler.
+    """
+    stream = ffmpeg.filter(stream, 'fps', f'1/{interval}')
+    if image_size != 'raw':
+        width, height = image_size.split('*')
+        scale_args = {'w': width, 'h': height}
+        if decode and decode['scale_flags']:
+            scale_args['flags'] = decode['scale_flags']
+        stream = ffmpeg.filter(stream, 'scale', **scale_args)
+    return stream
+
+
+def trim_windows(video_path, tmp_dir, frequency, list_length, interval, limit, image_size, begin=0, decode=None,
+                 encode=None):
+    """
+    Legacy engine: run one ffmpeg trim per window.
+    :param begin: start time of the first window, windows start every frequency seconds until limit
+    :param decode: decode_settings output, ffmpeg defaults when None
+    :param encode: encode_settings output, JPEG when None
+    :return: generator of (start_time, [image bytes]) per window
+    """
+    encode = encode or DEFAULT_ENCODE
+    original_stream = open_input(video_path, decode)
+    start_time = begin
+    while start_time < limit:
+        stream = ffmpeg.trim(original_stream, start=start_time, end=start_time + list_length * interval)
+        stream = build_scaled_stream(stream, image_size, interval, decode)
+
+        # a fresh directory per run, so leftovers of earlier or concurrent runs in tmp_dir are never picked up
+        window_dir = tempfile.mkdtemp(prefix=f'window_{start_time}_', dir=tmp_dir)
+        try:
+            stream = ffmpeg.output(stream, os.path.join(window_dir, f"%02d.{encode['extension']}"), vsync='vfr',
+                                   f='image2', **encode['output_args'])
+            ffmpeg.run(stream, overwrite_output=True)
+
+            frames = []
+            for image_file in sorted(os.listdir(window_dir)):
+                with open(os.path.join(window_dir, image_file), 'rb') as f:
+                    frames.append(f.read())
+        finally:
+            shutil.rmtree(window_dir, ignore_errors=True)
+
+        yield start_time, frames
+        start_time += frequency
+
+
+def extract_window(video_path, start_time, list_length, interval, image_size, seek_accuracy='exact', decode=None,
+                   encode=None):
+    """
+    Extract the frames of one window by seeking on the input side, so only list_length * interval
+    seconds after the nearest keyframe are decoded.
+    :param seek_accuracy: 'exact' decodes from the keyframe up to start_time and drops those frames,
+                          'keyframe' starts at the keyframe before start_time (cheapest, not frame exact)
+    :return: list of JPEG bytes
+    """
+    input_args = {'ss': start_time, 't': list_length * interval}
+    if seek_accuracy == 'keyframe':
+        input_args['noaccurate_seek'] = None
+    stream = build_scaled_stream(open_input(video_path, decode, **input_args), image_size, interval, decode)
+    out, _ = frame_output(stream, encode).run(capture_stdout=True)
+    frames = list(iter_frames(io.BytesIO(out), encode))
+    if not frames:
+        # containers without a usable index can make the demuxer seek miss, fall back to the trim filter
+        logger.warning(f'Input seek to {start_time}s returned no frames, falling back to trim filter')
+        stream = ffmpeg.trim(open_input(video_path, decode), start=start_time, end=start_time + list_length * interval)
+        stream = build_scaled_stream(stream, image_size, interval, decode)
+        out, _ = frame_output(stream, encode).run(capture_stdout=True)
+        frames = list(iter_frames(io.BytesIO(out), encode))
+    return frames[:list_length]
+
+
+def seek_windows(video_path, frequency, list_length, interval, limit, image_size, seek_accuracy='exact', begin=0,
+                 decode=None, encode=None):
+    """
+    Seek engine: one short ffmpeg run per window with the seek on the input side, so a window deep
+    into the file costs the same as the first one.
+    :return: generator of (start_time, [jpeg bytes]) per window
+    """
+    start_time = begin
+    while start_time < limit:
+        yield start_time, extract_window(video_path, start_time, list_length, interval, image_size, seek_accuracy,
+                                         decode, encode)
+        start_time += frequency
+
+
+def parallel_windows(video_path, frequency, list_length, interval, limit, image_size, seek_accuracy='exact',
+                     workers=0, begin=0, decode=None, encode=None):
+    """
+    Pool engine: extract independent windows concurrently, one seek-based ffmpeg process per worker,
+    and yield them back in timestamp order.
+    :param workers: pool size, 0 means one worker per available CPU
+    :return: generator of (start_time, [jpeg bytes]) per window
+    """
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+    if not workers:
+        workers = cpus
+    logger.info(f'Extracting windows with {workers} workers')
+    if decode and 'threads' in decode['input_args']:
+        # split the cores between the ffmpeg processes instead of each one starting a thread per core
+        decode = dict(decode, input_args=dict(decode['input_args'], threads=max(1, cpus // workers)))
+
+    # ffmpeg does the decoding in its own process, the threads only wait on it
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        start_time = begin
+        while start_time < limit:
+            future = executor.submit(extract_window, video_path, start_time, list_length, interval, image_size,
+                                     seek_accuracy, decode, encode)
+            pending.append((start_time, future))
+            start_time += frequency
+            # bound the number of finished windows held in memory ahead of the consumer
+            if len(pending) >= workers * 2:
+                window_start, future = pending.popleft()
+                yield window_start, future.result()
+        while pending:
+            window_start, future = pending.popleft()
+            yield window_start, future.result()
+
+
+def stream_windows(video_path, frequency, list_length, interval, limit, image_size, begin=0, decode=None,
+                   encode=None):
+    """
+    Single-pass engine: decode the video once with one ffmpeg process and group the sampled frames
+    into windows of list_length frames starting every frequency seconds.
+    :return: generator of (start_time, [jpeg bytes]) per window
+    """
+    window_span = list_length * interval
+    window_count = -(-(limit - begin) // frequency)
+    if window_count <= 0:
+        return
+    # the last window may read past limit, exactly like the trim engine
+    input_args = {'t': (window_count - 1) * frequency + window_span}
+    if begin:
+        input_args['ss'] = begin
+
+    stream = build_scaled_stream(open_input(video_path, decode, **input_args), image_size, interval, decode)
+    process = frame_output(stream, encode).run_async(pipe_stdout=True)
+
+    try:
+        # windows overlap when window_span > frequency, a frame then belongs to every window covering it
+        open_windows = deque()
+        opened = 0
+        for index, frame in enumerate(iter_frames(process.stdout, encode)):
+            # the fps filter emits frame n at n * interval after begin
+            frame_time = index * interval
+            while opened < window_count and opened * frequency <= frame_time + 1e-6:
+                open_windows.append((opened, []))
+                opened += 1
+            # all windows have the same span, so they end in the order they started
+            while open_windows and frame_time >= open_windows[0][0] * frequency + window_span - 1e-6:
+                window, frames = open_windows.popleft()
+                yield begin + window * frequency, frames
+            if not open_windows and opened >= window_count:
+                break
+            for _, frames in open_windows:
+                if len(frames) < list_length:
+                    frames.append(frame)
+
+        # the video ended before the last windows were filled
+        while open_windows:
+            window, frames = open_windows.popleft()
+            yield begin + window * frequency, frames
+        for window in range(opened, window_count):
+            yield begin + window * frequency, []
+    finally:
+        if process.poll() is None:
+            process.kill()
+        process.stdout.close()
+        process.wait()
+
+
+def read_showinfo_times(stderr, frame_times):
+    """
+    Collect the pts_time of every frame reported by the showinfo filter on ffmpeg's stderr.
+    """
+    for line in iter(stderr.readline, b''):
+        match = SHOWINFO_PTS_TIME.search(line)
+        if match:
+            frame_times.put(float(match.group(1)))
+    frame_times.put(None)
+
+
+def adaptive_windows(video_path, frequency, list_length, limit, image_size, scene_threshold=0.08, min_interval=1.0,
+                     max_interval=60.0, begin=0, decode=None, encode=None):
+    """
+    Adaptive engine: decode the video once and only emit a frame when the picture changes.
+    A frame is kept when its scene score exceeds scene_threshold and at least min_interval seconds passed since
+    the last kept frame (ceiling rate), or when max_interval seconds passed without one (floor rate).
+    Windows without any kept frame are skipped.
+    :return: generator of (start_time, [jpeg bytes]) for windows that have frames
+    """
+    # ffmpeg-python escapes commas in filter arguments, so the filter chain is written by hand
+    select_expression = (f'gt(isnan(prev_selected_t)+gte(t-prev_selected_t,{max_interval})'
+                         f'+gt(scene,{scene_threshold})*gte(t-prev_selected_t,{min_interval}),0)')
+    filters = []
+    if image_size != 'raw':
+        width, height = image_size.split('*')
+        scale_flags = f":flags={decode['scale_flags']}" if decode and decode['scale_flags'] else ''
+        filters.append(f'scale={width}:{height}{scale_flags}')
+    filters += [f"select='{select_expression}'", 'showinfo']
+
+    input_args = open_input(video_path, decode, t=limit - begin, **({'ss': begin} if begin else {})).node.kwargs
+    command = ['ffmpeg', '-hide_banner']
+    for key, value in input_args.items():
+        command += [f'-{key}', str(value)]
+    command += ['-i', video_path, '-vf', ','.join(filters), '-vsync', 'vfr', '-f', 'image2pipe']
+    for key, value in (encode or DEFAULT_ENCODE)['output_args'].items():
+        command += [f'-{key}', str(value)]
+    command.append('pipe:')
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    frame_times = queue.Queue()
+    reader = threading.Thread(target=read_showinfo_times, args=(process.stderr, frame_times), daemon=True)
+    reader.start()
+
+    try:
+        current = None
+        frames = []
+        for frame in iter_frames(process.stdout, encode):
+            frame_time = frame_times.get()
+            if frame_time is None:
+                break
+            window = int((frame_time + 1e-6) // frequency)
+            if window != current:
+                if frames:
+                    yield begin + current * frequency, frames
+                current = window
+                frames = []
+            if len(frames) < list_length:
+                frames.append(frame)
+        if frames:
+            yield begin + current * frequency, frames
+    finally:
+        if process.poll() is None:
+            process.kill()
+        process.stdout.close()
+        process.wait()
+        reader.join()
+        process.stderr.close()
+
+
+def kvs_schedule(frequency, cycle_limit, ingest_delay=KVS_INGEST_DELAY):
+    """
+    Fixed cadence scheduler for KVS extraction. Cycle n starts n * frequency seconds after the first one on the
+    monotonic clock, so the time spent fetching, uploading and invoking does not push the following cycles back.
+    A cycle that overran its slot lets the next one start right away rather than skipping it.
+    :return: generator of (cycle index, end of the footage to fetch as UTC datetime)
+    """
+    started = time.monotonic()
+    first_end = datetime.now(timezone.utc) - timedelta(seconds=ingest_delay)
+    for cycle in range(cycle_limit):
+        delay = started + cycle * frequency - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        yield cycle, first_end + timedelta(seconds=cycle * frequency)
+
+
+def fetch_kvs_frames(archived_media_client, stream_name, start_time, end_time, interval, max_frames,
+                     image_size='raw', encode=None):
+    """
+    Fetch the last max_frames JPEG frames sampled every interval seconds between start_time and end_time,
+    following NextToken since GetImages returns at most GET_IMAGES_PAGE_SIZE images per page.
+    Only the kept frames are base64-decoded.
+    :param encode: only its quality level is used, GetImages always returns JPEG
+    :return: generator of (server timestamp, jpeg bytes)
+    """
+    request = {
+        'StreamName': stream_name,
+        'ImageSelectorType': 'SERVER_TIMESTAMP',
+        'SamplingInterval': int(interval * 1000),
+        'StartTimestamp': start_time,
+        'EndTimestamp': end_time,
+        'Format': 'JPEG',
+        'MaxResults': GET_IMAGES_PAGE_SIZE
+    }
+    if image_size != 'raw':
+        width, height = image_size.split('*')
+        request['WidthPixels'] = int(width)
+        # with WidthPixels only, KVS keeps the aspect ratio of the stream
+        if int(height) > 0:
+            request['HeightPixels'] = int(height)
+    if encode:
+        request['FormatConfig'] = {'JPEGQuality': str(QUALITY_LEVELS[encode['level']]['quality'])}
+
+    # the most recent frames are kept when the window holds more sampling points than max_frames
+    images = deque(maxlen=max_frames)
+    while True:
+        response = archived_media_client.get_images(**request)
+        # sampling points without media carry an Error instead of ImageContent
+        images.extend(image for image in response['Images'] if 'ImageContent' in image)
+        if not response.get('NextToken'):
+            break
+        request['NextToken'] = response['NextToken']
+
+    for image in images:
+        yield image['TimeStamp'], base64.b64decode(image['ImageContent'])
+
+
+def feed_stdin(stdin, media, chunk_size=1024 * 1024):
+    """
+    Copy a media payload into ffmpeg's stdin, run in its own thread so ffmpeg's stdout keeps being drained.
+    """
+    if isinstance(media, (bytes, bytearray)):
+        media = io.BytesIO(media)
+    try:
+        for chunk in iter(lambda: media.read(chunk_size), b''):
+            stdin.write(chunk)
+    except BrokenPipeError:
+        # ffmpeg was stopped once enough frames were decoded
+        pass
+    finally:
+        try:
+            stdin.close()
+        except BrokenPipeError:
+            pass
+
+
+def decode_media_frames(media, interval, image_size, max_frames=None, encode=None):
+    """
+    Decode a video payload locally with ffmpeg, e.g. a KVS GetClip MP4 or a GetMedia MKV, sampling one
+    frame every interval seconds (sub-second intervals work) scaled to image_size.
+    The container is detected by ffmpeg, so a local MKV fixture exercises the same path as a live stream.
+    :param media: local file path, or bytes / a readable binary stream fed to ffmpeg through stdin
+    :param max_frames: stop decoding after this many frames
+    :return: list of image bytes
+    """
+    source = media if isinstance(media, str) else 'pipe:'
+    stream = build_scaled_stream(ffmpeg.input(source), image_size, interval)
+    process = frame_output(stream, encode).run_async(pipe_stdin=source == 'pipe:', pipe_stdout=True)
+    feeder = None
+    if source == 'pipe:':
+        feeder = threading.Thread(target=feed_stdin, args=(process.stdin, media), daemon=True)
+        feeder.start()
+
+    frames = []
+    try:
+        for frame in iter_frames(process.stdout, encode):
+            frames.append(frame)
+            if max_frames and len(frames) >= max_frames:
+                break
+    finally:
+        if process.poll() is None:
+            process.kill()
+        process.stdout.close()
+        process.wait()
+        if feeder is not None:
+            feeder.join()
+    return frames
+
+
+def fetch_kvs_clip_frames(archived_media_client, stream_name, start_time, end_time, interval, max_frames,
+                          image_size='raw', encode=None):
+    """
+    Alternative to fetch_kvs_frames: download the window as one GetClip MP4 and decode it locally instead of
+    having KVS encode every JPEG server side. Same arguments and output, so the two are interchangeable.
+    The clip starts at the fragment holding start_time, so frame timestamps are estimated from start_time.
+    :return: generator of (estimated timestamp, image bytes)
+    """
+    response = archived_media_client.get_clip(
+        StreamName=stream_name,
+        ClipFragmentSelector={
+            'FragmentSelectorType': 'SERVER_TIMESTAMP',
+            'TimestampRange': {'StartTimestamp': start_time, 'EndTimestamp': end_time}
+        }
+    )
+    frames = decode_media_frames(response['Payload'], interval, image_size, max_frames, encode)
+    for index, frame in enumerate(frames):
+        yield start_time + timedelta(seconds=index * interval), frame
+
+
+# task settings copied into every analysis request, named as in the frame extraction request
+ANALYSIS_TASK_FIELDS = ('system_prompt', 'user_prompt', 'model_id', 'temperature', 'top_p', 'top_k', 'max_tokens',
+                        'user_id', 'video_source_type', 'video_source_content', 'connection_id')
+
+
+def build_analysis_request(task, image_path, start_time, window_fields=None, delivery_fields=None, hashes=None,
+                           dedup_threshold=-1, tag=None):
+    """
+    Build the request video_analysis receives for one window.
+    :param task: ANALYSIS_TASK_FIELDS and the task_id, the frame extraction request itself can be passed
+    :param start_time: seconds into an S3 video, or the server timestamp of a KVS window
+    :param window_fields: prepare_window output
+    :param delivery_fields: deliver_window output
+    :param hashes: per frame dHash, lets video_analysis reuse the result of a near-identical window
+    :param tag: 'end' on the last window of the task
+    """
+    analysis_request = {
+        'system_prompt': task['system_prompt'],
+        'user_prompt': task['user_prompt'],
+        'model_id': task['model_id'],
+        'temperature': float(task['temperature']),
+        'top_p': float(task['top_p']),
+        'top_k': int(task['top_k']),
+        'max_tokens': int(task['max_tokens']),
+        'image_path': image_path,
+        'start_time': start_time.strftime('%Y-%m-%d-%H:%M:%S') if isinstance(start_time, datetime) else start_time,
+        'user_id': task['user_id'],
+        'task_id': task['task_id'],
+        'video_source_type': task['video_source_type'],
+        'video_source_content': task['video_source_content'],
+        'connection_id': task['connection_id']
+    }
+    analysis_request.update(window_fields or {})
+    analysis_request.update(delivery_fields or {})
+    if hashes:
+        analysis_request['frame_hashes'] = hashes
+        analysis_request['dedup_threshold'] = dedup_threshold
+    if tag:
+        analysis_request['tag'] = tag
+    return analysis_request
+
+
+def build_end_request(task):
+    """
+    Build a request that only closes the task, for when no window is left to carry the end tag, e.g. the last
+    shard to finish extracted nothing or failed.
+    :param task: same as for build_analysis_request
+    """
+    end_request = build_analysis_request(task, None, None, tag='end')
+    end_request['end_only'] = True
+    return end_request
+
+
+def send_analysis_request(lambda_client, sqs_client, video_analysis_lambda, analysis_request,
+                          queue_url=ANALYSIS_QUEUE_URL, state_table=None):
+    """
+    Hand a window over to the analysis stage. With an analysis queue the window waits there until video_analysis
+    picks it up in a batch and runs it within its per-model concurrency limits; without one, video_analysis is
+    invoked asynchronously for the window.
+    :param sqs_client: only used with a queue_url
+    :param state_table: DynamoDB task state table, the window is registered there once sent
+    """
+    payload = json.dumps(analysis_request)
+    if queue_url:
+        sqs_client.send_message(QueueUrl=queue_url, MessageBody=payload)
+    else:
+        lambda_client.invoke(
+            FunctionName=video_analysis_lambda,
+            InvocationType='Event',
+            Payload=bytes(payload, encoding='utf-8')
+        )
+    if state_table is not None and not analysis_request.get('end_only'):
+        register_window(state_table, analysis_request['task_id'], analysis_request['start_time'])
+
+
+def register_window(table, task_id, window_id):
+    """
+    Record a window as sent to the analysis stage. Queued windows can be analysed after the one tagged 'end',
+    so video_analysis only summarises the task once every registered window is done. Registering after the
+    send keeps a window that failed to send from holding the summary back forever.
+    :param window_id: start_time of the window, the same id video_analysis records when it is done
+    """
+    # a string set keeps retried windows from being counted twice
+    table.update_item(
+        Key={'task_id': task_id, 'state_key': 'windows'},
+        UpdateExpression='ADD windows_sent :window',
+        ExpressionAttributeValues={':window': {str(window_id)}}
+    )
+
+
+def load_checkpoint(table, task_id, checkpoint_key='checkpoint'):
+    """
+    Read where a previous run of the task stopped.
+    :param table: DynamoDB task state table
+    :return: start time of the first window not dispatched yet, None for a new task
+    """
+    item = table.get_item(Key={'task_id': task_id, 'state_key': checkpoint_key}).get('Item')
+    return int(item['next_start']) if item else None
+
+
+def save_checkpoint(table, task_id, next_start, checkpoint_key='checkpoint'):
+    """
+    Record that every window starting before next_start has been dispatched to the analysis stage.
+    A restarted run resumes from there; at most the window in flight when it stopped is analysed twice, and
+    its result row is overwritten since the row key is the video time.
+    """
+    table.put_item(Item={
+        'task_id': task_id,
+        'state_key': checkpoint_key,
+        'next_start': int(next_start),
+        'updated_at': datetime.now(timezone.utc).isoformat()
+    })
@@ -1,47 +1,87 @@
 import os
 import json
 import boto3
-import time
 import math
-import base64
 import ffmpeg
 import logging
 import shutil
 from datetime import datetime, timedelta
-from pathlib import Path
+from botocore.config import Config
+from extraction_utils import (FrameUploader, adaptive_windows, build_analysis_request, build_end_request,
+                              decode_settings, deliver_window, encode_settings, fetch_kvs_clip_frames, fetch_kvs_frames,
+                              frame_hashes, kvs_schedule, load_checkpoint, plan_image_size, prepare_window,
+                              resolve_video_input, save_checkpoint, seek_windows, send_analysis_request, stream_windows,
+                              trim_windows)
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-s3 = boto3.client('s3')
+s3 = boto3.client('s3', config=Config(max_pool_connections=20))
 lambda_client = boto3.client('lambda')
+sqs = boto3.client('sqs')
 kinesisvideo = boto3.client('kinesisvideo')
+dynamodb = boto3.resource('dynamodb')
+# windows are registered in the task state table as they are sent, see register_window
+task_state = dynamodb.Table(os.environ['TASK_STATE_DYNAMODB']) if 'TASK_STATE_DYNAMODB' in os.environ else None
+
+# shared across warm invocations, uploads a window's frames concurrently
+uploader = FrameUploader(s3, max_concurrency=20)
+
+FFMPEG_BINARIES = ('ffmpeg', 'ffprobe')
+
+# hand an S3 task over to a new invocation when less time than this is left
+RESUME_MARGIN_MS = 60 * 1000
+
+
+def is_same_file(source_path, target_path):
+    """
+    Compare size and modification time only, copy2 keeps the mtime so a copy made by an earlier cold start
+    in this execution environment matches without reading the ~200 MB of binaries again.
+    """
+    if not os.path.exists(target_path):
+        return False
+    source, target = os.stat(source_path), os.stat(target_path)
+    return source.st_size == target.st_size and int(source.st_mtime) == int(target.st_mtime)
+
+
+def prepare_ffmpeg_binaries(layer_dir='/opt', tmp_dir='/tmp'):
+    """
+    Make the ffmpeg and ffprobe binaries of the Lambda layer runnable, once per execution environment.
+    They are exec'd in place when the layer kept their exec bit, otherwise copied to tmp_dir, reusing a
+    copy already there when its size and modification time match.
+    :return: directory holding the runnable binaries, prepended to PATH, None when the layer is not attached
+    """
+    if not all(os.path.exists(os.path.join(layer_dir, name)) for name in FFMPEG_BINARIES):
+        logger.warning(f'ffmpeg layer not found in {layer_dir}, using the binaries on PATH')
+        return None
+    if all(os.access(os.path.join(layer_dir, name), os.X_OK) for name in FFMPEG_BINARIES):
+        bin_dir = layer_dir
+    else:
+        bin_dir = tmp_dir
+        for name in FFMPEG_BINARIES:
+            source_path = os.path.join(layer_dir, name)
+            target_path = os.path.join(tmp_dir, name)
+            if not is_same_file(source_path, target_path):
+                logger.info(f'Copying {source_path} to {target_path}')
+                shutil.copy2(source_path, target_path)
+            os.chmod(target_path, 0o755)
+
+    current_path = os.environ.get('PATH', '')
+    if bin_dir not in current_path.split(os.pathsep):
+        os.environ['PATH'] = bin_dir + os.pathsep + current_path
+    return bin_dir
+
+
+# runs on cold start only, warm invocations find the binaries ready
+prepare_ffmpeg_binaries()
 
 
 def lambda_handler(event, context):
     logger.info('frame_extraction: {}'.format(event))
 
-    # Set the path to the ffmpeg binary in the Lambda layer
-    ffmpeg_binary_path = '/opt/ffmpeg'
-    ffprobe_binary_path = '/opt/ffprobe'
-
-    # Copy the ffmpeg binary to a writable directory
     tmp_dir = '/tmp'
-    os.makedirs(tmp_dir, exist_ok=True)
-    tmp_ffmpeg_path = os.path.join(tmp_dir, 'ffmpeg')
-    shutil.copy(ffmpeg_binary_path, tmp_ffmpeg_path)
-    os.chmod(Path(tmp_ffmpeg_path), 0o755)
-    tmp_ffprobe_path = os.path.join(tmp_dir, 'ffprobe')
-    shutil.copy(ffprobe_binary_path, tmp_ffprobe_path)
-    os.chmod(Path(tmp_ffprobe_path), 0o755)
-
-    # Add tmp folder the PATH env var
-    current_path = os.environ.get('PATH', '')
-    new_path = tmp_dir + os.pathsep + current_path
-    os.environ['PATH'] = new_path
 
-    # context params
-    connection_id = event['connection_id']
+    # context params, the prompt and model settings are copied into each analysis request as they are
     video_analysis_lambda = event['video_analysis_lambda']
     user_id = event['user_id']
 
@@ -57,197 +97,303 @@ def lambda_handler(event, context):
     interval = float(event['interval'])
     duration = int(event['duration'])
     image_size = event['image_size']
+    extraction_engine = event.get('extraction_engine', 'stream')
+    seek_accuracy = event.get('seek_accuracy', 'exact')
+    shard_duration = int(event.get('shard_duration', 0))
+    input_mode = event.get('input_mode', 'url')
+    frame_delivery = event.get('frame_delivery', 'direct')
+    archive_frames = event.get('archive_frames', 'Y') == 'Y'
+    sampling_mode = event.get('sampling_mode', 'fixed')
+    scene_threshold = float(event.get('scene_threshold', 0.08))
+    min_interval = float(event.get('min_interval', interval))
+    max_interval = float(event.get('max_interval', 60))
+    dedup_threshold = int(event.get('dedup_threshold', -1))
+    kvs_engine = event.get('kvs_engine', 'images')
+    decode_profile = event.get('decode_profile', 'default')
+    frame_mosaic = event.get('frame_mosaic', 'N') == 'Y'
+    frame_format = event.get('frame_format', 'jpeg')
+    frame_quality = event.get('frame_quality', 'auto')
+    shard = event.get('shard')
 
     # LLM params
-    system_prompt = event['system_prompt']
-    user_prompt = event['user_prompt']
     model_id = event['model_id']
-    temperature = float(event['temperature'])
-    top_p = float(event['top_p'])
-    top_k = int(event['top_k'])
-    max_tokens = int(event['max_tokens'])
 
     # KVS frame extraction
     if video_source_type == 'kvs':
         task_timestamp = datetime.now().strftime('%Y-%m%d-%H%M%S')
         cycle_limit = int(duration / frequency)
-        cycle_count = 0
-        gap_time = list_length * interval + 4
+        window_span = timedelta(seconds=list_length * interval)
+        # server timestamp just past the last frame returned, frames before it are never fetched again
+        cursor = None
+
+        # 'images' lets KVS encode JPEGs with GetImages, 'clip' downloads GetClip media and decodes it locally
+        fetch_frames = fetch_kvs_clip_frames if kvs_engine == 'clip' else fetch_kvs_frames
+        # 'auto' sizes frames for the model, only the width is known without probing the stream
+        image_size, image_tokens = plan_image_size(image_size, model_id)
+        logger.info(f'Frame size {image_size}, about {image_tokens * list_length} image tokens per window')
+        # GetImages only returns JPEG, frame_format applies to frames decoded locally
+        encode = encode_settings(frame_format if kvs_engine == 'clip' else 'jpeg', frame_quality, model_id,
+                                 list_length, image_size)
 
         # get kvs information
         kvs_endpoint = kinesisvideo.get_data_endpoint(
             StreamName=video_source_content,
-            APIName='GET_IMAGES'
+            APIName='GET_CLIP' if kvs_engine == 'clip' else 'GET_IMAGES'
         ).get('DataEndpoint')
         kinesis_video_archived_media = boto3.client('kinesis-video-archived-media', endpoint_url=kvs_endpoint)
 
-        # start extract frames
-        while cycle_count < cycle_limit:
-            timestamp = datetime.now().strftime('%Y-%m%d-%H%M%S')
-            end_time = datetime.now()
-            start_time = end_time - timedelta(seconds=gap_time)
+        # start extract frames, cycles run on a fixed cadence whatever each one costs
+        for cycle_count, end_time in kvs_schedule(frequency, cycle_limit):
+            start_time = end_time - window_span
+            if cursor is not None and cursor > start_time:
+                start_time = cursor
             try:
-                if image_size != 'raw':
-                    width, height = image_size.split('*')
-                    frame_response = kinesis_video_archived_media.get_images(
-                        StreamName=video_source_content,
-                        ImageSelectorType='SERVER_TIMESTAMP',
-                        SamplingInterval=int(interval * 1000),
-                        StartTimestamp=start_time,
-                        EndTimestamp=end_time,
-                        Format='JPEG',
-                        WidthPixels=int(width),
-                        HeightPixels=int(height)
-                    )
-                else:
-                    frame_response = kinesis_video_archived_media.get_images(
-                        StreamName=video_source_content,
-                        ImageSelectorType='SERVER_TIMESTAMP',
-                        SamplingInterval=int(interval * 1000),
-                        StartTimestamp=start_time,
-                        EndTimestamp=end_time,
-                        Format='JPEG'
-                    )
-                image_contents_raw = [image['ImageContent'] for image in frame_response['Images'] if
-                                      'ImageContent' in image]
-
-                # get image list on demand
-                image_files_raw = image_contents_raw[-1 * list_length:]
-                for index, image_file_raw in enumerate(image_files_raw):
-                    with open(os.path.join(tmp_dir, f'{timestamp}_{index}.jpg'), "wb") as image_file:
-                        image_file.write(base64.decodebytes(bytes(image_file_raw, 'utf-8')))
-                        image_file.close()
-
-                # retrieve all jpg files from current directory
-                image_files = [f for f in os.listdir(tmp_dir) if f.endswith('.jpg')]
-
-                # list all images and upload to S3
-                task_id = f'task_{task_timestamp}'
-                image_folder = f'{video_source_type}_extract_{timestamp}_{start_time}'
+                # request exactly the list_length frames of the window
+                frames = []
+                frame_times = []
+                for frame_timestamp, frame in fetch_frames(kinesis_video_archived_media, video_source_content,
+                                                           start_time, end_time, interval, list_length, image_size,
+                                                           encode):
+                    frames.append(frame)
+                    frame_times.append(frame_timestamp)
+                    cursor = frame_timestamp + timedelta(milliseconds=1)
+                # optionally tile the window into mosaic images before inference
+                frames, frame_times, window_fields = prepare_window(frames, frame_times, frame_mosaic, model_id,
+                                                                    image_size, encode)
+
+                # perceptual hashes let video_analysis reuse the result of a near-identical window
+                hashes = frame_hashes(frames, encode) if dedup_threshold >= 0 and frames else None
+
+                # upload all images to S3, keys only depend on the task and the window
+                task_id = event.get('task_id') or f'task_{task_timestamp}'
+                image_folder = f'{video_source_type}_extract_{start_time:%Y-%m-%d %H:%M:%S.%f}'
                 image_path = f'{user_id}/{task_id}/{image_folder}'
-                for image_file in image_files:
-                    file_path = os.path.join(tmp_dir, image_file)
-                    object_key = f'{image_path}/{image_file}'
-                    s3.upload_file(file_path, video_info_bucket_name, object_key)
-                    logger.info(f'Successfully uploaded {image_file} to {video_info_bucket_name}/{object_key}')
-
-                # clear all images under current directory for next round extraction
-                for image_file in image_files:
-                    os.remove(os.path.join(tmp_dir, image_file))
+                delivery_fields, upload_futures = deliver_window(uploader, frames, video_info_bucket_name, image_path,
+                                                                 frame_delivery, archive_frames, encode, frame_times,
+                                                                 hashes)
+                uploader.wait(upload_futures)
 
                 # construct request and invoke analysis lambda
-                analysis_request = {
-                    'system_prompt': system_prompt,
-                    'user_prompt': user_prompt,
-                    'model_id': model_id,
-                    'temperature': temperature,
-                    'top_p': top_p,
-                    'top_k': top_k,
-                    'max_tokens': max_tokens,
-                    'image_path': image_path,
-                    'start_time': start_time.strftime('%Y-%m-%d-%H:%M:%S'),
-                    'user_id': user_id,
-                    'task_id': task_id,
-                    'video_source_type': video_source_type,
-                    'video_source_content': video_source_content,
-                    'connection_id': connection_id
-                }
-                cycle_count += 1
-                if cycle_count >= cycle_limit:
-                    analysis_request.update({'tag': 'end'})
+                analysis_request = build_analysis_request(
+                    dict(event, task_id=task_id), image_path, start_time, window_fields, delivery_fields, hashes,
+                    dedup_threshold, tag='end' if cycle_count == cycle_limit - 1 else None)
 
                 logger.info(f'Analysis request: {analysis_request}')
-                lambda_client.invoke(
-                    FunctionName=video_analysis_lambda,
-                    InvocationType='Event',
-                    Payload=bytes(json.dumps(analysis_request), encoding='utf-8')
-                )
+                send_analysis_request(lambda_client, sqs, video_analysis_lambda, analysis_request,
+                                      state_table=task_state)
 
             except kinesisvideo.exceptions.ResourceNotFoundException:
                 logger.warning(f"No fragments found in the stream for cycle {cycle_count}. Skipping this cycle.")
-                cycle_count += 1
             except Exception as e:
                 logger.exception(f'Exception during KVS frame extraction in cycle {cycle_count}: {str(e)}')
-            finally:
-                time.sleep(frequency)
 
     # S3 frame extraction
     elif video_source_type == 's3':
-        # download video file from S3
-        s3.download_file(video_upload_bucket_name, video_source_content, '/tmp/video.mp4')
-        original_stream = ffmpeg.input('/tmp/video.mp4')
+        # coordinator: split long videos into time range shards handled by their own invocations
+        if shard_duration > 0 and shard is None:
+            try:
+                if dispatch_shards(event, context, video_upload_bucket_name, video_source_content, frequency,
+                                   duration, shard_duration):
+                    return
+            except Exception:
+                logger.exception('Exception during S3 frame extraction sharding')
+                return
 
+        task_timestamp = datetime.now().strftime('%Y-%m%d-%H%M%S')
+        task_id = event.get('task_id') or f'task_{task_timestamp}'
+        # retries and resumed invocations keep the task id, and with it the checkpoint
+        event['task_id'] = task_id
+        state_table = dynamodb.Table(os.environ['TASK_STATE_DYNAMODB'])
+        checkpoint_key = 'checkpoint' if shard is None else f"checkpoint#{shard['index']}"
+        pending = None
+        handed_over = False
+        completed = False
         try:
-            probe = ffmpeg.probe('/tmp/video.mp4')
+            # stream the object through a presigned URL unless input_mode is 'download'
+            video_path = resolve_video_input(s3, video_upload_bucket_name, video_source_content, input_mode)
+            probe = ffmpeg.probe(video_path)
             original_stream_duration = math.floor(float(probe['format']['duration']))
-
-            task_timestamp = datetime.now().strftime('%Y-%m%d-%H%M%S')
-            start_time = 0
-            while start_time < duration and start_time < original_stream_duration:
-                # trim video start/end time
-                start_time_trim = start_time
-                end_time_trim = start_time + list_length * interval
-                stream = ffmpeg.trim(original_stream, start=start_time_trim, end=end_time_trim)
-
-                # apply output scale and fps filter
-                if image_size != 'raw':
-                    width, height = image_size.split('*')
-                    stream = ffmpeg.filter(stream, 'scale', w=width, h=height)
-                stream = ffmpeg.filter(stream, 'fps', f'1/{interval}')
-
-                # set output config
-                timestamp = datetime.now().strftime('%Y-%m%d-%H%M%S')
-                stream = ffmpeg.output(stream, os.path.join(tmp_dir, f'{timestamp}_%02d.jpg'), vsync='vfr', qscale=2,
-                                       f='image2')
-
-                # run ffmpeg
-                ffmpeg.run(stream, overwrite_output=True)
-
-                # retrieve all jpg files from current directory
-                image_files = [f for f in os.listdir(tmp_dir) if f.endswith('.jpg')]
-
-                # list all images and upload to S3
-                task_id = f'task_{task_timestamp}'
-                image_folder = f'{video_source_type}_extract_{timestamp}_{start_time}'
+            limit = min(duration, original_stream_duration)
+            begin = 0
+            if shard is not None:
+                begin = int(shard['start'])
+                limit = min(limit, int(shard['end']))
+
+            checkpoint = load_checkpoint(state_table, task_id, checkpoint_key)
+            if checkpoint is not None and checkpoint > begin:
+                logger.info(f'Resuming task {task_id} at {checkpoint}s')
+                begin = checkpoint
+            image_size, image_tokens = plan_image_size(image_size, model_id, probe)
+            logger.info(f'Frame size {image_size}, about {image_tokens * list_length} image tokens per window')
+            decode = decode_settings(decode_profile, probe, image_size)
+            encode = encode_settings(frame_format, frame_quality, model_id, list_length, image_size, probe)
+
+            # 'scene' sampling keeps frames on visual change instead of a fixed interval,
+            # 'stream' decodes the whole video once, 'seek' seeks on the input per window,
+            # 'trim' runs one ffmpeg trim per window
+            if sampling_mode == 'scene':
+                windows = adaptive_windows(video_path, frequency, list_length, limit, image_size, scene_threshold,
+                                           min_interval, max_interval, begin=begin, decode=decode, encode=encode)
+            elif extraction_engine == 'trim':
+                windows = trim_windows(video_path, tmp_dir, frequency, list_length, interval, limit,
+                                       image_size, begin=begin, decode=decode, encode=encode)
+            elif extraction_engine == 'seek':
+                windows = seek_windows(video_path, frequency, list_length, interval, limit, image_size,
+                                       seek_accuracy, begin=begin, decode=decode, encode=encode)
+            else:
+                windows = stream_windows(video_path, frequency, list_length, interval, limit, image_size,
+                                         begin=begin, decode=decode, encode=encode)
+
+            for start_time, frames in windows:
+                # hand over to a new invocation before the timeout, it resumes at this window
+                if context.get_remaining_time_in_millis() < RESUME_MARGIN_MS:
+                    if pending is not None:
+                        dispatch_analysis(video_analysis_lambda, *pending)
+                    save_checkpoint(state_table, task_id, start_time, checkpoint_key)
+                    windows.close()
+                    logger.info(f'Handing task {task_id} over to a new invocation at {start_time}s')
+                    lambda_client.invoke(
+                        FunctionName=context.invoked_function_arn,
+                        InvocationType='Event',
+                        Payload=bytes(json.dumps(event), encoding='utf-8')
+                    )
+                    handed_over = True
+                    return
+
+                # optionally tile the window into mosaic images before inference, scene sampling has no
+                # fixed frame times so its frames are labelled by position
+                frame_times = None if sampling_mode == 'scene' else [start_time + index * interval
+                                                                     for index in range(len(frames))]
+                frames, frame_times, window_fields = prepare_window(frames, frame_times, frame_mosaic, model_id,
+                                                                    image_size, encode, probe)
+
+                # perceptual hashes let video_analysis reuse the result of a near-identical window
+                hashes = frame_hashes(frames, encode) if dedup_threshold >= 0 and frames else None
+
+                # start uploading the images to S3 in the background, keys only depend on the task and the window
+                # so a resumed or retried run overwrites them
+                image_folder = f'{video_source_type}_extract_{start_time}'
                 image_path = f'{user_id}/{task_id}/{image_folder}'
-                for image_file in image_files:
-                    file_path = os.path.join(tmp_dir, image_file)
-                    object_key = f'{image_path}/{image_file}'
-                    s3.upload_file(file_path, video_info_bucket_name, object_key)
-                    logger.info(f'Successfully uploaded {image_file} to {video_info_bucket_name}/{object_key}')
-
-                # clear all images under current directory for next round extraction
-                for image_file in image_files:
-                    os.remove(os.path.join(tmp_dir, image_file))
+                delivery_fields, upload_futures = deliver_window(uploader, frames, video_info_bucket_name, image_path,
+                                                                 frame_delivery, archive_frames, encode, frame_times,
+                                                                 hashes)
 
                 # construct request and invoke analysis lambda
-                analysis_request = {
-                    'system_prompt': system_prompt,
-                    'user_prompt': user_prompt,
-                    'model_id': model_id,
-                    'temperature': temperature,
-                    'top_p': top_p,
-                    'top_k': top_k,
-                    'max_tokens': max_tokens,
-                    'image_path': image_path,
-                    'start_time': start_time,
-                    'user_id': user_id,
-                    'task_id': task_id,
-                    'video_source_type': video_source_type,
-                    'video_source_content': video_source_content,
-                    'connection_id': connection_id
-                }
-
-                start_time += frequency
-                if start_time >= duration or start_time >= original_stream_duration:
-                    analysis_request.update({'tag': 'end'})
+                analysis_request = build_analysis_request(event, image_path, start_time, window_fields,
+                                                          delivery_fields, hashes, dedup_threshold)
 
-                logger.info(f'Analysis request: {analysis_request}')
-                lambda_client.invoke(
-                    FunctionName=video_analysis_lambda,
-                    InvocationType='Event',
-                    Payload=bytes(json.dumps(analysis_request), encoding='utf-8')
-                )
+                # dispatch the previous window, its uploads overlapped with decoding this one
+                if pending is not None:
+                    dispatch_analysis(video_analysis_lambda, *pending)
+                    save_checkpoint(state_table, task_id, start_time, checkpoint_key)
+                pending = (analysis_request, upload_futures)
+
+            completed = True
 
         except Exception:
             logger.exception('Exception during S3 frame extraction')
+
+        finally:
+            # a shard that failed still counts as finished, otherwise no shard would ever close the task
+            if not handed_over:
+                try:
+                    finish_extraction(video_analysis_lambda, event, shard, pending)
+                    if completed:
+                        save_checkpoint(state_table, task_id, limit, checkpoint_key)
+                except Exception:
+                    logger.exception('Exception while finishing S3 frame extraction')
+
+
+def dispatch_analysis(video_analysis_lambda, analysis_request, upload_futures):
+    """
+    Wait for the frames of a window to be in S3, then invoke the analysis lambda
+    """
+    uploader.wait(upload_futures)
+    logger.info(f'Analysis request: {analysis_request}')
+    send_analysis_request(lambda_client, sqs, video_analysis_lambda, analysis_request, state_table=task_state)
+
+
+def finish_extraction(video_analysis_lambda, event, shard, pending):
+    """
+    Dispatch the window held back by the extraction loop and close the task.
+    The last yielded window closes the task, scene sampling skips windows without changes so it is not
+    necessarily the one at limit. A shard dispatches its last window first and then records itself as
+    finished, the last shard to finish closes the task with an end-only request, after every shard
+    registered all of its windows.
+    :param pending: (analysis request, upload futures) of the last window, None when there is none
+    """
+    if shard is None:
+        if pending is not None:
+            pending[0]['tag'] = 'end'
+            dispatch_analysis(video_analysis_lambda, *pending)
+            return
+    else:
+        if pending is not None:
+            dispatch_analysis(video_analysis_lambda, *pending)
+        if not complete_shard(event['task_id'], shard):
+            return
+    logger.info(f"Closing task {event['task_id']} with an end-only request")
+    send_analysis_request(lambda_client, sqs, video_analysis_lambda, build_end_request(event))
+
+
+def dispatch_shards(event, context, bucket_name, key, frequency, duration, shard_duration):
+    """
+    Probe the video once and invoke this function once per time range shard
+    :param shard_duration: seconds of video per shard, rounded to whole windows
+    :return: False if the video fits in a single shard and should be extracted by this invocation
+    """
+    # ffprobe only needs the container index, read it through a presigned URL instead of downloading
+    video_url = resolve_video_input(s3, bucket_name, key, 'url', expires_in=600)
+    probe = ffmpeg.probe(video_url)
+    limit = min(duration, math.floor(float(probe['format']['duration'])))
+
+    shard_span = max(1, shard_duration // frequency) * frequency
+    shard_starts = list(range(0, limit, shard_span))
+    if len(shard_starts) <= 1:
+        return False
+
+    task_timestamp = datetime.now().strftime('%Y-%m%d-%H%M%S')
+    task_id = event.get('task_id') or f'task_{task_timestamp}'
+    # an update keeps shards_done when a retried coordinator dispatches the shards again,
+    # shards that already finished resume at their checkpoint and do nothing
+    dynamodb.Table(os.environ['TASK_STATE_DYNAMODB']).update_item(
+        Key={'task_id': task_id, 'state_key': 'shards'},
+        UpdateExpression='SET shard_count = :count',
+        ExpressionAttributeValues={':count': len(shard_starts)}
+    )
+
+    for index, shard_start in enumerate(shard_starts):
+        shard_request = dict(event)
+        shard_request.update({
+            'task_id': task_id,
+            'shard': {
+                'index': index,
+                'count': len(shard_starts),
+                'start': shard_start,
+                'end': min(shard_start + shard_span, limit)
+            }
+        })
+        logger.info(f'Shard request: {shard_request}')
+        lambda_client.invoke(
+            FunctionName=context.invoked_function_arn,
+            InvocationType='Event',
+            Payload=bytes(json.dumps(shard_request), encoding='utf-8')
+        )
+    return True
+
+
+def complete_shard(task_id, shard):
+    """
+    Record a shard as finished
+    :return: True for exactly one shard, the last one to finish
+    """
+    # a string set keeps the count correct when an invocation is retried
+    response = dynamodb.Table(os.environ['TASK_STATE_DYNAMODB']).update_item(
+        Key={'task_id': task_id, 'state_key': 'shards'},
+        UpdateExpression='ADD shards_done :shard',
+        ExpressionAttributeValues={':shard': {str(shard['index'])}},
+        ReturnValues='ALL_OLD'
+    )
+    done_before = response.get('Attributes', {}).get('shards_done', set())
+    return str(shard['index']) not in done_before and len(done_before) + 1 >= int(shard['count'])
+
@@ -0,0 +1,19 @@
+import os
+import sys
+import importlib.util
+
+import pytest
+
+FUNCTION_DIR = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, FUNCTION_DIR)
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+
+@pytest.fixture(scope='session')
+def frame_extraction():
+    """The function's lambda_function module, loaded under its own name since every function has one."""
+    spec = importlib.util.spec_from_file_location('frame_extraction_lambda',
+                                                  os.path.join(FUNCTION_DIR, 'lambda_function.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,44 @@
+import pytest
+
+
+class FakeTable:
+    """Task state table supporting the ADD update complete_shard makes."""
+
+    def __init__(self):
+        self.items = {}
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues, ReturnValues):
+        assert UpdateExpression == 'ADD shards_done :shard' and ReturnValues == 'ALL_OLD'
+        key = (Key['task_id'], Key['state_key'])
+        old = self.items.get(key)
+        item = dict(old or Key)
+        item['shards_done'] = item.get('shards_done', set()) | ExpressionAttributeValues[':shard']
+        self.items[key] = item
+        return {'Attributes': old} if old else {}
+
+
+@pytest.fixture
+def table(frame_extraction, monkeypatch):
+    table = FakeTable()
+    monkeypatch.setenv('TASK_STATE_DYNAMODB', 'task-state')
+    monkeypatch.setattr(frame_extraction.dynamodb, 'Table', lambda name: table)
+    return table
+
+
+def test_only_the_last_shard_completes_the_task(frame_extraction, table):
+    done = [frame_extraction.complete_shard('task', {'index': index, 'count': 3}) for index in (2, 0, 1)]
+    assert done == [False, False, True]
+
+
+def test_retried_shard_is_counted_once(frame_extraction, table):
+    assert not frame_extraction.complete_shard('task', {'index': 0, 'count': 2})
+    assert not frame_extraction.complete_shard('task', {'index': 0, 'count': 2})
+    assert frame_extraction.complete_shard('task', {'index': 1, 'count': 2})
+    # a retry of the last shard after the task was closed does not close it again
+    assert not frame_extraction.complete_shard('task', {'index': 1, 'count': 2})
+
+
+def test_tasks_are_counted_separately(frame_extraction, table):
+    assert not frame_extraction.complete_shard('task-a', {'index': 0, 'count': 2})
+    assert not frame_extraction.complete_shard('task-b', {'index': 1, 'count': 2})
+    assert table.items[('task-a', 'shards')]['shards_done'] == {'0'}
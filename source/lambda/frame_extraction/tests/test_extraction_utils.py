@@ -0,0 +1,135 @@
+import io
+import base64
+import os
+import shutil
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from extraction_utils import (JPEG_SOI, decode_media_frames, decode_settings, fetch_kvs_clip_frames, fetch_kvs_frames,
+                              plan_image_size, stream_windows, trim_windows)
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+# 12 s of testsrc2 at 64x36, 10 fps
+TESTSRC = os.path.join(FIXTURES, 'testsrc.mp4')
+# 6 s of testsrc2 at 64x36, 10 fps, H.264 in Matroska as returned by KVS GetMedia
+TESTSRC_MKV = os.path.join(FIXTURES, 'testsrc.mkv')
+
+requires_ffmpeg = pytest.mark.skipif(shutil.which('ffmpeg') is None, reason='ffmpeg is not installed')
+
+
+@requires_ffmpeg
+@pytest.mark.parametrize('frequency, list_length, interval, limit, begin', [
+    (2, 2, 1, 10, 0),   # windows back to back
+    (2, 4, 1, 10, 0),   # each frame is shared by two windows
+    (5, 10, 1, 12, 0),  # the last window runs past the end of the video
+    (3, 4, 1, 11, 2),   # starting from a checkpoint
+])
+def test_stream_matches_trim(tmp_path, frequency, list_length, interval, limit, begin):
+    streamed = list(stream_windows(TESTSRC, frequency, list_length, interval, limit, '64*36', begin=begin))
+    trimmed = list(trim_windows(TESTSRC, str(tmp_path), frequency, list_length, interval, limit, '64*36',
+                                begin=begin))
+
+    assert [start for start, _ in streamed] == [start for start, _ in trimmed]
+    assert [len(frames) for _, frames in streamed] == [len(frames) for _, frames in trimmed]
+    assert streamed == trimmed
+
+
+@requires_ffmpeg
+def test_stream_keeps_frames_of_overlapping_windows():
+    windows = list(stream_windows(TESTSRC, 5, 10, 1, 12, '64*36'))
+
+    assert [(start, len(frames)) for start, frames in windows] == [(0, 10), (5, 7), (10, 2)]
+    # the second window starts with the frames the first one ends with
+    assert windows[1][1][:5] == windows[0][1][5:]
+
+
+class FakeArchivedMedia:
+    """GetImages stub returning the sampling points in pages of page_size."""
+
+    def __init__(self, count, page_size=25):
+        self.images = [{'TimeStamp': i, 'ImageContent': base64.b64encode(b'frame%d' % i).decode()} for i in range(count)]
+        # a sampling point without media
+        self.images[1] = {'TimeStamp': 1, 'Error': 'NO_MEDIA'}
+        self.page_size = page_size
+        self.requests = []
+
+    def get_images(self, **request):
+        self.requests.append(dict(request))
+        start = int(request.get('NextToken', 0))
+        response = {'Images': self.images[start:start + self.page_size]}
+        if start + self.page_size < len(self.images):
+            response['NextToken'] = str(start + self.page_size)
+        return response
+
+
+def test_fetch_kvs_frames_keeps_last_frames_across_pages():
+    client = FakeArchivedMedia(60)
+    frames = list(fetch_kvs_frames(client, 'stream', 0, 60, 1, 10))
+    assert [timestamp for timestamp, _ in frames] == list(range(50, 60))
+    assert frames[-1][1] == b'frame59'
+    assert len(client.requests) == 3
+    assert all(request['MaxResults'] <= 100 for request in client.requests)
+
+
+def test_fetch_kvs_frames_skips_points_without_media():
+    frames = list(fetch_kvs_frames(FakeArchivedMedia(5), 'stream', 0, 5, 1, 10))
+    assert [timestamp for timestamp, _ in frames] == [0, 2, 3, 4]
+
+
+@requires_ffmpeg
+def test_decode_media_frames_from_mkv_stream():
+    with open(TESTSRC_MKV, 'rb') as media:
+        frames = decode_media_frames(media, 0.5, '32*18')
+    assert len(frames) == 12
+    assert all(frame.startswith(JPEG_SOI) for frame in frames)
+    # the same frames whether the fixture is read by path or through stdin
+    assert decode_media_frames(TESTSRC_MKV, 0.5, '32*18') == frames
+
+
+class FakeClipMedia:
+    """GetClip stub returning the fixture as the streaming payload."""
+
+    def __init__(self, path):
+        self.path = path
+        self.requests = []
+
+    def get_clip(self, **request):
+        self.requests.append(request)
+        with open(self.path, 'rb') as media:
+            return {'Payload': io.BytesIO(media.read())}
+
+
+@requires_ffmpeg
+def test_fetch_kvs_clip_frames_estimates_timestamps():
+    client = FakeClipMedia(TESTSRC_MKV)
+    start_time = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    frames = list(fetch_kvs_clip_frames(client, 'stream', start_time, start_time + timedelta(seconds=6), 1, 4,
+                                        '32*18'))
+    assert len(frames) == 4
+    assert [timestamp for timestamp, _ in frames] == [start_time + timedelta(seconds=i) for i in range(4)]
+    assert client.requests[0]['ClipFragmentSelector']['TimestampRange']['StartTimestamp'] == start_time
+
+
+LLAMA_MODEL_ID = 'us.meta.llama3-2-11b-instruct-v1:0'
+PROBE_1080P = {'streams': [{'codec_type': 'video', 'width': 1920, 'height': 1080}]}
+
+
+def test_raw_frames_are_capped_for_llama():
+    assert plan_image_size('raw', LLAMA_MODEL_ID, PROBE_1080P)[0] == '560*314'
+    # KVS: the width is planned and the height follows the stream
+    assert plan_image_size('raw', LLAMA_MODEL_ID)[0] == '560*-2'
+
+
+def test_raw_frames_are_kept_for_other_models():
+    assert plan_image_size('raw', 'anthropic.claude-3-sonnet-20240229-v1:0', PROBE_1080P)[0] == 'raw'
+    assert plan_image_size('640*480', LLAMA_MODEL_ID, PROBE_1080P)[0] == '640*480'
+
+
+def test_fast_decode_downscales_in_the_decoder_only_for_lowres_codecs():
+    mpeg4 = {'streams': [{'codec_type': 'video', 'codec_name': 'mpeg4', 'width': 1920, 'height': 1080}]}
+    h264 = {'streams': [{'codec_type': 'video', 'codec_name': 'h264', 'width': 1920, 'height': 1080}]}
+    assert decode_settings('fast', mpeg4, '480*270')['input_args'] == {'threads': 0, 'lowres': 2}
+    assert decode_settings('fast', h264, '480*270')['input_args'] == {'threads': 0, 'skip_loop_filter': 'noref'}
+    assert decode_settings('fast', h264, '1280*720')['input_args'] == {'threads': 0}
+    assert decode_settings('fast', h264, 'raw')['input_args'] == {'threads': 0}
@@ -1,19 +1,18 @@
 import requests
 import boto3
 import json
-from opensearchpy import OpenSearch, RequestsHttpConnection
-from requests.auth import HTTPBasicAuth
 from pathlib import Path
 import base64
 import os
+from runtime_utils import get_client, get_opensearch_client
 
 session = boto3.session.Session()
 region = session.region_name
 
 # Define bedrock client
-bedrock_client = boto3.client(
+bedrock_client = get_client(
     "bedrock-runtime", 
-    region, 
+    region_name=region, 
     endpoint_url=f"https://bedrock-runtime.{region}.amazonaws.com"
 )
 
@@ -41,7 +40,7 @@ def get_titan_multimodal_embedding(
     # You can specify either text or image or both
     if image_path:
         if image_path.startswith('s3'):
-            s3 = boto3.client('s3')
+            s3 = get_client('s3')
             bucket_name, key = image_path.replace("s3://", "").split("/", 1)
             obj = s3.get_object(Bucket=bucket_name, Key=key)
             # Read the object's body
@@ -72,33 +71,10 @@ def get_titan_multimodal_embedding(
 
 
 def setup_opensearch_client():
-    # headers = {"Content-Type": "application/json"}
     host = os.environ["OPENSEARCH_ENDPOINT"] #<opensearch domain endpoint without 'https://'> #example: "opensearch-domain-endpoint.us-east-1.es.amazonaws.com"
-    # service = 'es'
-    # region = "us-east-1"
-
     # Use OpenSearch master credentials that you created while creating the OpenSearch domain
-    secret_client = boto3.client('secretsmanager')
     try:
-        get_secret_value_response = secret_client.get_secret_value(
-            SecretId='opensearch-master-user'
-        )
+        return get_opensearch_client(host)
     except Exception as e:
         print(f"error in create opensearch client, exception={e}")
         raise e
-
-    # 解码密钥值
-    secret_string = get_secret_value_response['SecretString']
-    secret_dict = json.loads(secret_string)
-    awsauth = HTTPBasicAuth(secret_dict["username"],secret_dict["password"])
-
-
-    #Initialise OpenSearch-py client
-    aos_client = OpenSearch(
-        hosts = [{'host': host, 'port': 443}],
-        http_auth = awsauth,
-        use_ssl = True,
-        connection_class = RequestsHttpConnection
-    )
-    
-    return aos_client
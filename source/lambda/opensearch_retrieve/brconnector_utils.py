@@ -4,6 +4,7 @@ import base64
 import os
 from pathlib import Path
 from typing import Dict, List, Optional, Union, Any, BinaryIO
+from runtime_utils import HTTP_TIMEOUT, get_http_session
 
 system_prompts = '''
 Here's the English translation of the prompt:
@@ -33,6 +34,8 @@ class BRClient:
         self.api_key = api_key
         self.base_url = os.environ.get('BRC_ENDPOINT')
         
+        # pooled session shared by every client in this execution environment
+        self.session = get_http_session()
         self.headers = {
             "Authorization": f"Bearer {api_key}",
             "Content-Type": "application/json"
@@ -100,7 +103,7 @@ class BRClient:
             payload["stop"] = stop
 
         try:
-            response = requests.post(url, headers=self.headers, json=payload)
+            response = self.session.post(url, headers=self.headers, json=payload, timeout=HTTP_TIMEOUT)
             response.raise_for_status()
             return response.json()["choices"][0]["message"]["content"]
         except requests.exceptions.RequestException as e:
@@ -213,7 +216,7 @@ class BRClient:
         }
 
         try:
-            response = requests.post(url, headers=self.headers, json=payload)
+            response = self.session.post(url, headers=self.headers, json=payload, timeout=HTTP_TIMEOUT)
             response.raise_for_status()
             return response.json()["choices"][0]["message"]["content"]
         except requests.exceptions.RequestException as e:
@@ -259,7 +262,7 @@ class BRClient:
                 payload["tool_choice"] = toolConfig["toolChoice"]
 
         try:
-            response = requests.post(url, headers=self.headers, json=payload)
+            response = self.session.post(url, headers=self.headers, json=payload, timeout=HTTP_TIMEOUT)
             response.raise_for_status()
             return response.json()
             
@@ -1,9 +1,6 @@
 import requests
-import boto3
 import json
-from opensearchpy import OpenSearch, RequestsHttpConnection
 from brconnector_utils import BRClient
-from requests.auth import HTTPBasicAuth
 from pathlib import Path
 import cohere_aws
 import base64
@@ -11,9 +8,11 @@ import os
 from brconnector_utils import BRClient
 from botocore.exceptions import ClientError
 from urllib.parse import urlparse
+from runtime_utils import BRC_SECRET_ID, call_with_secret, get_client, get_opensearch_client
+from rate_limiter import acquire_token
 
 # Define bedrock client
-bedrock_client = boto3.client("bedrock-runtime")
+bedrock_client = get_client("bedrock-runtime")
 
 # Bedrock models
 # Select Amazon titan-embed-image-v1 as Embedding model for multimodal indexing
@@ -38,7 +37,7 @@ def get_titan_multimodal_embedding(
     # You can specify either text or image or both
     if image_path:
         if image_path.startswith('s3'):
-            s3 = boto3.client('s3')
+            s3 = get_client('s3')
             bucket_name, key = image_path.replace("s3://", "").split("/", 1)
             obj = s3.get_object(Bucket=bucket_name, Key=key)
             # Read the object's body
@@ -69,37 +68,14 @@ def get_titan_multimodal_embedding(
 
 
 def setup_opensearch_client():
-    # headers = {"Content-Type": "application/json"}
     host = os.environ["OPENSEARCH_ENDPOINT"] #<opensearch domain endpoint without 'https://'> #example: "opensearch-domain-endpoint.us-east-1.es.amazonaws.com"
-    # service = 'es'
-    # region = "us-east-1"
-
     # Use OpenSearch master credentials that you created while creating the OpenSearch domain
-    secret_client = boto3.client('secretsmanager')
     try:
-        get_secret_value_response = secret_client.get_secret_value(
-            SecretId='opensearch-master-user'
-        )
+        return get_opensearch_client(host)
     except Exception as e:
         print(f"error in create opensearch client, exception={e}")
         raise e
 
-    # 解码密钥值
-    secret_string = get_secret_value_response['SecretString']
-    secret_dict = json.loads(secret_string)
-    awsauth = HTTPBasicAuth(secret_dict["username"],secret_dict["password"])
-
-
-    #Initialise OpenSearch-py client
-    aos_client = OpenSearch(
-        hosts = [{'host': host, 'port': 443}],
-        http_auth = awsauth,
-        use_ssl = True,
-        connection_class = RequestsHttpConnection
-    )
-    
-    return aos_client
-
 def get_presigned_url_from_uri(uri):
     try:
         parsed_uri = urlparse(uri)
@@ -112,7 +88,7 @@ def get_presigned_url_from_uri(uri):
         
         expiration = 600
 
-        s3 = boto3.client('s3')
+        s3 = get_client('s3')
 
         url = s3.generate_presigned_url(
             ClientMethod='get_object',
@@ -199,7 +175,7 @@ def call_bedrock_inference(model_id,input_text):
 
 def call_sagemaker_inference(model_id,input_text):
     
-    smr_client = boto3.client("sagemaker-runtime")
+    smr_client = get_client("sagemaker-runtime")
     
     prompt_content = '''
     Here's the English translation of the prompt:
@@ -245,21 +221,12 @@ def call_sagemaker_inference(model_id,input_text):
     return json.loads(response["Body"].read().decode('utf-8'))["choices"][0]["message"]["content"]
 
 def call_inference(**kwargs):
+    # searches are interactive and take precedence over batch analysis on the shared model quota
+    acquire_token(kwargs['model_id'], 'interactive')
     if kwargs['model_id'].lower().startswith("sagemaker"):
         return call_sagemaker_inference(**kwargs)
     elif os.environ.get('BRC_ENABLE') == 'Y':
-        secret_client = boto3.client('secretsmanager')
-        try:
-            get_secret_value_response = secret_client.get_secret_value(
-                SecretId='brconnector-apikey'
-            )
-        except Exception as e:
-            print(f"error in create opensearch client, exception={e}")
-            raise e
-
-        brc_api_key = get_secret_value_response['SecretString']
-        brclient = BRClient(api_key=brc_api_key)
-        brc_response = brclient.chat_completion(**kwargs)
-        return brc_response
+        # the API key is cached, and refreshed once when BRConnector rejects it
+        return call_with_secret(BRC_SECRET_ID, lambda brc_api_key: BRClient(api_key=brc_api_key).chat_completion(**kwargs))
     else:
         return call_bedrock_inference(**kwargs)
\ No newline at end of file
@@ -1,29 +1,12 @@
 import json
-import requests
 from datetime import datetime
 import os
-import boto3
 import uuid
+from runtime_utils import BRC_SECRET_ID, HTTP_TIMEOUT, call_with_secret, get_http_session
 
 def brconnect_with_tools(model_id, messages, system, tool_config):
     url = f"{os.environ.get('BRC_ENDPOINT')}/chat/completions"
 
-    secret_client = boto3.client('secretsmanager')
-    try:
-        get_secret_value_response = secret_client.get_secret_value(
-            SecretId='brconnector-apikey'
-        )
-    except Exception as e:
-        print(f"error in create opensearch client, exception={e}")
-        raise e
-
-    brc_api_key = get_secret_value_response['SecretString']
-
-    headers = {
-        "Authorization": f"Bearer {brc_api_key}",
-        "Content-Type": "application/json"
-    }
-    
     formatted_messages = format_messages_for_openai(messages, system)
     tools = convert_tools_to_functions(tool_config)
     
@@ -40,8 +23,18 @@ def brconnect_with_tools(model_id, messages, system, tool_config):
     }
     
     print("Debug - payload:", payload)
-    response = requests.post(url, headers=headers, json=payload)
-    response_data = response.json()
+
+    def post(brc_api_key):
+        headers = {
+            "Authorization": f"Bearer {brc_api_key}",
+            "Content-Type": "application/json"
+        }
+        response = get_http_session().post(url, headers=headers, json=payload, timeout=HTTP_TIMEOUT)
+        # 401/403 让 call_with_secret 刷新缓存的 API key 后重试
+        response.raise_for_status()
+        return response.json()
+
+    response_data = call_with_secret(BRC_SECRET_ID, post)
     return output_format(response_data)
 
 def format_messages_for_openai(messages, system):
@@ -1,4 +1,3 @@
-import boto3
 from datetime import datetime
 import json
 import logging
@@ -6,20 +5,19 @@ import os
 from dynamodb_utils import query_dynamodb, create_xml
 from brconnector_utils import brconnect_with_tools
 from botocore.exceptions import ClientError
+from runtime_utils import get_client
+from rate_limiter import acquire_token
 
 logger = logging.getLogger(__name__)
 
-bedrock = boto3.client(
-    service_name = 'bedrock-runtime'
-    )
+bedrock = get_client('bedrock-runtime')
 
 class ToolsList:
     #Define our get_weather tool function...
     def send_notification(self, condition, message, receiver=None):
         print('in toolslist', condition, message, receiver)
         try:
-            lambda_client = boto3.client('lambda')
-            response = lambda_client.invoke(
+            response = get_client('lambda').invoke(
                 FunctionName=os.environ['TOOL_NOTIFICATION_LAMBDA'],
                 InvocationType='Event',
                 Payload=json.dumps(
@@ -39,8 +37,7 @@ class ToolsList:
     def send_device_mqtt(self, level, command):
         print('in toolslist', command)
         try:
-            lambda_client = boto3.client('lambda')
-            response = lambda_client.invoke(
+            response = get_client('lambda').invoke(
                 FunctionName=os.environ['TOOL_DEVICE_LAMBDA'],
                 InvocationType='Event',
                 Payload=json.dumps(
@@ -128,6 +125,8 @@ toolConfig['tools'].append({
 
 #Function for caling the Bedrock Converse API...
 def converse_with_tools(model_id, prompt, system, tool_config):
+    #Interactive requests take precedence over batch analysis on the shared model quota
+    acquire_token(model_id, 'interactive')
     if os.environ.get('BRC_ENABLE') == 'Y':
         response = brconnect_with_tools(model_id, prompt, system, tool_config)
     else:
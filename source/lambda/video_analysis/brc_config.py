@@ -4,12 +4,15 @@ import base64
 import os
 from pathlib import Path
 from typing import Dict, List, Optional, Union, Any, BinaryIO
+from runtime_utils import HTTP_TIMEOUT, get_http_session
 
 class BRClient:
     def __init__(self, api_key: str):
         self.api_key = api_key
         self.base_url = os.environ.get('BRC_ENDPOINT')
         
+        # pooled session shared by every client in this execution environment
+        self.session = get_http_session()
         self.headers = {
             "Authorization": f"Bearer {api_key}",
             "Content-Type": "application/json"
@@ -77,20 +80,22 @@ class BRClient:
             payload["stop"] = stop
 
         try:
-            response = requests.post(url, headers=self.headers, json=payload)
+            response = self.session.post(url, headers=self.headers, json=payload, timeout=HTTP_TIMEOUT)
             response.raise_for_status()
             return response.json()["choices"][0]["message"]["content"]
         except requests.exceptions.RequestException as e:
             raise Exception(f"API request failed: {str(e)}")
     
     def prepare_image_content(self, input_image_paths: Optional[Union[str, List[str]]] = None, 
-                            input_images: Optional[List[bytes]] = None) -> List[dict]:
+                            input_images: Optional[List[bytes]] = None,
+                            image_format: str = "jpeg") -> List[dict]:
         """
         Prepare image content for multimodal messages in OpenAI format
         
         Args:
             input_image_paths: Single path or list of paths to image files 
             input_images: List of image bytes
+            image_format: Image format of the frames, jpeg or webp
             
         Returns:
             List of content items in OpenAI format
@@ -106,12 +111,15 @@ class BRClient:
                     content_images.append(image_file.read())
             elif Path(input_image_paths).is_dir():
                 print("dir path is ", input_image_paths)
-                for input_image_path in Path(input_image_paths).glob('*.jpg'):
+                extension = "jpg" if image_format == "jpeg" else image_format
+                for input_image_path in Path(input_image_paths).glob(f'*.{extension}'):
                     with open(input_image_path, "rb") as image_file:
                         content_images.append(image_file.read())
             else:
                 print('image')
                 content_images = input_images
+        elif input_images is not None:
+            content_images = input_images
 
         # Convert image bytes to base64 and format content
         for img in content_images:
@@ -119,7 +127,7 @@ class BRClient:
             content.append({
                 "type": "image_url",
                 "image_url": {
-                    "url": f"data:image/jpeg;base64,{base64_image}"
+                    "url": f"data:image/{image_format};base64,{base64_image}"
                 }
             })
                 
@@ -137,6 +145,8 @@ class BRClient:
         max_tokens: int = 300,
         input_image_paths: Optional[Union[str, List[str]]] = None,
         input_images: Optional[List[bytes]] = None,
+        image_format: str = "jpeg",
+        on_delta=None,
     ) -> str:
         """
         Create a chat completion with image analysis support using OpenAI format
@@ -151,6 +161,8 @@ class BRClient:
             max_tokens: Maximum tokens to generate
             input_image_paths: Path(s) to image file(s)
             input_images: List of image bytes
+            image_format: Image format of the frames, jpeg or webp
+            on_delta: When set, the response is streamed over SSE and each text delta is passed to it
             
         Returns:
             str: Model response
@@ -167,7 +179,7 @@ class BRClient:
         })
         
         # Add image content
-        content.extend(self.prepare_image_content(input_image_paths, input_images))
+        content.extend(self.prepare_image_content(input_image_paths, input_images, image_format))
         
         messages = [{
             "role": "user",
@@ -189,13 +201,48 @@ class BRClient:
             "top_k": top_k
         }
 
+        if on_delta is not None:
+            return self.stream_chat_completion(url, payload, on_delta)
+
         try:
-            response = requests.post(url, headers=self.headers, json=payload)
+            response = self.session.post(url, headers=self.headers, json=payload, timeout=HTTP_TIMEOUT)
             response.raise_for_status()
             return response.json()["choices"][0]["message"]["content"]
         except requests.exceptions.RequestException as e:
             raise Exception(f"API request failed: {str(e)}")
 
+    def stream_chat_completion(self, url: str, payload: Dict[str, Any], on_delta) -> str:
+        """
+        Send a chat completion request with stream enabled and read the server-sent events
+        
+        Args:
+            url: Chat completions endpoint
+            payload: Request body, stream is added
+            on_delta: Called with each text delta
+            
+        Returns:
+            str: Full model response
+        """
+        text = []
+        try:
+            with self.session.post(url, headers=self.headers, json=dict(payload, stream=True),
+                                   timeout=HTTP_TIMEOUT, stream=True) as response:
+                response.raise_for_status()
+                for line in response.iter_lines(decode_unicode=True):
+                    if not line or not line.startswith("data:"):
+                        continue
+                    data = line[len("data:"):].strip()
+                    if data == "[DONE]":
+                        break
+                    choices = json.loads(data).get("choices") or [{}]
+                    delta = (choices[0].get("delta") or {}).get("content")
+                    if delta:
+                        text.append(delta)
+                        on_delta(delta)
+        except requests.exceptions.RequestException as e:
+            raise Exception(f"API request failed: {str(e)}")
+        return "".join(text)
+
     def process_chat_with_functions(
         self,
         model_id: str,
@@ -236,7 +283,7 @@ class BRClient:
                 payload["tool_choice"] = toolConfig["toolChoice"]
 
         try:
-            response = requests.post(url, headers=self.headers, json=payload)
+            response = self.session.post(url, headers=self.headers, json=payload, timeout=HTTP_TIMEOUT)
             response.raise_for_status()
             return response.json()
             
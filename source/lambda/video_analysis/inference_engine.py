@@ -0,0 +1,193 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from runtime_utils import get_client, is_throttle
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# 一批 SQS 窗口中的每个窗口在各自的线程中运行 (asyncio.to_thread), 模型调用本身是阻塞的 boto3/HTTP 请求;
+# 下面的并发上限都只作用于单个执行环境内的线程, 跨执行环境的总并发由 SQS 事件源的 maximum concurrency 决定,
+# 跨任务共享的模型配额由 rate_limiter 的令牌桶控制
+
+# 单个执行环境内每个模型同时进行的调用上限
+MODEL_CONCURRENCY = int(os.environ.get('MODEL_CONCURRENCY', 8))
+# 单个执行环境内所有模型合计的调用上限
+ENVIRONMENT_CONCURRENCY = int(os.environ.get('ENVIRONMENT_CONCURRENCY', 16))
+# 冷启动时的并发, 成功后逐步增加到上限
+INITIAL_CONCURRENCY = float(os.environ.get('INITIAL_CONCURRENCY', 2))
+# 同一波并发请求先后被限流时只减半一次
+THROTTLE_COOLDOWN = 2.0
+
+# 失败窗口在这么多秒后重新投递, 按接收次数加倍; 否则要等满队列的可见性超时 (函数超时的 6 倍)
+RETRY_DELAY = int(os.environ.get('RETRY_DELAY_SECONDS', 10))
+RETRY_DELAY_MAX = 300
+# 与分析队列死信队列的 max_receive_count 一致, 最后一次接收仍失败的窗口将进入死信队列
+MAX_RECEIVES = int(os.environ.get('ANALYSIS_MAX_RECEIVES', 3))
+
+METRIC_NAMESPACE = 'MultimodalVideoAnalysis'
+
+
+class AdaptiveLimiter:
+    """
+    AIMD 并发上限: 被限流时减半, 每次成功增加 1/limit, 约每轮并发增加 1
+    基于 threading.Condition, 只协调同一执行环境内的线程
+    模块级保存, 热启动的调用之间延续已经探到的上限
+    """
+    def __init__(self, max_limit, initial=INITIAL_CONCURRENCY):
+        self.max_limit = max_limit
+        self.limit = max(1.0, min(float(initial), max_limit))
+        self.inflight = 0
+        self.throttles = 0
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.inflight < int(self.limit))
+            self.inflight += 1
+
+    def release(self, throttled=False):
+        with self.condition:
+            self.inflight -= 1
+            if throttled:
+                self.throttles += 1
+                now = time.monotonic()
+                if now - self.last_decrease >= THROTTLE_COOLDOWN:
+                    self.limit = max(1.0, self.limit / 2)
+                    self.last_decrease = now
+            else:
+                self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+_environment_slots = threading.BoundedSemaphore(ENVIRONMENT_CONCURRENCY)
+
+
+def get_limiter(model_id):
+    with _limiters_lock:
+        if model_id not in _limiters:
+            _limiters[model_id] = AdaptiveLimiter(MODEL_CONCURRENCY)
+        return _limiters[model_id]
+
+
+def limited_inference(call, model_id, **kwargs):
+    """
+    在执行环境内的模型和总并发上限内执行一次模型调用, 被限流时降低上限
+    这里不再重试: boto3/HTTP 客户端已经重试过限流, 仍然失败的窗口由 process_batch 延迟后经 SQS 重新投递
+    :param call: 实际的推理函数, 如 call_inference
+    """
+    limiter = get_limiter(model_id)
+    # 先等模型名额再占总名额, 一个被限流的模型不会占住其他模型的名额
+    limiter.acquire()
+    try:
+        with _environment_slots:
+            result = call(model_id=model_id, **kwargs)
+    except Exception as e:
+        throttled = is_throttle(e)
+        limiter.release(throttled)
+        if throttled:
+            logger.warning(f'{model_id} throttled, concurrency limit now {int(limiter.limit)}')
+        raise
+    limiter.release()
+    return result
+
+
+def emit_metrics(dimensions, values, units=None):
+    """
+    以 CloudWatch Embedded Metric Format 写入日志, 由 CloudWatch 提取为指标, 不额外调用 API
+    """
+    units = units or {}
+    print(json.dumps(dict({
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': METRIC_NAMESPACE,
+                'Dimensions': [list(dimensions)],
+                'Metrics': [{'Name': name, 'Unit': units.get(name, 'None')} for name in values]
+            }]
+        }
+    }, **dimensions, **values)))
+
+
+def report_batch(records, failures, started):
+    now = time.time()
+    oldest = max((now * 1000 - int(record['attributes']['SentTimestamp']) for record in records
+                  if 'SentTimestamp' in record.get('attributes', {})), default=0)
+    values = {'Windows': len(records), 'FailedWindows': len(failures), 'BatchDuration': (now - started) * 1000,
+              'OldestWindowAge': oldest}
+    units = {'Windows': 'Count', 'FailedWindows': 'Count', 'BatchDuration': 'Milliseconds',
+             'OldestWindowAge': 'Milliseconds'}
+    # 队列积压直接使用 SQS 自带的 ApproximateNumberOfMessagesVisible / NotVisible 指标, 不在每批调用 GetQueueAttributes
+    emit_metrics({}, values, units)
+
+    with _limiters_lock:
+        limiters = dict(_limiters)
+    for model_id, limiter in limiters.items():
+        with limiter.condition:
+            throttles, limiter.throttles = limiter.throttles, 0
+            limit = limiter.limit
+        emit_metrics({'ModelId': model_id}, {'ConcurrencyLimit': limit, 'Throttles': throttles},
+                     {'Throttles': 'Count'})
+
+
+def delay_retry(record, queue_url, receives):
+    """
+    缩短失败窗口的可见性超时, 让 SQS 很快重新投递, 同时避免立即重试
+    :param receives: 窗口已被接收的次数
+    """
+    try:
+        get_client('sqs').change_message_visibility(
+            QueueUrl=queue_url,
+            ReceiptHandle=record['receiptHandle'],
+            VisibilityTimeout=min(RETRY_DELAY * 2 ** (receives - 1), RETRY_DELAY_MAX)
+        )
+    except Exception as e:
+        # 失败时窗口仍会在队列的可见性超时后重新投递
+        logger.warning(f"Failed to shorten the retry delay of window {record['messageId']}: {e}")
+
+
+async def run_records(records, handle_window):
+    loop = asyncio.get_running_loop()
+    # 每个窗口一个线程, 等待并发名额的窗口也占用线程, 默认线程池在小内存的 Lambda 上只有几个线程
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=max(1, len(records))))
+
+    async def run(record):
+        await asyncio.to_thread(handle_window, json.loads(record['body']))
+
+    return await asyncio.gather(*(run(record) for record in records), return_exceptions=True)
+
+
+def process_batch(event, handle_window, give_up=None):
+    """
+    并发处理一批 SQS 窗口请求, 失败的窗口以 batchItemFailures 返回, 由 SQS 重新投递
+    :param handle_window: 处理单个窗口请求的函数, 失败时抛出异常
+    :param give_up: 窗口最后一次接收仍失败时以窗口请求调用, 此后不会再重试
+    """
+    started = time.time()
+    records = event['Records']
+    outcomes = asyncio.run(run_records(records, handle_window))
+
+    queue_url = os.environ.get('ANALYSIS_QUEUE_URL')
+    failures = []
+    for record, outcome in zip(records, outcomes):
+        if isinstance(outcome, Exception):
+            logger.error(f"Window {record['messageId']} failed: {outcome}")
+            failures.append({'itemIdentifier': record['messageId']})
+            receives = int(record.get('attributes', {}).get('ApproximateReceiveCount', 1))
+            if receives < MAX_RECEIVES:
+                if queue_url:
+                    delay_retry(record, queue_url, receives)
+            elif give_up:
+                try:
+                    give_up(json.loads(record['body']))
+                except Exception as e:
+                    logger.error(f"Failed to give up window {record['messageId']}: {e}")
+    report_batch(records, failures, started)
+    return {'batchItemFailures': failures}
@@ -1,22 +1,35 @@
 import json
 import logging
-import boto3
 import os
 from pathlib import Path
 import base64
 import time
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
 from botocore.exceptions import ClientError
 import uuid
 import shutil
-from decimal import Decimal
-from datetime import datetime
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from multimodal_config import call_claude3_img, call_sagemaker_llava
 from brc_config import BRClient
+from inference_engine import limited_inference, process_batch
+from runtime_utils import BRC_SECRET_ID, call_with_secret, get_client
+from rate_limiter import acquire_token
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 # 创建S3客户端
-s3 = boto3.client('s3')
+s3 = get_client('s3')
+# DynamoDB 使用线程安全的 client, 批量处理时多个窗口线程共用
+serializer = TypeSerializer()
+deserializer = TypeDeserializer()
+
+# 每个任务保留用于去重比较的最近窗口数量
+DEDUP_HISTORY = 5
+
+# 流式分析时, 增量文本攒够字符数或间隔时间后才推送一次, 避免每个 token 都调用 NotifyLambda
+STREAM_FLUSH_CHARS = int(os.environ.get('STREAM_FLUSH_CHARS', 200))
+STREAM_FLUSH_SECONDS = float(os.environ.get('STREAM_FLUSH_SECONDS', 0.5))
 
 def download_files_from_s3(bucket_name, folder_path):
     """
@@ -61,7 +74,76 @@ def download_files_from_s3(bucket_name, folder_path):
         logger.error(f'Unexpected error occurred: {e}')
         raise e
         
-def get_presigned_url(bucket_name, key):
+def load_frames(event, bucket_name):
+    """
+    读取提取端直接传递的帧 (请求内联或单个 bundle 对象), 或按窗口 manifest 中的对象键并发下载的帧
+    :param event: 分析请求
+    :param bucket_name: S3 Bucket名称
+    :return: 图像字节列表, 旧版请求没有 manifest, 需要列出并下载 image_path 时返回 None
+    """
+    if 'frames' in event:
+        return [base64.b64decode(frame) for frame in event['frames']]
+    if 'frame_bundle_key' in event:
+        bundle = s3.get_object(Bucket=bucket_name, Key=event['frame_bundle_key'])['Body'].read()
+        frames = []
+        offset = 0
+        for frame_size in event['frame_sizes']:
+            frames.append(bundle[offset:offset + frame_size])
+            offset += frame_size
+        return frames
+    if 'manifest_key' in event:
+        # manifest 列出了窗口的全部帧, 不需要 LIST 前缀, 也不会读到其他窗口的对象
+        manifest = json.loads(s3.get_object(Bucket=bucket_name, Key=event['manifest_key'])['Body'].read())
+        keys = [frame['key'] for frame in manifest['frames']]
+        with ThreadPoolExecutor(max_workers=max(1, min(len(keys), 8))) as executor:
+            return list(executor.map(lambda key: s3.get_object(Bucket=bucket_name, Key=key)['Body'].read(), keys))
+    return None
+
+def hamming_distance(hash_a, hash_b):
+    return bin(int(hash_a, 16) ^ int(hash_b, 16)).count('1')
+
+def to_dynamodb_item(values):
+    return {key: serializer.serialize(value) for key, value in values.items()}
+
+def from_dynamodb_item(item):
+    return {key: deserializer.deserialize(value) for key, value in item.items()}
+
+def find_duplicate_result(table_name, task_id, frame_hashes, threshold):
+    """
+    在任务最近分析过的窗口中查找画面近似的窗口
+    :param frame_hashes: 当前窗口每帧的感知哈希
+    :param threshold: 每帧与最相近帧之间允许的最大汉明距离
+    :return: (最近窗口列表, 可复用的 frame_result, 没有近似窗口时为 None)
+    """
+    item = get_client('dynamodb').get_item(
+        TableName=table_name,
+        Key=to_dynamodb_item({'task_id': task_id, 'state_key': 'recent_hashes'})
+    ).get('Item')
+    recent_windows = from_dynamodb_item(item).get('windows', []) if item else []
+    for window in reversed(recent_windows):
+        distance = max(min(hamming_distance(frame_hash, recent_hash) for recent_hash in window['frame_hashes'])
+                       for frame_hash in frame_hashes)
+        if distance <= threshold:
+            return recent_windows, window['frame_result']
+    return recent_windows, None
+
+def remember_window(table_name, task_id, recent_windows, frame_hashes, result, timestamp):
+    """
+    记录已分析窗口的哈希和结果, 只保留最近 DEDUP_HISTORY 个
+    并发的分析调用可能覆盖彼此的记录, 只会少去重一次, 不影响结果
+    """
+    recent_windows = recent_windows + [{
+        'frame_hashes': frame_hashes,
+        'frame_result': result,
+        'video_time': str(timestamp)
+    }]
+    get_client('dynamodb').put_item(TableName=table_name, Item=to_dynamodb_item({
+        'task_id': task_id,
+        'state_key': 'recent_hashes',
+        'windows': recent_windows[-DEDUP_HISTORY:]
+    }))
+
+def get_presigned_url(bucket_name, key, image_format='jpeg'):
     try:
         expiration = 600
         # 生成预签名URL
@@ -70,7 +152,7 @@ def get_presigned_url(bucket_name, key):
             Params={
                 'Bucket': bucket_name,
                 'Key': key,
-                'ResponseContentType': 'image/jpeg'
+                'ResponseContentType': f'image/{image_format}'
             },
             ExpiresIn=expiration
         )
@@ -87,8 +169,7 @@ def invoke_notify_lambda(notify_lambda_name, notify_request):
     :param notify_request: 请求参数
     """
     try:
-        lambda_client = boto3.client('lambda')
-        lambda_client.invoke(
+        get_client('lambda').invoke(
             FunctionName=notify_lambda_name,
             InvocationType='Event',
             Payload=bytes(json.dumps(notify_request), encoding='utf-8')
@@ -97,12 +178,44 @@ def invoke_notify_lambda(notify_lambda_name, notify_request):
         logger.error(f'Error occurred while invoking Lambda function: {e}')
         raise e
         
+class ResultStreamer:
+    """
+    把模型的增量输出合并成块, 经 NotifyLambda 推送到 WebSocket 连接
+    每块携带到目前为止的完整文本和递增的 stream_seq, 异步调用乱序到达时客户端保留序号最大的一块,
+    最终结果照常推送, 不带 stream_seq
+    """
+    def __init__(self, notify_lambda_name, connection_id, timestamp, task_id, img_url=None):
+        self.notify_lambda_name = notify_lambda_name
+        self.connection_id = connection_id
+        self.payload = {"timestamp": timestamp, "img_url": img_url, "task_id": task_id}
+        self.text = ''
+        self.sent = 0
+        self.seq = 0
+        self.last_flush = time.monotonic()
+
+    def __call__(self, delta):
+        self.text += delta
+        if len(self.text) - self.sent >= STREAM_FLUSH_CHARS or time.monotonic() - self.last_flush >= STREAM_FLUSH_SECONDS:
+            self.flush()
+
+    def flush(self):
+        if len(self.text) == self.sent:
+            return
+        self.seq += 1
+        self.sent = len(self.text)
+        self.last_flush = time.monotonic()
+        payload = dict(self.payload, analysis_result=self.text, stream_seq=self.seq)
+        try:
+            invoke_notify_lambda(self.notify_lambda_name, {"payload": payload, "connection_id": self.connection_id})
+        except Exception:
+            # 中间结果推送失败不影响分析, 最终结果仍会推送
+            logger.warning(f'Failed to push streamed chunk {self.seq}')
+
 def invoke_summary_lambda(summary_lambda_name, model_id, temperature, top_p, top_k, max_tokens, user_id, task_id, connection_id):
     """
     调用SummaryLambda函数
     """
     try:
-        lambda_client = boto3.client('lambda')
         summary_request = {
             "model_id": model_id,
             "temperature": temperature,
@@ -113,7 +226,7 @@ def invoke_summary_lambda(summary_lambda_name, model_id, temperature, top_p, top
             "task_id": task_id,
             "connection_id": connection_id
         }
-        lambda_client.invoke(
+        get_client('lambda').invoke(
             FunctionName=summary_lambda_name,
             InvocationType='Event',
             Payload=bytes(json.dumps(summary_request), encoding='utf-8')
@@ -122,10 +235,75 @@ def invoke_summary_lambda(summary_lambda_name, model_id, temperature, top_p, top
         logger.error(f'Error occurred while invoking Lambda function: {e}')
         raise e
 
-def put_item_to_dynamodb(table, user_id, task_id, task_object, timestamp, folder_path, result):
+def close_window(event):
+    """
+    记录窗口已处理完 (分析成功或放弃重试), 由最后处理完的窗口触发一次总结
+    队列中的窗口可能晚于 end 窗口处理, 所以收到 end 后还要等帧提取端登记的窗口都处理完
+    没有任务状态表时在 end 窗口处理完时总结
+    """
+    task_id = str(event.get('task_id', 'task_placeholder'))
+    end = event.get('tag') == 'end'
+    if 'TASK_STATE_DYNAMODB' not in os.environ:
+        if end:
+            summarize_task(event)
+        return
+
+    table_name = os.environ['TASK_STATE_DYNAMODB']
+    key = to_dynamodb_item({'task_id': task_id, 'state_key': 'windows'})
+    updates, values = [], {}
+    if not event.get('end_only'):
+        # 窗口编号与帧提取端登记时相同, 字符串集合使重复投递的窗口只计一次
+        updates.append('ADD windows_done :window')
+        values[':window'] = {'SS': [str(event.get('start_time'))]}
+    if end:
+        updates.append('SET end_received = :true')
+        values[':true'] = {'BOOL': True}
+    item = from_dynamodb_item(get_client('dynamodb').update_item(
+        TableName=table_name,
+        Key=key,
+        UpdateExpression=' '.join(updates),
+        ExpressionAttributeValues=values,
+        ReturnValues='ALL_NEW'
+    )['Attributes'])
+    if not item.get('end_received') or item.get('summary_sent'):
+        return
+    outstanding = item.get('windows_sent', set()) - item.get('windows_done', set())
+    if outstanding:
+        logger.info(f'Task {task_id} ended, waiting for {len(outstanding)} windows before the summary')
+        return
+
+    # 多个窗口可能同时看到任务完成, 条件写入保证只总结一次
+    try:
+        get_client('dynamodb').update_item(
+            TableName=table_name,
+            Key=key,
+            UpdateExpression='SET summary_sent = :true',
+            ConditionExpression='attribute_not_exists(summary_sent)',
+            ExpressionAttributeValues={':true': {'BOOL': True}}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return
+        raise
+    summarize_task(event)
+
+def summarize_task(event):
+    invoke_summary_lambda(
+        os.environ['SUMMARY_LAMBDA'],
+        event.get('model_id', 'anthropic.claude-3-haiku-20240307-v1:0'),
+        event.get('temperature', 0.5),
+        event.get('top_p', 1.0),
+        event.get('top_k', 250),
+        event.get('max_tokens', 2048),
+        str(event.get('user_id', 'id_placeholder')),
+        str(event.get('task_id', 'task_placeholder')),
+        event.get('connection_id', 'connection_placeholder')
+    )
+
+def put_item_to_dynamodb(table_name, user_id, task_id, task_object, timestamp, folder_path, result):
     """
     将结果写入DynamoDB
-    :param table: DynamoDB表
+    :param table_name: DynamoDB表名
     :param user_id: 用户ID
     :param task_id: 任务ID
     :param task_object: 任务对象
@@ -144,7 +322,7 @@ def put_item_to_dynamodb(table, user_id, task_id, task_object, timestamp, folder
             'folder_path': folder_path,
             'frame_result': result
         }
-        table.put_item(Item=item)
+        get_client('dynamodb').put_item(TableName=table_name, Item=to_dynamodb_item(item))
         logger.info(f"Successfully wrote item to DynamoDB: {item}")
     except ClientError as e:
         logger.error(f"Error occurred while writing to DynamoDB: {e}")
@@ -154,94 +332,141 @@ def put_item_to_dynamodb(table, user_id, task_id, task_object, timestamp, folder
         raise e
 
 def call_inference(**kwargs):
+    # 与其他任务共享模型配额, 逐帧分析优先级最低
+    acquire_token(kwargs['model_id'], 'batch')
     if kwargs['model_id'].lower().startswith("sagemaker"):
+        # SageMaker 端点不支持流式输出
+        kwargs.pop('on_delta', None)
         return call_sagemaker_llava(**kwargs)
     elif os.environ.get('BRC_ENABLE') == 'Y':
-        secret_client = boto3.client('secretsmanager')
-        try:
-            get_secret_value_response = secret_client.get_secret_value(
-                SecretId='brconnector-apikey'
-            )
-        except Exception as e:
-            print(f"error in create opensearch client, exception={e}")
-            raise e
-        brc_api_key = get_secret_value_response['SecretString']
-        brclient = BRClient(api_key=brc_api_key)
-        brc_response = brclient.chat_completion_with_images(**kwargs)
-        return brc_response
+        # API key 在执行环境内缓存, 被拒绝时刷新后重试一次
+        return call_with_secret(BRC_SECRET_ID,
+                                lambda brc_api_key: BRClient(api_key=brc_api_key).chat_completion_with_images(**kwargs))
     else:
         return call_claude3_img(**kwargs)
 
-def lambda_handler(event, context):
-    try:
-        logger.info('video_analysis: {}'.format(event))
-
-        # 从event中获取参数
-        bucket_name = event.get('bucket', os.environ['RESULT_BUCKET'])
-        folder_path = event['image_path']
-        timestamp = event.get('start_time', '00:00')
-        connection_id = event.get('connection_id', 'connection_placeholder')
-        user_id = str(event.get('user_id', 'id_placeholder'))
-        task_id = str(event.get('task_id', 'task_placeholder'))
-        task_object = event.get('video_source_content', 's3_placeholder')
-        video_source_content = event.get('video_source_content','video_content')
-
-        input_text = event.get('user_prompt', 'tell me the content of image in 30 words')
-        system_prompt = event.get('system_prompt', 'you are an assistant')
-        model_id = event.get('model_id', 'anthropic.claude-3-haiku-20240307-v1:0')
-        temperature = event.get('temperature', 0.5)
-        top_p = event.get('top_p', 1.0)
-        top_k = event.get('top_k', 250)
-        max_tokens = event.get('max_tokens', 2048)
-        tag = event.get('tag', 'running')
+def analyze_window(event, infer=call_inference):
+    """
+    分析一个窗口: 去重, 调用模型, 推送结果并写入DynamoDB, 失败时抛出异常
+    :param infer: 模型调用函数, 批量处理时为带并发控制的 call_inference
+    """
+    logger.info('video_analysis: {}'.format(event))
 
-        # 下载文件
-        download_dir, first_object_key, first_object_uri = download_files_from_s3(bucket_name, folder_path)
+    # 从event中获取参数
+    bucket_name = event.get('bucket', os.environ['RESULT_BUCKET'])
+    folder_path = event['image_path']
+    timestamp = event.get('start_time', '00:00')
+    connection_id = event.get('connection_id', 'connection_placeholder')
+    user_id = str(event.get('user_id', 'id_placeholder'))
+    task_id = str(event.get('task_id', 'task_placeholder'))
+    task_object = event.get('video_source_content', 's3_placeholder')
+    video_source_content = event.get('video_source_content','video_content')
+
+    input_text = event.get('user_prompt', 'tell me the content of image in 30 words')
+    system_prompt = event.get('system_prompt', 'you are an assistant')
+    model_id = event.get('model_id', 'anthropic.claude-3-haiku-20240307-v1:0')
+    temperature = event.get('temperature', 0.5)
+    top_p = event.get('top_p', 1.0)
+    top_k = event.get('top_k', 250)
+    max_tokens = event.get('max_tokens', 2048)
+    tag = event.get('tag', 'running')
+    frame_hashes = event.get('frame_hashes')
+    dedup_threshold = int(event.get('dedup_threshold', -1))
+    frame_format = event.get('frame_format', 'jpeg')
+    # 流式分析: 生成过程中把增量结果推送到 WebSocket, 完整结果仍在结束时推送并写入DynamoDB
+    stream_result = event.get('stream_result', os.environ.get('STREAM_RESULT', 'N')) == 'Y' and connection_id != 'connection_placeholder'
+    # 提取端把窗口内的帧拼成了网格图, 告知模型阅读顺序
+    frame_mosaic = event.get('frame_mosaic')
+    if frame_mosaic:
+        input_text = (f'Each image is a {frame_mosaic} grid of consecutive video frames, read left to right and '
+                      f'top to bottom, each labelled with its timestamp in the top left corner.\n{input_text}')
+
+    # 没有窗口可带 end 标记时, 帧提取端单独发送结束请求, 只通知任务结束并进行总结
+    if event.get('end_only'):
+        invoke_notify_lambda(os.environ['NOTIFY_LAMBDA'], {
+            "payload": {
+                "task_id": task_id,
+                "tag": "end",
+                "end_only": True
+            },
+            "connection_id": connection_id
+        })
+        close_window(event)
+        return None
+
+    # 与最近窗口画面近似时复用其结果, 不再下载帧和调用模型
+    result = None
+    dedup_enabled = bool(frame_hashes) and dedup_threshold >= 0 and 'TASK_STATE_DYNAMODB' in os.environ
+    if dedup_enabled:
+        state_table = os.environ['TASK_STATE_DYNAMODB']
+        recent_windows, result = find_duplicate_result(state_table, task_id, frame_hashes, dedup_threshold)
+
+    if result is not None:
+        logger.info(f'Window {timestamp} is a near duplicate of a recent window, reusing its result')
+        first_object_key = event.get('first_frame_key')
+        first_object_uri = f"s3://{bucket_name}/{first_object_key}" if first_object_key else None
+    else:
+        # 优先使用提取端直接传递的帧, 否则下载文件
+        frames = load_frames(event, bucket_name)
+        if frames is None:
+            download_dir, first_object_key, first_object_uri = download_files_from_s3(bucket_name, folder_path)
+            input_images = {'input_image_paths': Path(download_dir)}
+        else:
+            download_dir = None
+            first_object_key = event.get('first_frame_key')
+            first_object_uri = f"s3://{bucket_name}/{first_object_key}" if first_object_key else None
+            input_images = {'input_images': frames}
+
+        streamer = None
+        if stream_result:
+            img_url = get_presigned_url(bucket_name, first_object_key, frame_format) if first_object_key else None
+            streamer = ResultStreamer(os.environ['NOTIFY_LAMBDA'], connection_id, timestamp, task_id, img_url)
 
         # 调用Claude3进行分析
-        input_image_paths = Path(download_dir)
-        print(f'Input image paths: {input_image_paths}')
-        print(f'input_text={input_text}, system_prompt={system_prompt}, model_id={model_id}, temperature={temperature}, top_p={top_p}, top_k={top_k}, input_image_paths={input_image_paths}')
-        result = call_inference(input_text=input_text, system_prompt=system_prompt, model_id=model_id, temperature=temperature, top_p=top_p, top_k=top_k, max_tokens=max_tokens, input_image_paths=input_image_paths)
+        print(f"Input images: {download_dir or len(frames)}, expected image tokens: {event.get('expected_image_tokens')}")
+        print(f'input_text={input_text}, system_prompt={system_prompt}, model_id={model_id}, temperature={temperature}, top_p={top_p}, top_k={top_k}')
+        result = infer(input_text=input_text, system_prompt=system_prompt, model_id=model_id, temperature=temperature, top_p=top_p, top_k=top_k, max_tokens=max_tokens, image_format=frame_format, on_delta=streamer, **input_images)
         print(result)
 
         # 删除下载目录
-        shutil.rmtree(download_dir)
-
-        # 准备调用NotifyLambda的请求参数
-        first_object_presigned_url = get_presigned_url(bucket_name, first_object_key)
-        if tag == 'end':            
-            notify_request = {
-                "payload": {
-                    "timestamp": timestamp,
-                    "img_url": first_object_presigned_url,
-                    "analysis_result": result,
-                    "task_id": task_id,
-                    "tag": "end"
-                },
-                "connection_id": connection_id
-            }
-        else:
-            notify_request = {
-                "payload": {
-                    "timestamp": timestamp,
-                    "img_url": first_object_presigned_url,
-                    "analysis_result": result,
-                    "task_id": task_id
-                },
-                "connection_id": connection_id
-            }
-
-        # 调用NotifyLambda
-        invoke_notify_lambda(os.environ['NOTIFY_LAMBDA'], notify_request)
-
-        # 写入DynamoDB
-        dynamodb = boto3.resource('dynamodb')
-        table_name = os.environ['RESULT_DYNAMODB']
-        table = dynamodb.Table(table_name)
-        put_item_to_dynamodb(table, user_id, task_id, task_object, timestamp, folder_path, result)
-
-        # call opensearch lambda
+        if download_dir:
+            shutil.rmtree(download_dir)
+
+        if dedup_enabled:
+            remember_window(state_table, task_id, recent_windows, frame_hashes, result, timestamp)
+
+    # 准备调用NotifyLambda的请求参数, 未归档帧时没有预览图
+    first_object_presigned_url = get_presigned_url(bucket_name, first_object_key, frame_format) if first_object_key else None
+    if tag == 'end':            
+        notify_request = {
+            "payload": {
+                "timestamp": timestamp,
+                "img_url": first_object_presigned_url,
+                "analysis_result": result,
+                "task_id": task_id,
+                "tag": "end"
+            },
+            "connection_id": connection_id
+        }
+    else:
+        notify_request = {
+            "payload": {
+                "timestamp": timestamp,
+                "img_url": first_object_presigned_url,
+                "analysis_result": result,
+                "task_id": task_id
+            },
+            "connection_id": connection_id
+        }
+
+    # 调用NotifyLambda
+    invoke_notify_lambda(os.environ['NOTIFY_LAMBDA'], notify_request)
+
+    # 写入DynamoDB
+    put_item_to_dynamodb(os.environ['RESULT_DYNAMODB'], user_id, task_id, task_object, timestamp, folder_path, result)
+
+    # call opensearch lambda, 需要帧已归档到S3
+    if first_object_uri:
         ingest_payload = {
             "img_url": first_object_uri,
             "result": result,
@@ -250,22 +475,28 @@ def lambda_handler(event, context):
         }
         invoke_notify_lambda(os.environ['OPS_INGEST_LAMBDA'], ingest_payload)
 
-        # 在end时进行总结
-        if tag == 'end':
-            invoke_summary_lambda(
-                os.environ['SUMMARY_LAMBDA'],
-                model_id,
-                temperature,
-                top_p,
-                top_k,
-                max_tokens,
-                user_id,
-                task_id,
-                connection_id
-            )
+    # 记录窗口已处理完, 任务结束且所有窗口都处理完时进行总结
+    close_window(event)
+
+    return result
+
 
+def lambda_handler(event, context):
+    # SQS 分析队列: 一批窗口由批量推理引擎并发处理
+    if 'Records' in event:
+        # 放弃重试的窗口也计为处理完, 否则任务永远不会总结
+        return process_batch(event, partial(analyze_window, infer=partial(limited_inference, call_inference)),
+                             give_up=close_window)
+
+    try:
+        result = analyze_window(event)
     except Exception as e:
         logger.error(f'Unexpected error occurred: {e}')
+        # 直接调用时不会重试
+        try:
+            close_window(event)
+        except Exception:
+            logger.exception('Failed to record the failed window')
         return {
             'statusCode': 500,
             'body': json.dumps({'error': str(e)})
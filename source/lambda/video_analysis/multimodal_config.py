@@ -1,4 +1,3 @@
-import boto3
 import os
 import tempfile
 import json
@@ -7,35 +6,74 @@ from pathlib import Path
 import base64
 import time
 from botocore.exceptions import ClientError
+from runtime_utils import get_client
 
-bedrock_runtime = boto3.client(service_name='bedrock-runtime')
+bedrock_runtime = get_client('bedrock-runtime')
 
-def run_multi_modal_prompt(bedrock_runtime, model_id, messages, system_prompt, inferenceConfig, additionalModelFields):
+def image_extension(image_format):
+    """
+    帧提取时使用的文件扩展名
+    """
+    return 'jpg' if image_format == 'jpeg' else image_format
+
+def additional_request_fields(model_id, top_k):
+    """
+    模型特有的采样参数, converse 的 inferenceConfig 不包含 top_k
+    :return: additionalModelRequestFields 参数, 模型不支持 top_k 时为空
+    """
+    model = model_id.lower()
+    # llama model not support top_k parameter
+    if "llama" in model:
+        return {}
+    if "nova" in model:
+        return {"additionalModelRequestFields": {"inferenceConfig": {"topK": top_k}}}
+    return {"additionalModelRequestFields": {"top_k": top_k}}
+
+def run_multi_modal_prompt(bedrock_runtime, model_id, messages, system_prompt, inferenceConfig, additional_params):
         """
         Invokes a model with a multimodal prompt.
             bedrock_runtime: The Amazon Bedrock boto3 client.
             model_id (str): The model ID to use.
             messages (JSON) : The messages to send to the model.
+            additional_params: additional_request_fields output
         """
 
         t0 = time.time()
-        additional_params = {}
-        # llama model not support top_k parameter
-        if "llama" not in model_id.lower():
-            additional_params = {"additionalModelRequestFields": additionalModelFields} 
-            
-        response = bedrock_runtime.converse(modelId=model_id, messages=messages, system=system_prompt, inferenceConfig=inferenceConfig)
+        response = bedrock_runtime.converse(modelId=model_id, messages=messages, system=system_prompt, inferenceConfig=inferenceConfig, **additional_params)
         # response_body = response["output"]["message"]["content"][0]["text"]
         
         t1 = time.time()
         print("Invoke Cost: ",t1-t0)
 
         return response
+
+def run_multi_modal_prompt_stream(bedrock_runtime, model_id, messages, system_prompt, inferenceConfig, additional_params, on_delta):
+    """
+    与 run_multi_modal_prompt 相同, 使用 converse_stream, 每段增量文本回调 on_delta
+    :return: 完整的生成文本
+    """
+    t0 = time.time()
+    response = bedrock_runtime.converse_stream(modelId=model_id, messages=messages, system=system_prompt, inferenceConfig=inferenceConfig, **additional_params)
+
+    text = []
+    for event in response['stream']:
+        if 'contentBlockDelta' in event:
+            delta = event['contentBlockDelta']['delta'].get('text', '')
+            if delta:
+                if not text:
+                    print("First token: ", time.time() - t0)
+                text.append(delta)
+                on_delta(delta)
+
+    print("Invoke Cost: ", time.time() - t0)
+    return ''.join(text)
         
-def call_claude3_img(input_text, system_prompt, model_id, temperature, top_p, top_k, max_tokens, input_image_paths=None, input_images=None):
+def call_claude3_img(input_text, system_prompt, model_id, temperature, top_p, top_k, max_tokens, input_image_paths=None, input_images=None, image_format='jpeg', on_delta=None):
     """
     input_text: 输入的prompt
-    input_image_paths & input_images: 图像的输入为list，输入为一组图像地址input_image_paths或者base64编码后的图像input_images，优先input_image_paths
+    input_image_paths & input_images: 图像的输入为list，输入为一组图像地址input_image_paths或者图像字节input_images，优先input_image_paths
+    image_format: 图像格式, jpeg 或 webp
+    on_delta: 设置时以流式调用模型, 每段增量文本回调一次
     """
 
     try:
@@ -48,7 +86,7 @@ def call_claude3_img(input_text, system_prompt, model_id, temperature, top_p, to
                     content_images.append(image_file.read())
             elif Path(input_image_paths).is_dir():
                 print("dir path is ", input_image_paths)
-                for input_image_path in Path(input_image_paths).glob('*.jpg'):
+                for input_image_path in Path(input_image_paths).glob(f'*.{image_extension(image_format)}'):
                     with open(input_image_path, "rb") as image_file:
                         content_images.append(image_file.read())
         else:
@@ -63,7 +101,7 @@ def call_claude3_img(input_text, system_prompt, model_id, temperature, top_p, to
                 {
                     "image":
                     {
-                        "format": "jpeg", 
+                        "format": image_format, 
                         "source": {
                         "bytes": content_image
                         }
@@ -89,26 +127,36 @@ def call_claude3_img(input_text, system_prompt, model_id, temperature, top_p, to
         "topP": top_p
         }
 
-        additionalModelFields = {"top_k": top_k}
+        # 流式和非流式调用使用相同的参数
+        additional_params = additional_request_fields(model_id, top_k)
+
+        if on_delta is not None:
+            return run_multi_modal_prompt_stream(bedrock_runtime, model_id, messages, system, inferenceConfig,
+                                                 additional_params, on_delta)
 
         response = run_multi_modal_prompt(
-            bedrock_runtime, model_id, messages, system, inferenceConfig, additionalModelFields)
+            bedrock_runtime, model_id, messages, system, inferenceConfig, additional_params)
         # print(response, type(response))
         # print(json.dumps(response, indent=4))
         return response["output"]["message"]["content"][0]["text"]
 
     except (ClientError, Exception) as e:
         print(f"ERROR: Can't invoke '{model_id}'. Reason: {e}")
-        exit(1)
+        # 抛出异常而不是退出进程, 调用方据此识别限流并重试
+        raise
         
 def run_inference(endpoint_name, inputs):
-    smr_client = boto3.client("sagemaker-runtime")
+    smr_client = get_client("sagemaker-runtime")
     response = smr_client.invoke_endpoint(
         EndpointName=endpoint_name, Body=json.dumps(inputs)
     )
     return response["Body"].read().decode('utf-8')
 
-def call_sagemaker_llava(input_text, system_prompt, model_id, temperature, top_p, top_k, max_tokens, input_image_paths=None, input_images=None):
+def call_sagemaker_llava(input_text, system_prompt, model_id, temperature, top_p, top_k, max_tokens, input_image_paths=None, input_images=None, image_format='jpeg'):
+    """
+    input_image_paths & input_images: 一组图像地址或者图像字节, 优先input_image_paths
+    image_format: 图像格式, jpeg 或 webp
+    """
     
     if input_image_paths is not None:
         content_images = []
@@ -119,13 +167,13 @@ def call_sagemaker_llava(input_text, system_prompt, model_id, temperature, top_p
                 content_images.append(encode_image)
         elif Path(input_image_paths).is_dir():
             print("dir path is ", input_image_paths)
-            for input_image_path in Path(input_image_paths).glob('*.jpg'):
+            for input_image_path in Path(input_image_paths).glob(f'*.{image_extension(image_format)}'):
                 with open(input_image_path, "rb") as image_file:
                     encode_image = base64.b64encode(image_file.read()).decode('utf-8')
                     content_images.append(encode_image)
     else:
         print('image')
-        content_images = input_images
+        content_images = [base64.b64encode(input_image).decode('utf-8') for input_image in input_images]
     
     print(len(content_images))
     
@@ -133,7 +181,7 @@ def call_sagemaker_llava(input_text, system_prompt, model_id, temperature, top_p
     
     content = [{"type": "text", "text": prompt}]
     
-    content += [{"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}} for base64_image in content_images]
+    content += [{"type": "image_url", "image_url": {"url": f"data:image/{image_format};base64,{base64_image}"}} for base64_image in content_images]
 
     # print(content)
 
@@ -0,0 +1,21 @@
+import os
+import sys
+import importlib.util
+
+import pytest
+
+FUNCTION_DIR = os.path.join(os.path.dirname(__file__), '..')
+sys.path.insert(0, FUNCTION_DIR)
+# runtime_utils and rate_limiter come from the Lambda layer
+sys.path.insert(0, os.path.join(FUNCTION_DIR, '..', '..', 'layer', 'runtime_utils', 'python'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+
+@pytest.fixture(scope='session')
+def video_analysis():
+    """The function's lambda_function module, loaded under its own name since every function has one."""
+    spec = importlib.util.spec_from_file_location('video_analysis_lambda',
+                                                  os.path.join(FUNCTION_DIR, 'lambda_function.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
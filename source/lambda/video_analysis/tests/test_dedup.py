@@ -0,0 +1,54 @@
+import pytest
+
+
+class FakeDynamoDB:
+    """Low-level DynamoDB client holding typed items, as get_client('dynamodb') returns."""
+
+    def __init__(self):
+        self.items = {}
+
+    def get_item(self, TableName, Key):
+        item = self.items.get((TableName, Key['task_id']['S'], Key['state_key']['S']))
+        return {'Item': item} if item else {}
+
+    def put_item(self, TableName, Item):
+        self.items[(TableName, Item['task_id']['S'], Item['state_key']['S'])] = Item
+
+
+@pytest.fixture
+def dynamodb(video_analysis, monkeypatch):
+    client = FakeDynamoDB()
+    monkeypatch.setattr(video_analysis, 'get_client', lambda service_name: client)
+    return client
+
+
+def test_no_history_means_no_duplicate(video_analysis, dynamodb):
+    assert video_analysis.find_duplicate_result('state', 'task', ['00ff'], 4) == ([], None)
+
+
+def test_near_identical_window_reuses_its_result(video_analysis, dynamodb):
+    video_analysis.remember_window('state', 'task', [], ['00ff', 'f0f0'], 'a person at the door', 10)
+    # every frame is within 1 bit of a frame of the remembered window
+    recent, result = video_analysis.find_duplicate_result('state', 'task', ['00fe', 'f0f0'], 1)
+    assert result == 'a person at the door'
+    assert [window['video_time'] for window in recent] == ['10']
+
+
+def test_one_changed_frame_breaks_the_match(video_analysis, dynamodb):
+    video_analysis.remember_window('state', 'task', [], ['00ff', 'f0f0'], 'a person at the door', 10)
+    assert video_analysis.find_duplicate_result('state', 'task', ['00ff', '0f0f'], 4)[1] is None
+
+
+def test_most_recent_match_wins_and_history_is_bounded(video_analysis, dynamodb):
+    recent = []
+    for index in range(video_analysis.DEDUP_HISTORY + 2):
+        video_analysis.remember_window('state', 'task', recent, ['00ff'], f'result {index}', index)
+        recent = video_analysis.find_duplicate_result('state', 'task', ['ffff'], 0)[0]
+    assert len(recent) == video_analysis.DEDUP_HISTORY
+    assert video_analysis.find_duplicate_result('state', 'task', ['00ff'], 0)[1] == \
+        f'result {video_analysis.DEDUP_HISTORY + 1}'
+
+
+def test_negative_threshold_never_matches(video_analysis, dynamodb):
+    video_analysis.remember_window('state', 'task', [], ['00ff'], 'result', 0)
+    assert video_analysis.find_duplicate_result('state', 'task', ['00ff'], -1)[1] is None
@@ -0,0 +1,49 @@
+import io
+import json
+import base64
+
+import pytest
+
+
+class FakeS3:
+    def __init__(self, objects):
+        self.objects = objects
+        self.requested = []
+
+    def get_object(self, Bucket, Key):
+        self.requested.append(Key)
+        return {'Body': io.BytesIO(self.objects[Key])}
+
+
+@pytest.fixture
+def s3(video_analysis, monkeypatch):
+    client = FakeS3({})
+    monkeypatch.setattr(video_analysis, 's3', client)
+    return client
+
+
+def test_inline_frames_are_decoded_without_s3(video_analysis, s3):
+    event = {'frames': [base64.b64encode(frame).decode() for frame in (b'first', b'second')]}
+    assert video_analysis.load_frames(event, 'bucket') == [b'first', b'second']
+    assert s3.requested == []
+
+
+def test_bundle_is_split_by_frame_sizes(video_analysis, s3):
+    s3.objects['user/task/window/frames.bin'] = b'firstsecondthird'
+    event = {'frame_bundle_key': 'user/task/window/frames.bin', 'frame_sizes': [5, 6, 5]}
+    assert video_analysis.load_frames(event, 'bucket') == [b'first', b'second', b'third']
+    assert s3.requested == ['user/task/window/frames.bin']
+
+
+def test_requests_without_frames_fall_back_to_listing(video_analysis, s3):
+    assert video_analysis.load_frames({'image_path': 'user/task/window'}, 'bucket') is None
+
+
+def test_manifest_frames_are_read_in_order(video_analysis, s3):
+    keys = [f'user/task/window/frame_{index:03d}.jpeg' for index in range(1, 11)]
+    s3.objects.update({key: key.encode() for key in keys})
+    s3.objects['user/task/window/manifest.json'] = json.dumps({'frames': [{'key': key} for key in keys]}).encode()
+    frames = video_analysis.load_frames({'manifest_key': 'user/task/window/manifest.json'}, 'bucket')
+    # downloaded concurrently, returned in manifest order
+    assert frames == [key.encode() for key in keys]
+    assert sorted(s3.requested) == sorted(keys + ['user/task/window/manifest.json'])
@@ -0,0 +1,43 @@
+import pytest
+
+import multimodal_config
+
+
+class FakeBedrock:
+    def __init__(self):
+        self.calls = []
+
+    def converse(self, **kwargs):
+        self.calls.append(kwargs)
+        return {'output': {'message': {'content': [{'text': 'a person at the door'}]}}}
+
+    def converse_stream(self, **kwargs):
+        self.calls.append(kwargs)
+        return {'stream': [{'contentBlockDelta': {'delta': {'text': 'a person '}}},
+                           {'contentBlockDelta': {'delta': {'text': 'at the door'}}}]}
+
+
+@pytest.fixture
+def bedrock(monkeypatch):
+    client = FakeBedrock()
+    monkeypatch.setattr(multimodal_config, 'bedrock_runtime', client)
+    return client
+
+
+def analyze(model_id, on_delta=None):
+    return multimodal_config.call_claude3_img('describe', 'system', model_id, 0.1, 1.0, 250, 512,
+                                              input_images=[b'frame'], on_delta=on_delta)
+
+
+@pytest.mark.parametrize('model_id, fields', [
+    ('anthropic.claude-3-haiku-20240307-v1:0', {'additionalModelRequestFields': {'top_k': 250}}),
+    ('us.amazon.nova-lite-v1:0', {'additionalModelRequestFields': {'inferenceConfig': {'topK': 250}}}),
+    ('us.meta.llama3-2-11b-instruct-v1:0', {}),
+])
+def test_stream_and_non_stream_send_the_same_fields(bedrock, model_id, fields):
+    assert analyze(model_id) == 'a person at the door'
+    deltas = []
+    assert analyze(model_id, deltas.append) == 'a person at the door'
+    assert deltas == ['a person ', 'at the door']
+    for call in bedrock.calls:
+        assert {key: call[key] for key in call if key == 'additionalModelRequestFields'} == fields
@@ -1,10 +1,11 @@
-import boto3
 from datetime import datetime
 import json
 import logging
 from utils.dynamodb_utils import query_dynamodb, create_xml
 from utils.inference_utils import call_bedrock_inference, call_sagemaker_inference
 from utils.brconnector_utils import BRClient
+from runtime_utils import BRC_SECRET_ID, call_with_secret, get_client
+from rate_limiter import acquire_token
 from botocore.exceptions import ClientError
 import os
 
@@ -18,8 +19,7 @@ def invoke_notify_lambda(notify_lambda_name, notify_request):
     :param notify_request: 请求参数
     """
     try:
-        lambda_client = boto3.client('lambda')
-        lambda_client.invoke(
+        get_client('lambda').invoke(
             FunctionName=notify_lambda_name,
             InvocationType='Event',
             Payload=bytes(json.dumps(notify_request), encoding='utf-8')
@@ -29,22 +29,13 @@ def invoke_notify_lambda(notify_lambda_name, notify_request):
         raise e
     
 def call_inference(**kwargs):
+    # 与其他任务共享模型配额, 总结优先于逐帧分析
+    acquire_token(kwargs['model_id'], 'summary')
     if kwargs['model_id'].lower().startswith("sagemaker"):
         return call_sagemaker_inference(**kwargs)
     elif os.environ.get('BRC_ENABLE') == 'Y':
-        secret_client = boto3.client('secretsmanager')
-        try:
-            get_secret_value_response = secret_client.get_secret_value(
-                SecretId='brconnector-apikey'
-            )
-        except Exception as e:
-            print(f"error in create opensearch client, exception={e}")
-            raise e
-
-        brc_api_key = get_secret_value_response['SecretString']
-        brclient = BRClient(api_key=brc_api_key)
-        brc_response = brclient.chat_completion(**kwargs)
-        return brc_response
+        # API key 在执行环境内缓存, 被拒绝时刷新后重试一次
+        return call_with_secret(BRC_SECRET_ID, lambda brc_api_key: BRClient(api_key=brc_api_key).chat_completion(**kwargs))
     else:
         return call_bedrock_inference(**kwargs)
 
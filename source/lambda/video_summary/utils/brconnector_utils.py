@@ -4,12 +4,15 @@ import base64
 import os
 from pathlib import Path
 from typing import Dict, List, Optional, Union, Any, BinaryIO
+from runtime_utils import HTTP_TIMEOUT, get_http_session
 
 class BRClient:
     def __init__(self, api_key: str):
         self.api_key = api_key
         self.base_url = os.environ.get('BRC_ENDPOINT')
         
+        # pooled session shared by every client in this execution environment
+        self.session = get_http_session()
         self.headers = {
             "Authorization": f"Bearer {api_key}",
             "Content-Type": "application/json"
@@ -77,7 +80,7 @@ class BRClient:
             payload["stop"] = stop
 
         try:
-            response = requests.post(url, headers=self.headers, json=payload)
+            response = self.session.post(url, headers=self.headers, json=payload, timeout=HTTP_TIMEOUT)
             response.raise_for_status()
             return response.json()["choices"][0]["message"]["content"]
         except requests.exceptions.RequestException as e:
@@ -190,7 +193,7 @@ class BRClient:
         }
 
         try:
-            response = requests.post(url, headers=self.headers, json=payload)
+            response = self.session.post(url, headers=self.headers, json=payload, timeout=HTTP_TIMEOUT)
             response.raise_for_status()
             return response.json()["choices"][0]["message"]["content"]
         except requests.exceptions.RequestException as e:
@@ -236,7 +239,7 @@ class BRClient:
                 payload["tool_choice"] = toolConfig["toolChoice"]
 
         try:
-            response = requests.post(url, headers=self.headers, json=payload)
+            response = self.session.post(url, headers=self.headers, json=payload, timeout=HTTP_TIMEOUT)
             response.raise_for_status()
             return response.json()
             
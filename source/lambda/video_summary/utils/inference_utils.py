@@ -1,8 +1,8 @@
-import boto3
 from datetime import datetime
 import json
 import logging
 from botocore.exceptions import ClientError
+from runtime_utils import get_client
 import os
 
 logger = logging.getLogger(__name__)
@@ -26,7 +26,7 @@ def call_bedrock_inference(model_id,
 
     logger.info("Generating message with model %s", model_id)
     
-    bedrock_client = boto3.client(service_name='bedrock-runtime')
+    bedrock_client = get_client('bedrock-runtime')
 
     # Base inference parameters to use.
     inference_config = {"temperature": temperature, "topP": top_p, "maxTokens": max_tokens}
@@ -71,7 +71,7 @@ def call_sagemaker_inference(model_id,
                           input_text, temperature, top_p, top_k, max_tokens):
     logger.info("Generating message with model %s", model_id)
     
-    smr_client = boto3.client("sagemaker-runtime")
+    smr_client = get_client("sagemaker-runtime")
     
     prompt = "# system_prompt  \n" + system_prompts + "\n===============\n # user_input  \n" + input_text
 
@@ -7,11 +7,13 @@ import os
 from botocore.exceptions import ClientError
 from utils.dynamodb_utils import query_dynamodb, put_db, get_chat_history_db, create_xml
 from utils.inference_utils import _invoke_with_retries
+from rate_limiter import RateLimitExceeded
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 CHAT_HISTORY_LENGTH = 5
+BUSY_REPLY = 'The model is busy right now, please ask again in a moment.'
 
 dynamodb = boto3.resource('dynamodb')
 
@@ -77,6 +79,15 @@ def lambda_handler(event, context):
             'action': 'vqa_chatbot',
             'body': json.dumps({'vqa_result':response}, ensure_ascii=False)
         }
+    except RateLimitExceeded as e:
+        # the model quota stayed exhausted for the whole wait of an interactive request, the question is not
+        # added to the chat history so it can simply be asked again
+        logger.warning(f"Model busy: {e}")
+        return {
+            'statusCode': 200,
+            'action': 'vqa_chatbot',
+            'body': json.dumps({'vqa_result': BUSY_REPLY}, ensure_ascii=False)
+        }
     except Exception as e:
         logger.error(f"Error: {e}")
         return {
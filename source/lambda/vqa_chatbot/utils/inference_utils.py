@@ -1,11 +1,14 @@
-import boto3
 import logging
 import json
 import os
+import time
+import random
 from botocore.exceptions import ClientError
 from utils.brconnector_utils import BRClient
+from runtime_utils import BRC_SECRET_ID, call_with_secret, get_client
+from rate_limiter import acquire_token
 
-bedrock_runtime = boto3.client(service_name='bedrock-runtime')
+bedrock_runtime = get_client('bedrock-runtime')
 
 logger = logging.getLogger()
 
@@ -16,8 +19,7 @@ def invoke_notify_lambda(notify_lambda_name, notify_request):
     :param notify_request: 请求参数
     """
     try:
-        lambda_client = boto3.client('lambda')
-        lambda_client.invoke(
+        get_client('lambda').invoke(
             FunctionName=notify_lambda_name,
             InvocationType='Event',
             Payload=bytes(json.dumps(notify_request), encoding='utf-8')
@@ -124,7 +126,7 @@ def call_bedrock_inference(chat_history,system_message, prompt,model_id):
 
 def call_sagemaker_inference(chat_history,system_message, prompt,model_id):
 
-    smr_client = boto3.client("sagemaker-runtime")
+    smr_client = get_client("sagemaker-runtime")
 
     content = "# system_prompt  \n" + system_message + "\n===============\n # user_input  \n" + prompt
 
@@ -171,22 +173,12 @@ def call_brclient_inference(chat_history,system_message, prompt,model_id):
       }
 
 
-    secret_client = boto3.client('secretsmanager')
-    try:
-        get_secret_value_response = secret_client.get_secret_value(
-            SecretId='brconnector-apikey'
-        )
-    except Exception as e:
-        print(f"error in create opensearch client, exception={e}")
-        raise e
-    brc_api_key = get_secret_value_response['SecretString']
-    
-    brclient = BRClient(api_key=brc_api_key)  
-    response = brclient.chat_completion(
+    # API key 在执行环境内缓存, 被拒绝时刷新后重试一次
+    response = call_with_secret(BRC_SECRET_ID, lambda brc_api_key: BRClient(api_key=brc_api_key).chat_completion(
         model_id=model_id,
         system_prompts=system,
         input_text=chat_history
-        )
+        ))
     
     answer = response["choices"][0]["message"]["content"]
     input_tokens = response["usage"]["prompt_tokens"]
@@ -195,6 +187,8 @@ def call_brclient_inference(chat_history,system_message, prompt,model_id):
     return answer, input_tokens, output_tokens
 
 def call_inference(**kwargs):
+    # 与其他任务共享模型配额, 交互式问答优先于逐帧分析
+    acquire_token(kwargs['model_id'], 'interactive')
     if kwargs['model_id'].lower().startswith("sagemaker"):
         return call_sagemaker_inference(**kwargs)
     elif os.environ.get('BRC_ENABLE') == 'Y':
@@ -213,6 +207,8 @@ def _invoke_with_retries(chat_history,system_message, prompt,model_id):
         try:
             response,input_tokens,output_tokens= call_inference(chat_history=chat_history,system_message=system_message, prompt=prompt,model_id=model_id)
             return response,input_tokens,output_tokens
+        # RateLimitExceeded is not retried here, acquire_token already waited for the model quota; the caller
+        # answers with a busy reply
         except ClientError as e:
             if e.response['Error']['Code'] == 'ThrottlingException':
                 if retries < max_retries:
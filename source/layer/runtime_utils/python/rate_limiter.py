@@ -0,0 +1,148 @@
+import os
+import json
+import time
+import random
+import logging
+import threading
+from botocore.exceptions import ClientError
+from runtime_utils import get_client
+
+logger = logging.getLogger()
+
+# requests per minute, the first entry whose key is a substring of the lowercase model_id applies, 0 disables;
+# models without an entry are unlimited unless DEFAULT_MODEL_RPM is set
+MODEL_RATE_LIMITS = json.loads(os.environ.get('MODEL_RATE_LIMITS') or '{}')
+DEFAULT_MODEL_RPM = float(os.environ.get('DEFAULT_MODEL_RPM', 0))
+# a bucket holds at most this many seconds of requests, which bounds the burst after an idle period
+BURST_SECONDS = float(os.environ.get('RATE_LIMIT_BURST_SECONDS', 10))
+# shared buckets across every Lambda when set, per execution environment buckets otherwise
+RATE_LIMIT_TABLE = os.environ.get('RATE_LIMIT_TABLE')
+
+# reserve: share of a full bucket a class has to leave for the classes above it, so queued batch work cannot
+# starve interactive requests; max_wait: seconds a call waits for a token before giving up
+PRIORITIES = {
+    'interactive': {'reserve': 0.0, 'max_wait': 15},
+    'summary': {'reserve': 0.2, 'max_wait': 60},
+    'batch': {'reserve': 0.4, 'max_wait': 30},
+}
+
+
+class RateLimitExceeded(Exception):
+    """
+    No token became available within the wait of the priority class
+    """
+    # lets runtime_utils.is_throttle treat it like a throttling response from the model
+    throttled = True
+
+
+class LocalTokenBucket:
+    """
+    Token buckets in memory, only coordinates the threads of one execution environment
+    """
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def try_acquire(self, model_id, rate, capacity, reserve):
+        """
+        :return: 0 when a token was taken, otherwise the seconds until one is expected
+        """
+        with self.lock:
+            now = time.monotonic()
+            tokens, updated_at = self.buckets.get(model_id, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated_at) * rate)
+            if tokens - 1 >= reserve:
+                self.buckets[model_id] = (tokens - 1, now)
+                return 0
+            self.buckets[model_id] = (tokens, now)
+            return (reserve + 1 - tokens) / rate
+
+
+class DynamoDBTokenBucket:
+    """
+    Token buckets in a DynamoDB table keyed by model_id, shared by every task and Lambda.
+    Updates are conditional on the version read, a lost race is retried after a short pause.
+    """
+    def __init__(self, table_name):
+        self.table_name = table_name
+
+    def try_acquire(self, model_id, rate, capacity, reserve):
+        dynamodb = get_client('dynamodb')
+        item = dynamodb.get_item(TableName=self.table_name, Key={'model_id': {'S': model_id}},
+                                 ConsistentRead=True).get('Item')
+        now = time.time()
+        if item:
+            elapsed = max(0.0, now - float(item['updated_at']['N']))
+            tokens = min(capacity, float(item['tokens']['N']) + elapsed * rate)
+        else:
+            tokens = capacity
+        if tokens - 1 < reserve:
+            return (reserve + 1 - tokens) / rate
+
+        condition = {'ConditionExpression': 'attribute_not_exists(model_id)'}
+        if item:
+            condition = {
+                'ConditionExpression': 'updated_at = :updated_at',
+                'ExpressionAttributeValues': {':updated_at': item['updated_at']}
+            }
+        try:
+            dynamodb.put_item(TableName=self.table_name, Item={
+                'model_id': {'S': model_id},
+                'tokens': {'N': str(round(tokens - 1, 6))},
+                'updated_at': {'N': str(round(now, 6))}
+            }, **condition)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            return random.uniform(0.01, 0.05)
+        return 0
+
+
+_local_bucket = LocalTokenBucket()
+_shared_bucket = DynamoDBTokenBucket(RATE_LIMIT_TABLE) if RATE_LIMIT_TABLE else None
+
+
+def model_rate(model_id):
+    """
+    Requests per minute allowed for model_id
+    """
+    model = model_id.lower()
+    for key, rpm in MODEL_RATE_LIMITS.items():
+        if key.lower() in model:
+            return float(rpm)
+    return DEFAULT_MODEL_RPM
+
+
+def try_acquire(model_id, rate, capacity, reserve):
+    if _shared_bucket is not None:
+        try:
+            return _shared_bucket.try_acquire(model_id, rate, capacity, reserve)
+        except ClientError as e:
+            # the limiter must not stop inference, fall back to the local bucket while the table is unavailable
+            logger.warning(f'Rate limit table unavailable, using the local bucket: {e}')
+    return _local_bucket.try_acquire(model_id, rate, capacity, reserve)
+
+
+def acquire_token(model_id, priority='batch'):
+    """
+    Block until model_id has capacity for one more request, call it right before each model invocation
+    :param priority: 'interactive', 'summary' or 'batch', lower classes leave part of the bucket to higher ones
+    :raise RateLimitExceeded: when no token is available within the wait of the class
+    """
+    rpm = model_rate(model_id)
+    if rpm <= 0:
+        return
+    rate = rpm / 60
+    capacity = max(1.0, rate * BURST_SECONDS)
+    settings = PRIORITIES.get(priority, PRIORITIES['batch'])
+    reserve = min(capacity * settings['reserve'], capacity - 1)
+
+    deadline = time.monotonic() + settings['max_wait']
+    while True:
+        wait = try_acquire(model_id, rate, capacity, reserve)
+        if not wait:
+            return
+        if time.monotonic() + wait > deadline:
+            raise RateLimitExceeded(f'No {priority} capacity for {model_id} within {settings["max_wait"]}s')
+        # jitter spreads out callers that wait for the same refill
+        time.sleep(wait * random.uniform(1.0, 1.2))
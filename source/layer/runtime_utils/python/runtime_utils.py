@@ -0,0 +1,164 @@
+import os
+import json
+import time
+import boto3
+import logging
+import requests
+import threading
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger()
+
+# secrets are fetched again after this many seconds, so a rotated value is picked up without a redeploy
+SECRET_TTL = int(os.environ.get('SECRET_TTL_SECONDS', 300))
+
+BRC_SECRET_ID = 'brconnector-apikey'
+OPENSEARCH_SECRET_ID = 'opensearch-master-user'
+
+# error codes of boto3 ClientError that mean the request was throttled
+THROTTLE_ERROR_CODES = {'ThrottlingException', 'TooManyRequestsException', 'ServiceQuotaExceededException',
+                        'ModelNotReadyException', 'RequestLimitExceeded'}
+
+# pooled HTTP session for BRConnector and other plain HTTP endpoints
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 10))
+HTTP_MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', 3))
+HTTP_BACKOFF = float(os.environ.get('HTTP_BACKOFF_SECONDS', 0.5))
+# (connect, read) in seconds, pass as timeout= on every request. The read timeout stays below the 60 s timeout of
+# the functions using the session, so a hung call fails with an error instead of running the invocation out
+HTTP_TIMEOUT = (float(os.environ.get('HTTP_CONNECT_TIMEOUT', 5)), float(os.environ.get('HTTP_READ_TIMEOUT', 50)))
+
+# module level, so every warm invocation of the execution environment reuses them
+_clients = {}
+_secrets = {}
+_lock = threading.Lock()
+
+
+def get_client(service_name, **kwargs):
+    """
+    boto3 client built on first use and reused by later calls and invocations.
+    Clients are thread safe, one per service and arguments is enough.
+    :param kwargs: boto3.client arguments such as endpoint_url or config
+    """
+    key = (service_name, tuple(sorted(kwargs.items(), key=lambda item: item[0])))
+    client = _clients.get(key)
+    if client is None:
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = boto3.client(service_name, **kwargs)
+                _clients[key] = client
+    return client
+
+
+def get_http_session():
+    """
+    requests Session built on first use, so warm invocations keep their TLS connections alive.
+    Throttling, 5xx responses and connection errors are retried with exponential backoff, the last
+    response is returned as is for raise_for_status. 401/403 are left to call_with_secret.
+    """
+    key = ('http',)
+    session = _clients.get(key)
+    if session is None:
+        with _lock:
+            session = _clients.get(key)
+            if session is None:
+                retry = Retry(
+                    total=HTTP_MAX_RETRIES,
+                    # a request that timed out while reading may have been served, do not send it again
+                    read=0,
+                    backoff_factor=HTTP_BACKOFF,
+                    status_forcelist=(429, 500, 502, 503, 504),
+                    allowed_methods=None,
+                    respect_retry_after_header=True,
+                    raise_on_status=False
+                )
+                adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE,
+                                      max_retries=retry)
+                session = requests.Session()
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _clients[key] = session
+    return session
+
+
+def get_opensearch_client(host, secret_id=OPENSEARCH_SECRET_ID):
+    """
+    OpenSearch client authenticated with the master user secret, reused by warm invocations and rebuilt
+    when the secret was rotated. opensearch-py is imported here since only the OpenSearch functions bundle it.
+    :param host: domain endpoint without 'https://'
+    """
+    from opensearchpy import OpenSearch, RequestsHttpConnection
+
+    secret_string = get_secret(secret_id)
+    key = ('opensearch', host)
+    cached = _clients.get(key)
+    if cached is not None and cached[0] == secret_string:
+        return cached[1]
+
+    secret_dict = json.loads(secret_string)
+    client = OpenSearch(
+        hosts=[{'host': host, 'port': 443}],
+        http_auth=HTTPBasicAuth(secret_dict['username'], secret_dict['password']),
+        use_ssl=True,
+        connection_class=RequestsHttpConnection
+    )
+    _clients[key] = (secret_string, client)
+    return client
+
+
+def get_secret(secret_id, refresh=False):
+    """
+    SecretString of a Secrets Manager secret, cached for SECRET_TTL seconds
+    :param refresh: skip the cache, after the cached value was rejected
+    """
+    cached = _secrets.get(secret_id)
+    if cached is not None and not refresh and time.monotonic() - cached[1] < SECRET_TTL:
+        return cached[0]
+    value = get_client('secretsmanager').get_secret_value(SecretId=secret_id)['SecretString']
+    _secrets[secret_id] = (value, time.monotonic())
+    return value
+
+
+def is_auth_failure(error):
+    """
+    True when error, or an error it was raised from, is an HTTP 401/403 response
+    """
+    while error is not None:
+        response = getattr(error, 'response', None)
+        if getattr(response, 'status_code', None) in (401, 403):
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+
+def is_throttle(error):
+    """
+    True when error, or an error it was raised from, is a throttling response: a boto3 ClientError
+    such as ThrottlingException, an HTTP 429 response, or rate_limiter.RateLimitExceeded
+    """
+    while error is not None:
+        if getattr(error, 'throttled', False):
+            return True
+        response = getattr(error, 'response', None)
+        if isinstance(response, dict) and response.get('Error', {}).get('Code') in THROTTLE_ERROR_CODES:
+            return True
+        if getattr(response, 'status_code', None) == 429:
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+
+def call_with_secret(secret_id, call):
+    """
+    Run call(secret) with the cached secret. When the secret is rejected, it was most likely rotated:
+    fetch it again and retry once.
+    """
+    try:
+        return call(get_secret(secret_id))
+    except Exception as e:
+        if not is_auth_failure(e):
+            raise
+        logger.warning(f'Secret {secret_id} was rejected, refreshing it and retrying')
+        return call(get_secret(secret_id, refresh=True))
@@ -0,0 +1,66 @@
+import pytest
+
+import rate_limiter
+from rate_limiter import LocalTokenBucket, RateLimitExceeded, acquire_token
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limiter.time, 'monotonic', clock)
+    return clock
+
+
+def test_bucket_starts_full_then_waits_for_refill(clock):
+    bucket = LocalTokenBucket()
+    # 1 request per second, bursts of 3
+    assert [bucket.try_acquire('model', 1.0, 3.0, 0.0) for _ in range(3)] == [0, 0, 0]
+    assert bucket.try_acquire('model', 1.0, 3.0, 0.0) == pytest.approx(1.0)
+    clock.now += 1.0
+    assert bucket.try_acquire('model', 1.0, 3.0, 0.0) == 0
+
+
+def test_refill_is_capped_at_capacity(clock):
+    bucket = LocalTokenBucket()
+    bucket.try_acquire('model', 1.0, 2.0, 0.0)
+    clock.now += 60
+    assert [bucket.try_acquire('model', 1.0, 2.0, 0.0) for _ in range(3)][-1] == pytest.approx(1.0)
+
+
+def test_reserve_is_left_to_higher_priorities(clock):
+    bucket = LocalTokenBucket()
+    # a batch caller stops with 2 tokens left, an interactive caller can still take them
+    assert [bucket.try_acquire('model', 1.0, 4.0, 2.0) for _ in range(3)] == [0, 0, pytest.approx(1.0)]
+    assert bucket.try_acquire('model', 1.0, 4.0, 0.0) == 0
+
+
+def test_models_have_separate_buckets(clock):
+    bucket = LocalTokenBucket()
+    assert bucket.try_acquire('model-a', 1.0, 1.0, 0.0) == 0
+    assert bucket.try_acquire('model-b', 1.0, 1.0, 0.0) == 0
+    assert bucket.try_acquire('model-a', 1.0, 1.0, 0.0) > 0
+
+
+def test_models_without_a_limit_are_not_throttled(monkeypatch):
+    monkeypatch.setattr(rate_limiter, 'MODEL_RATE_LIMITS', {})
+    monkeypatch.setattr(rate_limiter, 'DEFAULT_MODEL_RPM', 0)
+    for _ in range(1000):
+        acquire_token('anthropic.claude-3-haiku', 'interactive')
+
+
+def test_acquire_gives_up_after_the_priority_wait(monkeypatch):
+    monkeypatch.setattr(rate_limiter, 'MODEL_RATE_LIMITS', {'haiku': 1})
+    monkeypatch.setattr(rate_limiter, '_shared_bucket', None)
+    monkeypatch.setattr(rate_limiter, '_local_bucket', LocalTokenBucket())
+    acquire_token('anthropic.claude-3-haiku', 'interactive')
+    # the next token of a 1 rpm model is a minute away, longer than the interactive wait
+    with pytest.raises(RateLimitExceeded):
+        acquire_token('anthropic.claude-3-haiku', 'interactive')
@@ -93,13 +93,26 @@ export default function ContentVisionAnalytics({
           if (data.summary_result) {
             setSummary(data.summary_result);
             setIsLoading(false);
+          } else if (data.end_only) {
+            // the task ended without a window of its own to carry the end tag
+            Global.taskId = data.task_id;
           } else {
-            setDistributions((prev) =>
-              [...prev, data].filter(
-                (obj, index, self) =>
-                  index === self.findIndex((o) => o.timestamp === obj.timestamp)
+            setDistributions((prev) => {
+              const index = prev.findIndex(
+                (o) => o.timestamp === data.timestamp
+              );
+              if (index < 0) return [...prev, data];
+              // streamed chunks carry stream_seq and are replaced by later
+              // chunks and by the final result, which has none
+              const current = prev[index];
+              if (current.stream_seq === undefined) return prev;
+              if (
+                data.stream_seq !== undefined &&
+                data.stream_seq <= current.stream_seq
               )
-            );
+                return prev;
+              return prev.map((o, i) => (i === index ? data : o));
+            });
             setLoadingAnalyticDetails(false);
             if (data.tag === "end") Global.taskId = data.task_id;
           }